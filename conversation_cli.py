@@ -42,6 +42,27 @@ def start_context(context_name, host, port, history=2):
     return True, con_client
 
 
+def fork_context(context_name, host, port):
+    global contexts
+    global context_colors
+    global current_context
+
+    # Create a new context client sharing the current context's history
+    con_client = ContextClient(context_name, host, port)
+    status = con_client.fork_context(current_context)
+    if status[1] == 422:
+        print_error(status[2]['detail'])
+        return False, None
+
+    contexts[context_name] = con_client
+    next_color_index = len(contexts) % len(conv_colors)
+    context_colors[context_name] = conv_colors[next_color_index - 1]
+
+    # Switch to the fork
+    current_context = context_name
+    return True, con_client
+
+
 def clear_screen():
     sys.stderr.write("\x1b[2J\x1b[H")
 
@@ -97,6 +118,24 @@ def display_model_info():
     print()
 
 
+def display_response_timing(cname):
+    resp_id = contexts[cname].current_response_id
+    if not resp_id:
+        print_warning("No answer yet in context '{}'.".format(cname))
+        return
+
+    timing = llm_client.get_response_timing(resp_id)
+    if timing is None:
+        # Fall back to the breakdown carried by the end of the stream
+        timing = contexts[cname].last_timing
+    if timing:
+        print("Timing of the last answer '{}' in context '{}':".format(resp_id, cname))
+        print(json.dumps(timing, indent=4))
+        print()
+    else:
+        print_warning("No timing available for answer '{}'.".format(resp_id))
+
+
 def display_context_info(cname):
     print("Current information for context '{}':".format(cname))
     info = contexts[cname].get_context_info()
@@ -191,6 +230,11 @@ if __name__ == "__main__":
                 show_help()
                 continue
 
+            # Display the phase timing of the last answer
+            if human_msg == ".timing":
+                display_response_timing(current_context)
+                continue
+
             # Restart LLM
             if human_msg == ".restart":
                 llm_client.restart_llm()
@@ -230,6 +274,19 @@ if __name__ == "__main__":
                     print_error("Invalid context command.")
                 continue
 
+            # Fork the current context into a new context and switch to it
+            if human_msg.startswith(".fork "):
+                cmd_items = human_msg.split()
+                if len(cmd_items) != 2:
+                    print_error("Invalid fork command.")
+                elif cmd_items[1] in contexts:
+                    print_warning("Context '{}' already exists.".format(cmd_items[1]))
+                else:
+                    parent_context = current_context
+                    if fork_context(cmd_items[1], args['host'], args['port'])[0]:
+                        print_warning("Forked context '{}' from '{}'.".format(cmd_items[1], parent_context))
+                continue
+
             # Switch contexts
             if human_msg.startswith(".switch ") or human_msg.startswith(".sw "):
                 cmd_items = human_msg.split()
@@ -381,7 +438,9 @@ if __name__ == "__main__":
             pattern = r'(.*?)[.: ]\d+\.'
 
             try:
-                resp_gen, resp_id = contexts[current_context].submit_directive(human_msg)
+                # Questions asked automatically from the question file go in the batch lane
+                priority = 'batch' if auto_question else None
+                resp_gen, resp_id = contexts[current_context].submit_directive(human_msg, priority=priority)
                 if resp_gen is not None:
                     for word in resp_gen:
                         if not filter_words(word):
@@ -404,5 +463,12 @@ if __name__ == "__main__":
                     print_error("{}".format(resp_id))
                 print(Fore.RESET)
 
+            except KeyboardInterrupt:
+                # Stop the answer on the server too so the model is free for the next directive
+                contexts[current_context].cancel_directive()
+                auto_question = False
+                print(Fore.RESET)
+                print_warning("Answer cancelled.")
+
             except ValueError as ex:
                 print_error(str(ex))
@@ -1,5 +1,5 @@
 import time
-import queue
+import tempfile
 import logging
 import threading
 import uuid
@@ -8,14 +8,28 @@ from abc import ABC, abstractmethod
 from pydantic import BaseModel
 import importlib
 
-from llm_streamers import Word2StdoutStreamer, Word2QueueStreamer
-from llm_contexts import Context
+from llm_streamers import Word2StdoutStreamer, Word2QueueStreamer, DirectiveCancelled
+from llm_contexts import Context, read_template
+from llm_timing import DirectiveTiming
+from llm_trace import TraceRecorder
+from llm_store import ContextStore
+from llm_registry import ContextRegistry, ModelRegistry
+from llm_scheduler import DirectiveScheduler, QueueFull
+from llm_results import ResultStore
 
 
 class Directive(BaseModel):
     response_id: str
     context_name: str
     msg: str
+    submitted: float = 0.0
+    arrival: float = 0.0
+    parameters: dict = {}
+    priority: str = 'interactive'
+    tenant: str = ''
+    deadline: float = 0.0
+    prompt_tokens: int = 0
+    max_tokens: int = 0
 
 
 class BaseLanguageModel(ABC):
@@ -23,17 +37,70 @@ class BaseLanguageModel(ABC):
                       'queue': Word2QueueStreamer,
                       'none': None}
 
+    # Seconds between checks for contexts to evict
+    eviction_interval = 1.0
+
+    # Seconds the worker waits for a directive before doing its idle work
+    idle_interval = 0.1
+
     def __init__(self, model, template, verbose=False, **kwargs):
+        store_dir = kwargs.pop('store_dir', None)
+        # Directives of different contexts run concurrently on backends that batch them
+        workers = max(1, kwargs.pop('workers', 1))
+        registry = ContextRegistry(kwargs.pop('max_contexts', 0),
+                                   kwargs.pop('max_context_memory', 0),
+                                   kwargs.pop('context_ttl', 0.0))
+        scheduler = DirectiveScheduler(kwargs.pop('max_queued', 0),
+                                       kwargs.pop('max_queued_per_context', 0),
+                                       kwargs.pop('queue_aging', 30.0),
+                                       kwargs.pop('tenant_rate', 0.0),
+                                       kwargs.pop('tenant_burst', 0.0),
+                                       kwargs.pop('tenant_weights', None))
+        # Results of the directives by response id, for clients that collect them later
+        results = ResultStore(kwargs.pop('max_results', 1024),
+                              kwargs.pop('result_ttl', 3600.0),
+                              kwargs.pop('max_result_memory', 0))
+        # Contexts naming another model than the default one share the models loaded on demand
+        models = ModelRegistry(self._load_model, self._unload_model,
+                               kwargs.pop('model_memory', 0), kwargs.pop('models', None))
+        # Model parameters are kept for the swaps and the other models, which only override some of them
+        self._llm_params = dict(kwargs)
+        self._verbose = verbose
         self._llm, self._model_info = self.create_llm(model, verbose, kwargs)
+        models.set_default(model)
+        self._models = models
         self._default_template_file = template
-
-        self._contexts = {}
-        self._directive_queue = queue.Queue()
-        self._directives_thread = threading.Thread(target=self._directive_worker, args=())
-
+        self._model_state = 'ready'
+        self._swap_lock = threading.Lock()
+        # Contexts switching to the new model when their running directive ends
+        self._llm_switches = set()
+
+        # Evicted contexts need somewhere to spill to even without a persistent store
+        if registry.enabled and not store_dir:
+            store_dir = tempfile.mkdtemp(prefix='llm_contexts_')
+
+        # Contexts are snapshotted to the store (if any) and lazily rehydrated from it
+        self._store = ContextStore(store_dir) if store_dir else None
+        self._contexts = registry
+        self._last_eviction = time.monotonic()
+        self._context_settings = {}
+        self._contexts_lock = threading.RLock()
+        self._scheduler = scheduler
+        # Context and cancel event of every queued or running directive by response id
+        self._outstanding = {}
+        self._results = results
+        self._trace = None
+        self._workers = workers
+        self._directives_threads = []
+
+        self._start_workers()
+
+    def _start_workers(self):
         self._running = True
-        self._directives_thread.start()
-        self._last_result = None
+        self._directives_threads = [threading.Thread(target=self._directive_worker, args=())
+                                    for _ in range(self._workers)]
+        for thread in self._directives_threads:
+            thread.start()
 
     @abstractmethod
     def create_llm(self, model, verbose, kwargs):
@@ -46,175 +113,723 @@ class BaseLanguageModel(ABC):
         self.shutdown()
 
     def shutdown(self):
-        # Shutdown the converse worker thread
+        # Shutdown the converse worker threads
         if self._running:
             self._running = False
-            self._directives_thread.join()
-
-        # Delete all contexts
-        for context_name in list(self._contexts):
-            self.delete_context(context_name)
-
-        self._contexts = {}
-        self._directive_queue = queue.Queue()
+            for thread in self._directives_threads:
+                thread.join()
+
+        # Drop all contexts (their snapshots stay in the store to be rehydrated on first use)
+        with self._contexts_lock:
+            for context_name in list(self._contexts):
+                self._context_unloaded(context_name)
+                logging.info("Unloaded context '{}'.".format(context_name))
+            self._contexts.clear()
+            self._context_settings = {}
+        for directive in self._scheduler.clear():
+            self._results.finish(directive.response_id, 'CANCELLED', error="Model shut down")
+        self._outstanding = {}
+        self.stop_trace()
 
         logging.info("LLM has been shutdown.")
 
     def restart(self):
+        # Keep recording to the same trace across the restart
+        trace_file = self._trace.trace_file if self._trace else None
         self.shutdown()
+        if trace_file:
+            self.start_trace(trace_file)
 
-        self._directives_thread = threading.Thread(target=self._directive_worker, args=())
-        self._running = True
-        self._directives_thread.start()
+        self._start_workers()
 
         logging.info("LLM has been restarted.")
 
     def _directive_worker(self):
         while self._running:
-            try:
-                directive = self._directive_queue.get(block=False)
+            for expired in self._scheduler.take_expired():
+                self._expire_directive(expired)
+
+            directive = self._scheduler.get(timeout=self.idle_interval)
+            if directive is None:
+                self._worker_idle()
+            else:
+                try:
+                    self._run_directive(directive)
+                finally:
+                    # Together, so a model swap cannot slip in between
+                    with self._scheduler.paused():
+                        self._switch_context(directive.context_name)
+                        self._scheduler.done(directive.context_name)
+
+            if self._contexts.enabled and time.monotonic() - self._last_eviction > self.eviction_interval:
+                self._evict_contexts()
+
+    def _expire_directive(self, directive: Directive):
+        # The deadline passed while the directive was waiting, so it is dropped without running
+        self._abort_directive(self._contexts.get(directive.context_name), directive.response_id, 'TIMEOUT')
+        self._outstanding.pop(directive.response_id, None)
+        self._contexts.unpin(directive.context_name)
+        logging.warning("Dropped directive '{}' in context '{}' past its deadline.".format(directive.response_id,
+                                                                                        directive.context_name))
+
+    def _run_directive(self, directive: Directive):
+        if directive.deadline and time.monotonic() > directive.deadline:
+            self._expire_directive(directive)
+            return
+
+        _context_name, cancel = self._outstanding.get(directive.response_id, (None, threading.Event()))
+        model = None
+        try:
+            context = self._find_context(directive.context_name)
+            if context is None:
+                self._results.finish(directive.response_id, 'FAILED', error="Unknown context")
+                logging.error("Unknown context '{}'".format(directive.context_name))
+                return
+
+            if cancel.is_set():
+                # Cancelled between leaving the queue and starting
+                self._abort_directive(context, directive.response_id, 'CANCELLED')
+                logging.info("Cancelled directive '{}' before it started.".format(directive.response_id))
+                return
 
-                if directive.context_name in self._contexts:
-                    logging.info("Started directive in context '{}'...".format(directive.context_name))
+            try:
+                model = self._acquire_model(directive.context_name, context)
+            except Exception as ex:
+                self._abort_directive(context, directive.response_id, 'FAILED', error=str(ex))
+                logging.error("Unable to load the model of context '{}': {}".format(directive.context_name, ex))
+                return
+
+            logging.info("Started directive in context '{}'...".format(directive.context_name))
+            history_length = len(context.history_store)
+            timing = DirectiveTiming(directive.response_id, directive.submitted)
+            timing.start()
+            self._results.start(directive.response_id)
+            self._before_directive(directive.context_name)
+
+            # Send directive message to the selected context
+            # This blocks here while working (or until the directive is cancelled)
+            try:
+                result = context.submit_directive(directive.response_id, directive.msg, timing,
+                                                  directive.parameters, cancel)
+            except DirectiveCancelled:
+                self._after_directive(directive.context_name)
+                self._abort_directive(context, directive.response_id, 'CANCELLED', timing)
+                self._directive_done(directive, timing)
+                logging.info("Cancelled directive in context '{}' after {:.2f}s\n\n".format(directive.context_name,
+                                                                                          timing.total))
+                return
+            except Exception as ex:
+                # The LLM failed (a remote model that kept failing, ...), the worker carries on
+                self._after_directive(directive.context_name)
+                self._abort_directive(context, directive.response_id, 'FAILED', timing, str(ex))
+                self._directive_done(directive, timing)
+                logging.error("Failed directive in context '{}': {}".format(directive.context_name, ex))
+                return
+
+            self._after_directive(directive.context_name)
+            self._directive_done(directive, timing)
+            self._results.finish(directive.response_id, 'END', timing, result)
+            self._snapshot_turn(directive.context_name, context)
+            self._contexts.update_size(directive.context_name)
+
+            if self._trace:
+                self._trace.record(directive.arrival, directive.context_name, context.get_context_info(),
+                                   history_length, directive.msg, directive.parameters or {},
+                                   self._effective_parameters(context, directive.parameters), timing)
+
+            logging.info("Completed directive in context '{}' in {:.2f}s\n\n".format(directive.context_name,
+                                                                                     timing.total))
+        finally:
+            if model:
+                self._models.release(model)
+            self._outstanding.pop(directive.response_id, None)
+            self._contexts.unpin(directive.context_name)
+
+    def _context_model(self, context_name: str) -> Union[str, None]:
+        # Model of a context that does not use the default model
+        settings = self._context_settings.get(context_name)
+        if settings is None or not settings.get('model') or self._models.is_default(settings['model']):
+            return None
+        return self._models.resolve(settings['model'])
 
-                    # Send directive message to the selected context
-                    # This blocks here while working
-                    self._last_result = self._contexts[directive.context_name].submit_directive(directive.response_id,
-                                                                                                directive.msg)
+    def _acquire_model(self, context_name: str, context: Context) -> Union[str, None]:
+        # Load the context's model if it is not the default one (and not loaded yet)
+        model = self._context_model(context_name)
+        if model is None:
+            return None
 
-                    logging.info("Completed directive in context '{}'\n\n".format(directive.context_name))
-                else:
-                    logging.error("Unknown context '{}'".format(directive.context_name))
+        llm = self._models.acquire(model)
+        with self._contexts_lock:
+            if context.llm is not llm:
+                context.set_llm(llm)
+        return model
+
+    def _load_model(self, model: str):
+        return self.create_llm(model, self._verbose, dict(self._llm_params))
+
+    def _unload_model(self, model: str, llm):
+        # The contexts of an unloaded model estimate their tokens until it is loaded again
+        with self._contexts_lock:
+            for context_name in self._contexts:
+                context = self._contexts.get(context_name)
+                if context and context.llm is llm:
+                    context.set_llm(None)
+        self._model_swapped(llm)
+
+    def _switch_context(self, context_name: str):
+        # A context that was running during a model swap moves to the new model between its directives
+        if context_name in self._llm_switches:
+            context = self._contexts.get(context_name)
+            if context:
+                context.set_llm(self._llm)
+            self._llm_switches.discard(context_name)
+
+    def swap_model(self, model: str, **params) -> (bool, str):
+        # Load another model (or quantization) next to the current one and switch to it between directives.
+        # The parameters override the ones the current model was created with. The old model is freed once
+        # the directives running on it are done.
+        if not self._swap_lock.acquire(blocking=False):
+            return False, "A model swap is already in progress."
+
+        try:
+            self._model_state = 'loading'
+            start = time.monotonic()
+            llm_params = dict(self._llm_params, **params)
+            try:
+                llm, model_info = self.create_llm(model, self._verbose, dict(llm_params))
+            except Exception as ex:
+                msg = "Unable to load model '{}': {}".format(model, ex)
+                logging.error(msg)
+                return False, msg
 
-            except queue.Empty:
+            # Contexts that are not running switch right away, the others when their directive ends
+            self._model_state = 'swapping'
+            with self._scheduler.paused() as running:
+                old_llm = self._llm
+                self._llm, self._model_info = llm, model_info
+                self._llm_params = llm_params
+                self._models.set_default(model)
+                with self._contexts_lock:
+                    for context_name in list(self._contexts):
+                        if self._context_model(context_name):
+                            continue
+                        if context_name in running:
+                            self._llm_switches.add(context_name)
+                        else:
+                            self._contexts.get(context_name).set_llm(llm)
+                self._model_switched()
+            logging.info("Switched to model '{}' after {:.2f}s, {} directives still running on the old one".format(
+                model, time.monotonic() - start, len(self._llm_switches)))
+
+            self._model_state = 'draining'
+            while self._llm_switches and self._running:
                 time.sleep(0.1)
+            self._model_swapped(old_llm)
+
+            msg = "Swapped to model '{}' in {:.2f}s.".format(model, time.monotonic() - start)
+            logging.info(msg)
+            return True, msg
+        finally:
+            self._model_state = 'ready'
+            self._swap_lock.release()
+
+    def _evict_contexts(self):
+        # Spill idle and least recently used contexts to the store to stay within budget
+        self._last_eviction = time.monotonic()
+        with self._contexts_lock:
+            for context_name in self._contexts.select_evictions():
+                context = self._contexts.pop(context_name)
+                self._snapshot_context(context_name, context)
+                self._context_settings.pop(context_name, None)
+                self._context_unloaded(context_name)
+                logging.info("Evicted context '{}' to the store.".format(context_name))
+
+    def _directive_done(self, directive: Directive, timing: DirectiveTiming):
+        # Feed the throughput estimate and the tenant's usage
+        self._scheduler.record_service(timing.service)
+        self._scheduler.record_usage(directive, timing.prompt_tokens, timing.completion_tokens)
+
+    def _abort_directive(self, context: Union[Context, None], response_id: str, event: str,
+                         timing: Union[DirectiveTiming, None] = None, error: str = ''):
+        # Close the directive's stream (if its context is loaded) and keep the outcome for lookup
+        if context:
+            context.abort_directive(response_id, event, timing)
+        self._results.finish(response_id, event, timing, error=error)
+
+    def _effective_parameters(self, context: Context, overrides: Union[dict, None] = None) -> dict:
+        # Temperature and token limit a directive ran with (model defaults, the template's token limit
+        # and the directive's overrides)
+        parameters = {name: self._model_info[name] for name in ('temperature', 'max_tokens')
+                      if name in self._model_info}
+        if 'temperature' in (overrides or {}):
+            parameters['temperature'] = overrides['temperature']
+        max_tokens = context.max_tokens(overrides)
+        if max_tokens:
+            parameters['max_tokens'] = max_tokens
+        return parameters
+
+    def start_trace(self, trace_file: str):
+        # Record every directive to an append-only JSONL trace for later replay
+        self.stop_trace()
+        self._trace = TraceRecorder(trace_file, self._model_info)
+
+    def stop_trace(self):
+        if self._trace:
+            self._trace.close()
+            self._trace = None
+
+    # Hooks for the backends to manage per context model state (all called from the directive workers
+    # except _context_reset and _model_available, and with more than one worker from several threads at once)
+    def _before_directive(self, context_name: str):
+        pass
+
+    def _after_directive(self, context_name: str):
+        pass
+
+    def _worker_idle(self):
+        pass
+
+    def _context_unloaded(self, context_name: str):
+        pass
+
+    def _context_reset(self, context_name: str):
+        pass
+
+    def _context_forked(self, parent_name: str, context_name: str):
+        pass
+
+    def _model_available(self, model: str) -> bool:
+        # Whether a model other than the default one can be loaded
+        return True
+
+    def _model_switched(self):
+        # The new model is in place and no directive is starting (drop the state tied to the old model)
+        pass
+
+    def _model_swapped(self, old_llm):
+        # The old model's last directive is done, after a swap or when an idle model is unloaded
+        # (dropping the last reference frees it)
+        pass
+
+    def _build_context(self, context_name: str, template_file: Union[str, None], history_count: int,
+                       system_prompt: Union[str, None], summerizer_type: str,
+                       streamer_type: Union[str, None], priority: str = 'interactive',
+                       model: Union[str, None] = None, **streamer_params) -> (Union[Context, None], str):
+        if priority not in DirectiveScheduler.lanes:
+            msg = "Unknown priority '{}' (use {}).".format(priority, ', '.join(DirectiveScheduler.lanes))
+            logging.error(msg)
+            return None, msg
+
+        # Contexts of another model get it when their first directive runs (if it is not loaded yet)
+        llm = self._llm
+        if model and not self._models.is_default(model):
+            if not self._model_available(self._models.resolve(model)):
+                msg = "Unknown model '{}'.".format(model)
+                logging.error(msg)
+                return None, msg
+            llm = self._models.get(self._models.resolve(model))
+
+        # Select prompt template (specified here or specified with the LLM)
+        templ_file = template_file if template_file else self._default_template_file
+        if not templ_file:
+            msg = "Context '{}' does not have a template.".format(context_name)
+            logging.error(msg)
+            return None, msg
+
+        # Setup a streamer
+        streamer = None
+        if streamer_type in self.streamer_types:
+            streamer = self.streamer_types[streamer_type](context_name, **streamer_params)
+
+        # Create context class based on the name located in the first line of the template file
+        try:
+            template_type, _meta, _text = read_template(templ_file)
+        except FileNotFoundError:
+            msg = "Template file '{}' not found.".format(templ_file)
+            logging.error(msg)
+            return None, msg
+        except ValueError as ex:
+            msg = str(ex)
+            logging.error(msg)
+            return None, msg
+
+        try:
+            # Import the module dynamically
+            module = importlib.import_module("llm_contexts")
+            conv = getattr(module, template_type)(context_name, llm, templ_file, history_count,
+                                                  system_prompt, summerizer_type, streamer)
+        except AttributeError:
+            msg = "Context type '{}' does not exist.".format(template_type)
+            logging.error(msg)
+            return None, msg
+
+        self._contexts[context_name] = conv
+        self._context_settings[context_name] = {"template_file": templ_file,
+                                                "history_count": history_count,
+                                                "system_prompt": system_prompt,
+                                                "summerizer_type": summerizer_type,
+                                                "streamer_type": streamer_type,
+                                                "priority": priority,
+                                                "model": model if model else None}
+        msg = "Started {} context '{}' with history of {}.".format(template_type, context_name, history_count)
+        return conv, msg
+
+    def _find_context(self, context_name: str) -> Union[Context, None]:
+        # Look up a loaded context, rehydrating it from its snapshot on first access
+        context = self._contexts.get(context_name)
+        if context is not None or self._store is None:
+            return context
+
+        with self._contexts_lock:
+            if context_name in self._contexts:
+                return self._contexts.get(context_name)
+
+            snapshot = self._store.load_context(context_name)
+            if snapshot is None:
+                return None
+
+            settings, history = snapshot
+            context, msg = self._build_context(context_name, **settings)
+            if context:
+                context.restore_history(history)
+                logging.info("Restored context '{}' with {} history messages.".format(context_name,
+                                                                                   len(context.history_store)))
+            else:
+                logging.error("Unable to restore context '{}': {}".format(context_name, msg))
+            return context
+
+    def _snapshot_context(self, context_name: str, context: Context):
+        if self._store:
+            self._store.save_context(context_name, self._context_settings[context_name], context.history)
+
+    def _snapshot_turn(self, context_name: str, context: Context):
+        if self._store and len(context.history_store) >= 2:
+            self._store.append_turn(context_name, self._context_settings[context_name], context.history)
 
     def create_context(self, context_name: str,
                        template_file: Union[str, None] = None,
                        history_count: int = 2,
                        system_prompt: Union[str, None] = None,
                        summerizer_type: str = "abstractive",
-                       streamer_type: Union[str, None] = None, **streamer_params) -> (bool, str):
-        if context_name not in self._contexts:
-            # Select prompt template (specified here or specified with the LLM)
-            templ_file = template_file if template_file else self._default_template_file
-            if not templ_file:
-                msg = "Context '{}' does not have a template.".format(context_name)
-                logging.error(msg)
+                       streamer_type: Union[str, None] = None,
+                       priority: str = 'interactive', model: Union[str, None] = None,
+                       **streamer_params) -> (bool, str):
+        # The model is a file or an alias of one (the default model when not given)
+        with self._contexts_lock:
+            if self._find_context(context_name) is None:
+                context, msg = self._build_context(context_name, template_file, history_count, system_prompt,
+                                                   summerizer_type, streamer_type, priority, model,
+                                                   **streamer_params)
+                if context is None:
+                    return False, msg
+
+                self._snapshot_context(context_name, context)
+                logging.info(msg)
+                return True, msg
+            else:
+                msg = "Reusing context '{}'.".format(context_name)
+                logging.warning(msg)
                 return False, msg
 
-            # Setup a streamer
-            streamer = None
-            if streamer_type in self.streamer_types:
-                streamer = self.streamer_types[streamer_type](context_name, **streamer_params)
+    def fork_context(self, parent_name: str, context_name: str) -> (bool, str):
+        # New context sharing the parent's settings and history (the history messages themselves are
+        # shared, each context appends its own turns from here on)
+        with self._contexts_lock:
+            parent = self._find_context(parent_name)
+            if parent is None:
+                msg = "Unknown context '{}'.".format(parent_name)
+                logging.error(msg)
+                return False, msg
 
-            # Create context class based on the name located in the first line of the template file
-            try:
-                with open('templates/' + templ_file, 'r') as file:
-                    # Read the first line from the file
-                    template_type = file.readline().strip()
-            except FileNotFoundError:
-                msg = "Template file '{}' not found.".format(templ_file)
+            if self._find_context(context_name) is not None:
+                msg = "Context '{}' already exists.".format(context_name)
                 logging.error(msg)
                 return False, msg
 
-            try:
-                # Import the module dynamically
-                module = importlib.import_module("llm_contexts")
-                conv = getattr(module, template_type)(context_name, self._llm, templ_file, history_count,
-                                                      system_prompt, summerizer_type, streamer)
-            except AttributeError:
-                msg = "Context type '{}' does not exist.".format(template_type)
+            settings = dict(self._context_settings[parent_name])
+            settings['template_file'] = parent.template_file
+            settings['system_prompt'] = parent.system_prompt
+            context, msg = self._build_context(context_name, **settings)
+            if context is None:
+                return False, msg
+
+            context.restore_history(parent.history_store.entries)
+            self._contexts.update_size(context_name)
+            self._snapshot_context(context_name, context)
+            self._context_forked(parent_name, context_name)
+
+            msg = "Forked context '{}' from '{}' with {} history messages.".format(context_name, parent_name,
+                                                                                   len(context.history_store))
+            logging.info(msg)
+            return True, msg
+
+    def context_busy(self, context_name: str) -> bool:
+        # Whether the context has directives queued or running
+        return any(name == context_name for name, _cancel in list(self._outstanding.values()))
+
+    def export_context(self, context_name: str) -> Union[dict, None]:
+        # Settings and history of a context, enough to rebuild it in another model instance
+        with self._contexts_lock:
+            context = self._find_context(context_name)
+            if context is None:
+                logging.error("Unknown context '{}'.".format(context_name))
+                return None
+
+            settings = dict(self._context_settings[context_name])
+            settings['template_file'] = context.template_file
+            settings['system_prompt'] = context.system_prompt
+            return {"settings": settings, "history": context.history}
+
+    def import_context(self, context_name: str, snapshot: dict) -> (bool, str):
+        # Rebuild a context exported by export_context
+        with self._contexts_lock:
+            if self._find_context(context_name) is not None:
+                msg = "Context '{}' already exists.".format(context_name)
                 logging.error(msg)
                 return False, msg
 
-            self._contexts[context_name] = conv
-            msg = "Started {} context '{}' with history of {}.".format(template_type, context_name,
-                                                                       history_count)
+            context, msg = self._build_context(context_name, **snapshot['settings'])
+            if context is None:
+                return False, msg
+
+            context.restore_history(snapshot['history'])
+            self._contexts.update_size(context_name)
+            self._snapshot_context(context_name, context)
+
+            msg = "Imported context '{}' with {} history messages.".format(context_name, len(context.history_store))
             logging.info(msg)
             return True, msg
-        else:
-            msg = "Reusing context '{}'.".format(context_name)
-            logging.warning(msg)
-            return False, msg
 
     def delete_context(self, context_name: str) -> bool:
-        if context_name in self._contexts:
-            logging.info("Ended context '{}'.".format(context_name))
-            self._contexts.pop(context_name)
-            return True
-        else:
-            logging.error("Unknown context '{}'.".format(context_name))
-            return False
+        with self._contexts_lock:
+            stored = self._store is not None and self._store.has_context(context_name)
+            if stored:
+                self._store.delete_context(context_name)
+
+            if context_name in self._contexts or stored:
+                logging.info("Ended context '{}'.".format(context_name))
+                self._contexts.pop(context_name, None)
+                self._context_settings.pop(context_name, None)
+                self._context_reset(context_name)
+                return True
+            else:
+                logging.error("Unknown context '{}'.".format(context_name))
+                return False
 
     def clear_context(self, context_name: str) -> bool:
-        if context_name in self._contexts:
-            self._contexts[context_name].erase_memory()
+        context = self._find_context(context_name)
+        if context:
+            context.erase_memory()
+            self._snapshot_context(context_name, context)
+            self._contexts.update_size(context_name)
+            self._context_reset(context_name)
             return True
         else:
             logging.error("Unknown context '{}'.".format(context_name))
             return False
 
     def get_context_info(self, context_name: str) -> Union[dict, None]:
-        if context_name in self._contexts:
-            return self._contexts[context_name].get_context_info()
+        context = self._find_context(context_name)
+        if context:
+            info = context.get_context_info()
+            info['idle_seconds'] = round(self._contexts.idle_time(context_name), 1)
+            info['priority'] = self._context_settings[context_name].get('priority', 'interactive')
+            info['model'] = self._context_settings[context_name].get('model')
+            return info
         else:
             logging.error("Unknown context '{}'.".format(context_name))
             return None
 
-    def submit_directive(self, context_name: str, msg: str) -> Union[str, None]:
+    def submit_directive(self, context_name: str, msg: str,
+                         max_tokens: Union[int, None] = None,
+                         temperature: Union[float, None] = None,
+                         top_p: Union[float, None] = None,
+                         stop: Union[list, None] = None,
+                         priority: Union[str, None] = None,
+                         deadline_seconds: Union[float, None] = None,
+                         tenant: Union[str, None] = None) -> Union[str, None]:
         # Add new human message to the LLM queue
-        if context_name in self._contexts:
+        # The generation parameters given here apply to this directive only (the model is left as is)
+        # and so does the priority (the context's priority is used if not given)
+        # A directive still waiting deadline_seconds after it was submitted is dropped (TIMEOUT)
+        # The tenant (who is charged for the directive) is the context name's prefix unless another
+        # configured tenant is given
+        # Raises QueueFull (with a retry estimate) if the queue has no room for it
+        context = self._find_context(context_name)
+        if context:
+            if priority is None:
+                priority = self._context_settings[context_name].get('priority', 'interactive')
+            elif priority not in DirectiveScheduler.lanes:
+                raise ValueError("Unknown priority '{}'".format(priority))
+
+            parameters = {name: value for name, value in (('max_tokens', max_tokens), ('temperature', temperature),
+                                                           ('top_p', top_p), ('stop', stop))
+                          if value is not None}
+            # Cost estimate for the scheduler: the prompt as it would be rendered now and the token limit
+            prompt_tokens = context.estimate_prompt_tokens(msg)
+            limit = context.max_tokens(parameters) or self._model_info.get('max_tokens', 0)
+
+            # Keep the context loaded until the worker picks up the directive
+            self._contexts.pin(context_name)
             resp_id_full = uuid.uuid4().hex
             resp_id = resp_id_full[0:4] + resp_id_full[-4:]
-            directive_item = Directive(response_id=resp_id, context_name=context_name, msg=msg)
-            self._directive_queue.put(directive_item)
+            submitted = time.monotonic()
+            directive_item = Directive(response_id=resp_id, context_name=context_name, msg=msg,
+                                       submitted=submitted, arrival=time.time(), parameters=parameters,
+                                       priority=priority, tenant=self._directive_tenant(context_name, tenant),
+                                       deadline=submitted + deadline_seconds if deadline_seconds else 0.0,
+                                       prompt_tokens=prompt_tokens, max_tokens=limit)
+            self._outstanding[resp_id] = (context_name, threading.Event())
+            self._results.add(resp_id, context_name)
+            try:
+                self._scheduler.put(directive_item)
+            except QueueFull as ex:
+                self._outstanding.pop(resp_id, None)
+                self._results.discard(resp_id)
+                self._contexts.unpin(context_name)
+                logging.warning("Rejected directive in context '{}': {}".format(context_name, ex))
+                raise
             return directive_item.response_id
         else:
             logging.error("Unknown context '{}'.".format(context_name))
             return None
 
+    def _directive_tenant(self, context_name: str, tenant: Union[str, None]) -> str:
+        # A client cannot pick a tenant of its own to get around the token rate and fair share
+        if tenant and (tenant == self.tenant_of(context_name) or self._scheduler.configured_tenant(tenant)):
+            return tenant
+        if tenant:
+            logging.warning("Unknown tenant '{}' for context '{}'".format(tenant, context_name))
+        return self.tenant_of(context_name)
+
+    @staticmethod
+    def tenant_of(context_name: str) -> str:
+        # Context names start with the user they belong to (<login>-<host> by default)
+        return context_name.split('-', 1)[0]
+
+    def get_tenant_usage(self, tenant: Union[str, None] = None) -> dict:
+        return self._scheduler.usage(tenant)
+
+    def cancel_directive(self, response_id: str) -> bool:
+        # Take a queued directive out of the queue, or stop a running one at its next token
+        outstanding = self._outstanding.get(response_id)
+        if outstanding is None:
+            logging.error("Unknown or completed response '{}'.".format(response_id))
+            return False
+
+        context_name, cancel = outstanding
+        cancel.set()
+        directive = self._scheduler.remove(response_id)
+        if directive:
+            # Never started, so its stream is closed right here
+            self._outstanding.pop(response_id, None)
+            self._abort_directive(self._contexts.get(context_name), response_id, 'CANCELLED')
+            self._contexts.unpin(context_name)
+            logging.info("Cancelled queued directive '{}' in context '{}'.".format(response_id, context_name))
+        else:
+            logging.info("Cancelling running directive '{}' in context '{}'.".format(response_id, context_name))
+        return True
+
+    def cancel_directives(self, context_name: str) -> list:
+        # Cancel all the queued and running directives of a context
+        response_ids = [response_id for response_id, (name, _cancel) in list(self._outstanding.items())
+                        if name == context_name]
+        return [response_id for response_id in response_ids if self.cancel_directive(response_id)]
+
     def load_template(self, context_name: str, template_file: str) -> bool:
-        if context_name in self._contexts:
-            return self._contexts[context_name].load_template(template_file)
+        context = self._find_context(context_name)
+        if context and context.load_template(template_file):
+            self._context_settings[context_name]['template_file'] = template_file
+            self._snapshot_context(context_name, context)
+            return True
+        return False
 
     def get_template(self, context_name: str) -> Union[str, None]:
-        if context_name in self._contexts:
-            return self._contexts[context_name].template_file + "|" + self._contexts[context_name].template
+        context = self._find_context(context_name)
+        if context:
+            return context.template_file + "|" + context.template
         else:
             logging.error("Unknown context '{}'.".format(context_name))
             return None
 
     def set_system_prompt(self, context_name: str, system_prompt: str) -> bool:
-        if context_name in self._contexts:
-            self._contexts[context_name].system_prompt = system_prompt
+        context = self._find_context(context_name)
+        if context:
+            context.system_prompt = system_prompt
+            self._context_settings[context_name]['system_prompt'] = system_prompt
+            self._snapshot_context(context_name, context)
             return True
         else:
             logging.error("Unknown context '{}'.".format(context_name))
             return False
 
     def get_context(self, context_name: str) -> Union[Context, None]:
-        if context_name in self._contexts:
-            return self._contexts[context_name]
+        context = self._find_context(context_name)
+        if context:
+            return context
         else:
             logging.error("Unknown context '{}'.".format(context_name))
             return None
 
     def get_history(self, context_name: str):
-        if context_name in self._contexts:
-            return self._contexts[context_name].history
+        context = self._find_context(context_name)
+        if context:
+            return context.history
         else:
             logging.error("Unknown context '{}'.".format(context_name))
             return None
 
+    def get_directive_timing(self, response_id: str) -> Union[dict, None]:
+        result = self._results.get(response_id)
+        if result and result.get('timing'):
+            return result['timing']
+        else:
+            logging.error("Unknown response '{}'.".format(response_id))
+            return None
+
+    def get_directive_result(self, response_id: str) -> Union[dict, None]:
+        # State of a directive (queued, running or done) and once done its end event, text, summary,
+        # token counts and timing (None if unknown or expired)
+        return self._results.get(response_id)
+
     def get_context_names(self):
         names = list(self._contexts.keys())
+        if self._store:
+            # Include the snapshots that have not been rehydrated yet
+            names += [name for name in self._store.get_context_names() if name not in self._contexts]
         return names
 
+    @property
+    def registry_info(self):
+        info = self._contexts.info
+        info['stored_contexts'] = len(self._store.get_context_names()) if self._store else 0
+        return info
+
+    @property
+    def queue_info(self):
+        info = self._scheduler.info
+        info['running'] = len(self._outstanding) - info['queued']
+        return info
+
+    @property
+    def models_info(self):
+        return self._models.info
+
     @property
     def model_info(self):
         return self._model_info
 
+    @property
+    def model_state(self) -> str:
+        # ready, or loading/swapping/draining during a model swap
+        return self._model_state
+
+    @property
+    def results_info(self):
+        return self._results.info
+
     @property
     def last_result(self):
-        return self._last_result
+        # Text and summary of the latest directive that ended
+        last = self._results.last
+        return (last['text'], last['summary']) if last else None
@@ -0,0 +1,368 @@
+import os
+import queue
+import codecs
+import ctypes
+import logging
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+import numpy as np
+import llama_cpp
+
+from langchain_core.callbacks.manager import CallbackManagerForLLMRun
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+
+class _Sequence:
+    """A generation request in the batch engine and the queue its text pieces are streamed through."""
+
+    def __init__(self, prompt_tokens: list, max_tokens: int, temperature: float, top_p: float, stop: list):
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stop = stop
+        self.slot = None
+        self.pending = []          # Prompt tokens not evaluated yet
+        self.last_token = None     # Sampled token to evaluate in the next batch
+        self.generated = 0
+        self.text = ""             # Decoded text not streamed yet (could be the start of a stop sequence)
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.output = queue.Queue()
+        self.cancelled = False
+
+
+class LlamaBatchEngine:
+    """Continuous batching of several generations in one llama.cpp context.
+
+    Each generation gets a sequence id (slot) of its own in a shared KV
+    cache. A single thread builds one batch per step from the next token of
+    every decoding sequence plus as much of the waiting prompts as fits, so
+    requests join and leave at token boundaries. A request takes the free
+    slot holding the longest common prefix with its prompt, so a context's
+    next turn only evaluates the new part of its prompt.
+    """
+
+    # Repetition penalty over the last tokens of a sequence (as in the llama.cpp defaults)
+    repeat_penalty = 1.1
+    repeat_last_n = 64
+
+    def __init__(self, model_path: str, n_ctx: int, n_parallel: int, n_batch: int = 512, n_gpu_layers: int = 0,
+                 verbose: bool = False, seed: Union[int, None] = None):
+        llama_cpp.llama_backend_init()
+        if not verbose:
+            llama_cpp.llama_log_set(_quiet_log(), ctypes.c_void_p(0))
+
+        model_params = llama_cpp.llama_model_default_params()
+        model_params.n_gpu_layers = n_gpu_layers
+        self._model = llama_cpp.llama_model_load_from_file(model_path.encode('utf-8'), model_params)
+        if not self._model:
+            raise ValueError("Unable to load model '{}'".format(model_path))
+        self._vocab = llama_cpp.llama_model_get_vocab(self._model)
+        self._n_vocab = llama_cpp.llama_vocab_n_tokens(self._vocab)
+
+        # Every sequence gets a context of n_ctx tokens
+        context_params = llama_cpp.llama_context_default_params()
+        context_params.n_ctx = n_ctx * n_parallel
+        context_params.n_batch = n_batch
+        context_params.n_ubatch = n_batch
+        context_params.n_seq_max = n_parallel
+        context_params.n_threads = context_params.n_threads_batch = max(1, (os.cpu_count() or 2) // 2)
+        self._ctx = llama_cpp.llama_init_from_model(self._model, context_params)
+        if not self._ctx:
+            raise ValueError("Unable to create a llama.cpp context with {} sequences".format(n_parallel))
+        self._memory = llama_cpp.llama_get_memory(self._ctx)
+        self._batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+
+        self._n_ctx = n_ctx
+        self._n_batch = n_batch
+        self._slots = [[] for _ in range(n_parallel)]   # Tokens in the KV cache of each sequence id
+        self._active = {}
+        self._waiting = []
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Condition()
+        self._stats = {"steps": 0, "batched_tokens": 0, "generated_tokens": 0, "reused_tokens": 0}
+
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="llama-batch", daemon=True)
+        self._thread.start()
+        logging.info("Llama batch engine running {} sequences of {} tokens".format(n_parallel, n_ctx))
+
+    def close(self):
+        with self._lock:
+            self._running = False
+            self._lock.notify()
+        self._thread.join()
+        llama_cpp.llama_batch_free(self._batch)
+        llama_cpp.llama_free(self._ctx)
+        llama_cpp.llama_model_free(self._model)
+
+    def tokenize(self, text: str, add_bos: bool = True) -> list:
+        data = text.encode('utf-8')
+        size = len(data) + 8
+        tokens = (llama_cpp.llama_token * size)()
+        count = llama_cpp.llama_tokenize(self._vocab, data, len(data), tokens, size, add_bos, True)
+        if count < 0:
+            size = -count
+            tokens = (llama_cpp.llama_token * size)()
+            count = llama_cpp.llama_tokenize(self._vocab, data, len(data), tokens, size, add_bos, True)
+        return list(tokens[:count])
+
+    def _piece(self, token: int) -> bytes:
+        buf = ctypes.create_string_buffer(64)
+        count = llama_cpp.llama_token_to_piece(self._vocab, token, buf, len(buf), 0, False)
+        return buf.raw[:count] if count > 0 else b''
+
+    def generate(self, prompt: str, max_tokens: int, temperature: float = 0.0, top_p: float = 1.0,
+                 stop: Union[list, None] = None) -> Iterator[str]:
+        # Stream the text pieces of a generation, the sequence leaves the batch if the caller stops early
+        prompt_tokens = self.tokenize(prompt)
+        if len(prompt_tokens) + max_tokens > self._n_ctx:
+            max_tokens = max(0, self._n_ctx - len(prompt_tokens))
+            if max_tokens == 0:
+                raise ValueError("Prompt of {} tokens does not fit a context of {}".format(len(prompt_tokens),
+                                                                                          self._n_ctx))
+
+        sequence = _Sequence(prompt_tokens, max_tokens, temperature, top_p, list(stop or []))
+        with self._lock:
+            self._waiting.append(sequence)
+            self._lock.notify()
+
+        try:
+            while True:
+                item = sequence.output.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            sequence.cancelled = True
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._running and not self._active and not self._waiting:
+                    self._lock.wait()
+                if not self._running:
+                    break
+                self._admit()
+
+            try:
+                self._step()
+            except Exception as ex:
+                logging.error("Llama batch step failed: {}".format(ex))
+                for slot in list(self._active):
+                    self._finish(slot, ex)
+
+        for sequence in list(self._active.values()) + self._waiting:
+            sequence.output.put(None)
+
+    def _admit(self):
+        # Give waiting requests the free slot sharing the longest prefix with their prompt
+        free = [slot for slot in range(len(self._slots)) if slot not in self._active]
+        while free and self._waiting:
+            sequence = self._waiting.pop(0)
+            if sequence.cancelled:
+                continue
+
+            slot = max(free, key=lambda index: _common_prefix(self._slots[index], sequence.prompt_tokens))
+            free.remove(slot)
+            # At least the last prompt token is evaluated again to get the logits of the first answer token
+            keep = min(_common_prefix(self._slots[slot], sequence.prompt_tokens), len(sequence.prompt_tokens) - 1)
+            llama_cpp.llama_memory_seq_rm(self._memory, slot, keep, -1)
+            del self._slots[slot][keep:]
+            sequence.slot = slot
+            sequence.pending = sequence.prompt_tokens[keep:]
+            self._stats['reused_tokens'] += keep
+            self._active[slot] = sequence
+
+    def _step(self):
+        # One llama_decode of the next token of every decoding sequence plus chunks of the pending prompts
+        batch = self._batch
+        batch.n_tokens = 0
+        outputs = {}
+        for slot, sequence in list(self._active.items()):
+            if sequence.cancelled:
+                self._finish(slot)
+            elif sequence.last_token is not None and batch.n_tokens < self._n_batch:
+                outputs[slot] = self._add_token(slot, sequence.last_token, True)
+                sequence.last_token = None
+
+        for slot, sequence in self._active.items():
+            if sequence.pending and batch.n_tokens < self._n_batch:
+                chunk = sequence.pending[:self._n_batch - batch.n_tokens]
+                sequence.pending = sequence.pending[len(chunk):]
+                for index, token in enumerate(chunk):
+                    last = not sequence.pending and index == len(chunk) - 1
+                    position = self._add_token(slot, token, last)
+                    if last:
+                        outputs[slot] = position
+
+        if batch.n_tokens == 0:
+            return
+
+        result = llama_cpp.llama_decode(self._ctx, batch)
+        if result != 0:
+            raise RuntimeError("llama_decode returned {}".format(result))
+        self._stats['steps'] += 1
+        self._stats['batched_tokens'] += batch.n_tokens
+
+        for slot, position in outputs.items():
+            self._sample(slot, self._active[slot], position)
+
+    def _add_token(self, slot: int, token: int, logits: bool) -> int:
+        batch = self._batch
+        index = batch.n_tokens
+        batch.token[index] = token
+        batch.pos[index] = len(self._slots[slot])
+        batch.n_seq_id[index] = 1
+        batch.seq_id[index][0] = slot
+        batch.logits[index] = logits
+        batch.n_tokens += 1
+        self._slots[slot].append(token)
+        return index
+
+    def _sample(self, slot: int, sequence: _Sequence, position: int):
+        logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(self._ctx, position),
+                                       shape=(self._n_vocab,)).copy()
+
+        # Penalize the recent tokens of this sequence
+        recent = np.unique(np.array(self._slots[slot][-self.repeat_last_n:], dtype=np.int64))
+        if self.repeat_penalty != 1.0 and len(recent):
+            values = logits[recent]
+            logits[recent] = np.where(values > 0, values / self.repeat_penalty, values * self.repeat_penalty)
+
+        if sequence.temperature <= 0:
+            token = int(np.argmax(logits))
+        else:
+            probs = np.exp((logits - logits.max()) / sequence.temperature)
+            probs /= probs.sum()
+            if sequence.top_p < 1.0:
+                order = np.argsort(-probs)
+                keep = order[:int(np.searchsorted(np.cumsum(probs[order]), sequence.top_p)) + 1]
+                token = int(self._rng.choice(keep, p=probs[keep] / probs[keep].sum()))
+            else:
+                token = int(self._rng.choice(self._n_vocab, p=probs))
+
+        if llama_cpp.llama_vocab_is_eog(self._vocab, token):
+            self._finish(slot)
+            return
+
+        sequence.generated += 1
+        self._stats['generated_tokens'] += 1
+        sequence.text += sequence.decoder.decode(self._piece(token))
+        if self._emit(sequence) or sequence.generated >= sequence.max_tokens:
+            self._finish(slot)
+        else:
+            sequence.last_token = token
+
+    @staticmethod
+    def _emit(sequence: _Sequence) -> bool:
+        # Stream the decoded text, holding back what could be the start of a stop sequence
+        for stop in sequence.stop:
+            found = sequence.text.find(stop)
+            if found >= 0:
+                if found:
+                    sequence.output.put(sequence.text[:found])
+                sequence.text = ""
+                return True
+
+        hold = 0
+        for stop in sequence.stop:
+            for length in range(min(len(stop) - 1, len(sequence.text)), hold, -1):
+                if sequence.text.endswith(stop[:length]):
+                    hold = length
+                    break
+        if len(sequence.text) > hold:
+            sequence.output.put(sequence.text[:len(sequence.text) - hold])
+            sequence.text = sequence.text[len(sequence.text) - hold:]
+        return False
+
+    def _finish(self, slot: int, error: Union[Exception, None] = None):
+        # The sequence leaves the batch, its tokens stay in the KV cache for the next request on the slot
+        sequence = self._active.pop(slot)
+        if error is not None:
+            llama_cpp.llama_memory_seq_rm(self._memory, slot, -1, -1)
+            self._slots[slot] = []
+            sequence.output.put(error)
+        else:
+            if sequence.text and not sequence.cancelled:
+                sequence.output.put(sequence.text)
+            sequence.output.put(None)
+
+    @property
+    def info(self) -> dict:
+        with self._lock:
+            info = dict(self._stats)
+            info['active'] = len(self._active)
+            info['waiting'] = len(self._waiting)
+            info['slots'] = len(self._slots)
+            info['tokens_per_step'] = round(info['batched_tokens'] / info['steps'], 2) if info['steps'] else 0.0
+            return info
+
+
+def _common_prefix(a: list, b: list) -> int:
+    count = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        count += 1
+    return count
+
+
+_quiet_log_callback = None
+
+
+def _quiet_log():
+    # Created on first use and kept, llama.cpp holds on to the callback
+    global _quiet_log_callback
+    if _quiet_log_callback is None:
+        _quiet_log_callback = llama_cpp.llama_log_callback(lambda level, text, user_data: None)
+    return _quiet_log_callback
+
+
+class BatchedLlamaCpp(LLM):
+    """LangChain LLM whose generations run in a shared LlamaBatchEngine.
+
+    Called from several directive workers at once, the calls are decoded
+    together; the tokens of each call go to its own callbacks (streamer).
+    """
+
+    engine: Any
+    max_tokens: int = 256
+    temperature: float = 0.0
+    top_p: float = 1.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "llama_batched"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"max_tokens": self.max_tokens, "temperature": self.temperature, "top_p": self.top_p}
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        return "".join(chunk.text for chunk in self._stream(prompt, stop, run_manager, **kwargs))
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        pieces = self.engine.generate(prompt,
+                                      max_tokens=kwargs.get('max_tokens', self.max_tokens),
+                                      temperature=kwargs.get('temperature', self.temperature),
+                                      top_p=kwargs.get('top_p', self.top_p),
+                                      stop=stop)
+        try:
+            for piece in pieces:
+                chunk = GenerationChunk(text=piece)
+                if run_manager:
+                    # A callback raising here (cancellation) closes the generator and frees the slot
+                    run_manager.on_llm_new_token(piece, chunk=chunk)
+                yield chunk
+        finally:
+            pieces.close()
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(self.engine.tokenize(text))
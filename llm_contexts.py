@@ -1,4 +1,7 @@
+import sys
+import json
 import logging
+import threading
 from typing import Union
 from jinja2 import Environment
 from abc import ABC, abstractmethod
@@ -12,9 +15,62 @@ from transformers import pipeline
 
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain, ConversationChain
-from langchain.memory import ConversationBufferWindowMemory
-from llm_streamers import PromptCallbackHandler
+from langchain.chains import LLMChain
+from llm_history import HistoryStore, tokenizer_key
+from llm_prompt import PromptBuilder
+from llm_streamers import PromptCallbackHandler, TimingCallbackHandler, CancelCallbackHandler
+from llm_timing import DirectiveTiming
+
+# Summarizer models are loaded once and shared by all the contexts using them
+_summarizers = {}
+_summarizers_lock = threading.Lock()
+
+
+def shared_summarizer(summerizer_type: str):
+    with _summarizers_lock:
+        if summerizer_type not in _summarizers:
+            if summerizer_type == 'abstractive':
+                _summarizers[summerizer_type] = pipeline("summarization")
+            elif summerizer_type == 'extractive':
+                _summarizers[summerizer_type] = spacy.load('en_core_web_sm')
+        return _summarizers.get(summerizer_type)
+
+
+# Metadata a template header can declare and the type of each value
+template_meta_types = {'stop': list, 'max_tokens': int, 'assistant_prefix': str}
+
+
+def read_template(template_file: str) -> (str, dict, str):
+    """Read a template file into its context type, metadata and template text.
+
+    The first line names the context type, optionally followed by a JSON object
+    with the generation settings of the template, for example:
+    ContextInstruct {"stop": ["</s>", "[INST]"], "max_tokens": 512, "assistant_prefix": ""}
+
+    Raises FileNotFoundError if the template does not exist and ValueError if the header is invalid.
+    """
+    with open('templates/' + template_file, 'r') as f:
+        header = f.readline().strip()
+        text = f.read()
+
+    template_type, _, meta_text = header.partition(' ')
+    meta = {}
+    if meta_text.strip():
+        try:
+            meta = json.loads(meta_text)
+        except json.JSONDecodeError as ex:
+            raise ValueError("Invalid metadata in template '{}': {}".format(template_file, ex))
+        if not isinstance(meta, dict):
+            raise ValueError("Metadata in template '{}' is not an object".format(template_file))
+
+    for key, value in meta.items():
+        if key not in template_meta_types:
+            logging.warning("Ignoring unknown metadata '{}' in template '{}'".format(key, template_file))
+        elif not isinstance(value, template_meta_types[key]) or \
+                (key == 'stop' and not all(isinstance(stop, str) for stop in value)):
+            raise ValueError("Invalid '{}' in template '{}'".format(key, template_file))
+
+    return template_type, meta, text
 
 
 class Context(ABC):
@@ -26,10 +82,11 @@ class Context(ABC):
                  streamer: Union[BaseCallbackHandler, None] = None):
         self._name = name
         self._llm = llm
+        self._tokenizer_key = tokenizer_key(llm)
         self._template_file = template_file
         self._history_count = history_count * 2
         self._out_streamer = streamer
-        self._history = []
+        self._history = HistoryStore(history_count)
 
         if system_prompt is not None and len(system_prompt) > 0:
             self._system_prompt = system_prompt
@@ -42,10 +99,10 @@ class Context(ABC):
         self._summerizer_type = summerizer_type
 
         if summerizer_type == 'abstractive':
-            self._summarizer = pipeline("summarization")
+            self._summarizer = shared_summarizer(summerizer_type)
 
         elif summerizer_type == 'extractive':
-            self._nlp = spacy.load('en_core_web_sm')
+            self._nlp = shared_summarizer(summerizer_type)
 
         elif summerizer_type == 'none':
             pass
@@ -56,6 +113,8 @@ class Context(ABC):
 
         self._template_text = ""
         self._template_rendered_text = ""
+        self._template_meta = {}
+        self._token_overhead = None
 
     def get_context_info(self):
         return {
@@ -64,21 +123,129 @@ class Context(ABC):
             "streamer_type": type(self._out_streamer).__name__,
             "system_prompt": self._system_prompt,
             "template_file": self._template_file,
-            "history_count": self._history_count / 2
+            "template_meta": self._template_meta,
+            "history_count": self._history_count / 2,
+            "memory_bytes": self.memory_usage()
         }
 
+    def memory_usage(self) -> int:
+        # Rough estimate of the memory held by this context alone (shared models are not counted)
+        size = sys.getsizeof(self) + self._history.memory_usage()
+        for text in (self._system_prompt, self._template_text, self._template_rendered_text):
+            size += sys.getsizeof(text)
+        return size
+
     @abstractmethod
     def erase_memory(self):
         pass
 
+    def restore_history(self, history: list):
+        # Reload a saved (already summarized) history or share the entries of another context's
+        # history; the store keeps only the history window
+        self._history.clear()
+        self._history.extend(history)
+
     @abstractmethod
-    def submit_directive(self, stream_id, message):
+    def submit_directive(self, stream_id, message, timing: Union[DirectiveTiming, None] = None,
+                         parameters: Union[dict, None] = None, cancel: Union[threading.Event, None] = None):
         pass
 
+    def abort_directive(self, stream_id, event: str, timing: Union[DirectiveTiming, None] = None):
+        # Close the response stream of a directive that was cancelled or dropped (nothing goes to the history)
+        marker = ""
+        if timing:
+            timing.finish()
+            marker = timing.as_marker()
+        if self._out_streamer:
+            self._out_streamer.abort_response(stream_id, event, marker)
+
     @abstractmethod
     def load_template(self, template_file) -> bool:
         pass
 
+    @abstractmethod
+    def estimate_prompt_tokens(self, message) -> int:
+        pass
+
+    def set_llm(self, llm):
+        # Switch to another model, whose tokenizer has token counts of its own on the history entries
+        self._llm = llm
+        self._tokenizer_key = tokenizer_key(llm)
+        self._token_overhead = None
+
+    def max_tokens(self, parameters: Union[dict, None] = None) -> Union[int, None]:
+        # Most tokens a directive may generate (None if only the model limits it)
+        return self._generation_kwargs(parameters).get('max_tokens')
+
+    def _read_template(self, template_file) -> bool:
+        try:
+            # The header line (context type and metadata) is not part of the template text
+            _template_type, self._template_meta, self._template_text = read_template(template_file)
+        except FileNotFoundError:
+            logging.warning("Template file '{}' not found.".format(template_file))
+            return False
+        except ValueError as ex:
+            logging.warning(str(ex))
+            return False
+        return True
+
+    def _generation_kwargs(self, parameters: Union[dict, None] = None) -> dict:
+        # Stop sequences and token limit declared by the template, enforced by the LLM on every directive,
+        # with the directive's own parameters on top (its stop sequences are added to the template's)
+        kwargs = {}
+        if self._template_meta.get('stop'):
+            kwargs['stop'] = list(self._template_meta['stop'])
+        if self._template_meta.get('max_tokens'):
+            kwargs['max_tokens'] = self._template_meta['max_tokens']
+
+        for name, value in (parameters or {}).items():
+            if name == 'stop':
+                kwargs['stop'] = kwargs.get('stop', []) + [stop for stop in value if stop not in kwargs.get('stop', [])]
+            else:
+                kwargs[name] = value
+        return kwargs
+
+    def _build_callbacks(self, stream_id, timing: DirectiveTiming,
+                         cancel: Union[threading.Event, None] = None) -> list:
+        callbacks = [TimingCallbackHandler(timing)]
+        if cancel is not None:
+            # Raises DirectiveCancelled out of the LLM call at the next token once the directive is cancelled
+            callbacks.insert(0, CancelCallbackHandler(cancel))
+        if self._out_streamer:
+            self._out_streamer.id = stream_id
+            callbacks += [self._out_streamer, PromptCallbackHandler()]
+        return callbacks
+
+    def _count_tokens(self, text: str) -> int:
+        # Tokens of a piece of text, without the BOS token some tokenizers add to everything
+        # (roughly estimated while the context's model is not loaded)
+        if self._llm is None:
+            return len(text) // 4
+        if self._token_overhead is None:
+            self._token_overhead = self._llm.get_num_tokens("")
+        return max(0, self._llm.get_num_tokens(text) - self._token_overhead) if text else 0
+
+    def _save_exchange(self, message: str, result_text: str, timing: DirectiveTiming) -> str:
+        # Save query/response to history, summerizing the response first
+        summerized = ""
+        if self._history_count > 0:
+            # TODO Maybe do some additional scrubbing of the result text before summerization
+            with timing.phase('summarize'):
+                summerized = self._summerize(result_text)
+            self._history.add_exchange(message, summerized)
+        return summerized
+
+    def _end_directive(self, timing: DirectiveTiming, result_text: str):
+        # Fill in the token counts and close the response stream with the timing breakdown
+        if timing.prompt_text and timing.prompt_tokens == 0:
+            timing.prompt_tokens = self._llm.get_num_tokens(timing.prompt_text)
+        if timing.completion_tokens == 0 and result_text:
+            timing.completion_tokens = self._llm.get_num_tokens(result_text)
+        timing.finish()
+
+        if self._out_streamer:
+            self._out_streamer.end_response(timing.as_marker())
+
     def _summerize(self, text: str) -> str:
         if self._summerizer_type == 'abstractive':
             return self._summerize_abstractive(text)
@@ -143,6 +310,10 @@ class Context(ABC):
         else:
             return self._template_text
 
+    @property
+    def llm(self):
+        return self._llm
+
     @property
     def template_file(self):
         return self._template_file
@@ -152,7 +323,11 @@ class Context(ABC):
         return self._out_streamer
 
     @property
-    def history(self):
+    def history(self) -> list:
+        return self._history.as_dicts()
+
+    @property
+    def history_store(self) -> HistoryStore:
         return self._history
 
 
@@ -164,74 +339,58 @@ class ContextInstruct(Context):
         super().__init__(name, llm, template_file, history_count, system_prompt, summerizer_type, streamer)
 
         self._j_template = None
+        self._builder = None
         self.load_template(template_file)
 
     def erase_memory(self):
-        self._history = []
+        self._history.clear()
 
-    def submit_directive(self, stream_id, message):
-        # Build messages list from message and history
-        messages = []
-
-        # Add system prompt if specified
-        if len(self._system_prompt) > 0:
-            messages.append({"role": "system", "content": self._system_prompt})
+    def submit_directive(self, stream_id, message, timing: Union[DirectiveTiming, None] = None,
+                         parameters: Union[dict, None] = None, cancel: Union[threading.Event, None] = None):
+        if timing is None:
+            timing = DirectiveTiming(stream_id)
+            timing.start()
 
         # TODO
         # Add example user/assistant dialog from somewhere
 
-        # Add history of user/assistant interactions
-        for hist in self._history:
-            messages.append(hist)
-
-        # Add user query/directive
-        query = {'role': 'user', 'content': message}
-        messages.append(query)
-        messages.append({"role": "assistant", "content": ""})
-
-        # Use the above messages to render prompt template using jinja2
-        self._template_rendered_text = self._j_template.render(messages=messages)
-        prompt = PromptTemplate.from_template(self._template_rendered_text)
-        chain = LLMChain(llm=self._llm, prompt=prompt, verbose=False)
-
-        # Invoke the LLM!
-        if self._out_streamer:
-            # Wait while streaming the output
-            self._out_streamer.id = stream_id
-            result = chain.invoke({}, {"callbacks": [self._out_streamer,
-                                                     PromptCallbackHandler()]})
-        else:
-            # Wait quietly for the full result
-            result = chain.invoke({})
-
-        # Save query/response to history
-        summerized = ""
-        if self._history_count > 0:
-            if self._history_count == len(self._history):
-                self._history.pop(0)
-                self._history.pop(0)
-
-            # Save query to history
-            self._history.append(query)
+        # Assemble the prompt (system prompt, history and user query/directive) from the cached
+        # fragments of the history, rendering only the new message with the jinja2 template
+        with timing.phase('render'):
+            entries = self._history.entries
+            self._template_rendered_text = self._builder.build(self._system_prompt, entries, message)
+            timing.prompt_tokens = self._builder.prompt_tokens(self._count_tokens, self._system_prompt,
+                                                               entries, message, self._tokenizer_key)
+
+        # Invoke the LLM with the prompt as is (no second templating pass, so braces in the text are fine)
+        # streaming the output if there is a streamer, stopping where the template says the answer ends
+        result = self._llm.invoke(self._template_rendered_text,
+                                  {"callbacks": self._build_callbacks(stream_id, timing, cancel)},
+                                  **self._generation_kwargs(parameters))
+
+        summerized = self._save_exchange(message, result.strip(), timing)
+        self._end_directive(timing, result)
+        return result.strip(), summerized
 
-            # Summerize the response before saving it to history
-            summerized = self._summerize(result['text'].strip())
-            self._history.append({'role': 'assistant', 'content': summerized})
+    def estimate_prompt_tokens(self, message) -> int:
+        # Token count of the prompt the message would get, from the cached counts of the history entries
+        if self._builder is None:
+            return self._count_tokens(message)
+        return self._builder.prompt_tokens(self._count_tokens, self._system_prompt, self._history.entries, message,
+                                           self._tokenizer_key)
 
-        return result['text'].strip(), summerized
+    def set_llm(self, llm):
+        super().set_llm(llm)
+        if self._builder:
+            self._builder.clear_token_counts()
 
     def load_template(self, template_file) -> bool:
-        try:
-            with open('templates/' + template_file, 'r') as f:
-                lines = f.readlines()
-                # Throw out the first line which has the context type
-                self._template_text = ''.join(lines[1:])
-        except FileNotFoundError:
-            logging.warning("Template file '{}' not found.".format(template_file))
+        if not self._read_template(template_file):
             return False
 
         j_environ = Environment()
         self._j_template = j_environ.from_string(self._template_text)
+        self._builder = PromptBuilder(self._j_template, template_file, self._template_meta.get('assistant_prefix'))
         logging.info("Loaded template '{}' into context {}".format(template_file, self._name))
         self._template_file = template_file
         self._template_rendered_text = ""  # Not rendered yet
@@ -247,68 +406,63 @@ class ContextStandard(Context):
 
         self._prompt = None
         self._input_vars = ["input", "history"]
+        self._template_tokens = None
         self.load_template(template_file)
 
-        # Setup history
-        if self._history_count > 0:
-            self._chat_memory = ConversationBufferWindowMemory(k=self._history_count)
-        else:
-            self._chat_memory = None
-
     def erase_memory(self):
-        self._chat_memory.clear()
-
-    def submit_directive(self, stream_id, prompt):
-        if self._template_text.find('{system}') != -1:
-            self._template_rendered_text = self._template_text.replace('{system}', self._system_prompt)
-        else:
-            self._template_rendered_text = self._template_text
-        self._prompt = PromptTemplate(input_variables=self._input_vars,
-                                      template=self._template_rendered_text)
-
-        ccc = ConversationChain(
-            llm=self._llm,
-            prompt=self._prompt,
-            memory=self._chat_memory,
-            verbose=True)
-
-        # Invoke the LLM!
-        if self._out_streamer:
-            # Wait while streaming the output
-            self._out_streamer.id = stream_id
-            result = ccc.predict([self._out_streamer, PromptCallbackHandler()],
-                                 input=prompt)
-        else:
-            # Wait quietly for the full result
-            result = ccc.predict(input=prompt)
-
-        summerized = ""
-        if self._history_count > 0:
-            if self._history_count == len(self._history):
-                self._history.pop(0)
-                self._history.pop(0)
+        self._history.clear()
+
+    def submit_directive(self, stream_id, prompt, timing: Union[DirectiveTiming, None] = None,
+                         parameters: Union[dict, None] = None, cancel: Union[threading.Event, None] = None):
+        if timing is None:
+            timing = DirectiveTiming(stream_id)
+            timing.start()
+
+        with timing.phase('render'):
+            if self._template_text.find('{system}') != -1:
+                self._template_rendered_text = self._template_text.replace('{system}', self._system_prompt)
+            else:
+                self._template_rendered_text = self._template_text
+
+        with timing.phase('chain'):
+            self._prompt = PromptTemplate(input_variables=self._input_vars,
+                                          template=self._template_rendered_text)
+
+            # The token limit and sampling parameters go to the LLM call, the stop sequences in with the inputs
+            llm_kwargs = self._generation_kwargs(parameters)
+            stop = llm_kwargs.pop('stop', None)
+            chain = LLMChain(llm=self._llm, prompt=self._prompt, llm_kwargs=llm_kwargs, verbose=False)
+
+        # The history comes from the context's history store (same layout as a LangChain memory)
+        with timing.phase('render'):
+            inputs = {"input": prompt, "history": self._history.buffer_string()}
+            if stop:
+                inputs['stop'] = stop
+
+        # Invoke the LLM! (streaming the output if there is a streamer)
+        result = chain.invoke(inputs, {"callbacks": self._build_callbacks(stream_id, timing, cancel)})['text']
+
+        summerized = self._save_exchange(prompt, result.strip(), timing)
+        self._end_directive(timing, result)
+        return result.strip(), summerized
 
-            # Save query to history
-            query = {'role': 'user', 'content': prompt}
-            self._history.append(query)
+    def estimate_prompt_tokens(self, prompt) -> int:
+        # The template text is counted once per system prompt, the history entries keep their own counts
+        if self._template_tokens is None or self._template_tokens[0] != self._system_prompt:
+            text = self._template_text.replace('{system}', self._system_prompt)
+            self._template_tokens = (self._system_prompt, self._count_tokens(text))
+        return self._template_tokens[1] + self._count_tokens(prompt) + \
+            sum(entry.token_count(self._count_tokens, self._tokenizer_key) for entry in self._history.entries)
 
-            # Summerize the response and save it to history
-            # TODO Maybe do some additional scrubbing of the result text before summerization
-            summerized = self._summerize(result.strip())
-            self._history.append({'role': 'assistant', 'content': summerized})
-
-        return result.strip(), summerized
+    def set_llm(self, llm):
+        super().set_llm(llm)
+        self._template_tokens = None
 
     def load_template(self, template_file) -> bool:
-        try:
-            with open('templates/' + template_file, 'r') as f:
-                lines = f.readlines()
-                # Throw out the first line which has the context type
-                self._template_text = ''.join(lines[1:])
-        except FileNotFoundError:
-            logging.warning("Template file '{}' not found.".format(template_file))
+        if not self._read_template(template_file):
             return False
 
+        self._template_tokens = None
         logging.info("Loaded standard template '{}' into context {}".format(template_file, self._name))
         self._template_file = template_file
         return True
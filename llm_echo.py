@@ -0,0 +1,53 @@
+import time
+from typing import Any, Iterator, List, Optional
+
+from llm_base import BaseLanguageModel
+
+from langchain_core.callbacks.manager import CallbackManagerForLLMRun
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+
+class EchoLLM(LLM):
+    """Stand-in LLM that streams back the last words of its prompt, at a fixed pace."""
+
+    max_tokens: int = 64
+    token_delay: float = 0.02
+
+    @property
+    def _llm_type(self) -> str:
+        return "echo"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        return "".join(chunk.text for chunk in self._stream(prompt, stop, run_manager, **kwargs))
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        words = prompt.split()[-kwargs.get('max_tokens', self.max_tokens):]
+        for word in words:
+            time.sleep(self.token_delay)
+            chunk = GenerationChunk(text=" " + word)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(text.split())
+
+
+class EchoModel(BaseLanguageModel):
+    """Backend without a model, for testing servers, clients and routers (the model argument is ignored)."""
+
+    def __init__(self, model, template, verbose, **kwargs):
+        super().__init__(model, template, verbose, **kwargs)
+
+    def create_llm(self, model, verbose, kwargs):
+        model_info = {'model': 'echo',
+                      'model_type': 'echo',
+                      'temperature': kwargs.pop('temperature', 0.0),
+                      'max_tokens': kwargs.pop('max_tokens', 64)
+                      }
+
+        llm = EchoLLM(max_tokens=model_info['max_tokens'])
+        return llm, model_info
@@ -0,0 +1,137 @@
+import sys
+import weakref
+import itertools
+import threading
+from collections import deque
+from typing import Union
+
+
+class HistoryEntry:
+    """A single history message. The role and content never change once stored, so entries can be
+    shared between contexts (forks). Token counts and rendered fragments are cached on the entry per
+    tokenizer and per prompt builder, so forks using another model or template keep their own."""
+
+    __slots__ = ('role', 'content', 'tokens', 'fragments')
+
+    # Tokenizers (and builders) whose data is cached at once, the oldest is dropped first
+    max_cached = 4
+
+    def __init__(self, role: str, content: str):
+        # Roles are interned so thousands of entries share a handful of strings
+        self.role = sys.intern(role)
+        self.content = content
+        self.tokens = None
+        self.fragments = None
+
+    @classmethod
+    def _cache(cls, cache: Union[dict, None], key, value) -> dict:
+        if cache is None:
+            cache = {}
+        elif key not in cache and len(cache) >= cls.max_cached:
+            cache.pop(next(iter(cache)), None)
+        cache[key] = value
+        return cache
+
+    def token_count(self, count_tokens, tokenizer_key: int = 0) -> int:
+        count = self.tokens.get(tokenizer_key) if self.tokens else None
+        if count is None:
+            count = count_tokens(self.content) if self.content else 0
+            self.tokens = self._cache(self.tokens, tokenizer_key, count)
+        return count
+
+    def cached_fragments(self, key) -> Union[tuple, None]:
+        return self.fragments.get(key) if self.fragments else None
+
+    def cache_fragments(self, key, fragments: tuple):
+        self.fragments = self._cache(self.fragments, key, fragments)
+
+    def as_dict(self) -> dict:
+        return {'role': self.role, 'content': self.content}
+
+    def memory_usage(self) -> int:
+        size = sys.getsizeof(self) + sys.getsizeof(self.content)
+        if self.tokens:
+            size += sys.getsizeof(self.tokens)
+        if self.fragments:
+            size += sys.getsizeof(self.fragments) + \
+                sum(sys.getsizeof(text) for fragments in list(self.fragments.values()) for text in fragments)
+        return size
+
+
+def tokenizer_key(llm) -> int:
+    # Key of the tokenizer of a model for the cached token counts (0 for the estimate without a model).
+    # The LLM objects are not hashable, so they are known by id while they are alive.
+    if llm is None:
+        return 0
+    with _tokenizer_lock:
+        known = _tokenizer_keys.get(id(llm))
+        if known is None or known[0]() is not llm:
+            llm_id = id(llm)
+            known = (weakref.ref(llm, lambda _ref: _tokenizer_keys.pop(llm_id, None)), next(_next_tokenizer_key))
+            _tokenizer_keys[llm_id] = known
+        return known[1]
+
+
+_tokenizer_keys = {}
+_tokenizer_lock = threading.Lock()
+_next_tokenizer_key = itertools.count(1)
+
+
+class HistoryStore:
+    """Window of the latest user/assistant exchanges of a context.
+
+    The deque drops the oldest messages in O(1) as new exchanges are added.
+    """
+
+    __slots__ = ('_history_count', '_messages')
+
+    human_prefix = 'Human'
+    ai_prefix = 'AI'
+
+    def __init__(self, history_count: int):
+        self._history_count = history_count
+        self._messages = deque(maxlen=history_count * 2)
+
+    def add_exchange(self, user: str, assistant: str):
+        if self._history_count > 0:
+            self._messages.append(HistoryEntry('user', user))
+            self._messages.append(HistoryEntry('assistant', assistant))
+
+    def extend(self, messages: list):
+        # Accepts stored entries (shared as is) or role/content dicts (saved history)
+        for msg in messages:
+            if isinstance(msg, HistoryEntry):
+                self._messages.append(msg)
+            else:
+                self._messages.append(HistoryEntry(msg['role'], msg['content']))
+
+    def clear(self):
+        self._messages.clear()
+
+    def as_dicts(self) -> list:
+        return [entry.as_dict() for entry in self._messages]
+
+    def buffer_string(self) -> str:
+        # Same layout as the LangChain conversation memories
+        lines = []
+        for entry in self._messages:
+            prefix = self.human_prefix if entry.role == 'user' else self.ai_prefix
+            lines.append("{}: {}".format(prefix, entry.content))
+        return "\n".join(lines)
+
+    def memory_usage(self) -> int:
+        return sys.getsizeof(self._messages) + sum(entry.memory_usage() for entry in self._messages)
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self):
+        return iter(self._messages)
+
+    @property
+    def entries(self) -> tuple:
+        return tuple(self._messages)
+
+    @property
+    def history_count(self) -> int:
+        return self._history_count
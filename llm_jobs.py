@@ -0,0 +1,430 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict, deque
+from typing import Union
+
+from llm_scheduler import QueueFull
+from llm_worker import ModelWorkerError
+
+
+class BatchJob:
+    """Directives of a JSONL file run in the background at batch priority, the results appended to an output JSONL.
+
+    Every input line holds a "msg" and optionally an "id", the context settings ("context", "template",
+    "history", "system_prompt", "summerizer_type", "model") and the generation parameters ("max_tokens",
+    "temperature", "top_p", "stop"). A line without a context gets a context of its own, the lines naming
+    the same context run one after the other in file order. The output file is the checkpoint: the lines
+    it already holds are skipped when the job is started again.
+    """
+
+    # Seconds between polls for the results of the directives in flight
+    poll_interval = 0.2
+
+    # Seconds a directive may be gone from the model without a result before it counts as lost
+    lost_after = 10.0
+
+    # Seconds to wait before submitting again when the model is not reachable (a model worker restarting)
+    retry_interval = 5.0
+
+    def __init__(self, llm, job_id: str, input_file: str, output_file: str, concurrency: int = 4,
+                 tenant: str = '', keep_contexts: bool = False, on_change=None):
+        self.job_id = job_id
+        self.input_file = input_file
+        self.output_file = output_file
+        self.concurrency = max(1, concurrency)
+        self.tenant = tenant
+        self.keep_contexts = keep_contexts
+        self._llm = llm
+        self._on_change = on_change
+        self._state = 'queued'
+        self._error = ''
+        self._thread = None
+        self._output = None
+
+        self._total = 0
+        self._skipped = 0
+        self._done = 0
+        self._failed = 0
+        self._in_flight = {}
+        self._completion_tokens = 0
+        self._started = 0.0
+        self._finished = 0.0
+
+        # Contexts checked (or created by the job) and the lines left per context
+        self._ready = set()
+        self._created = set()
+        self._remaining = {}
+        self._resume_at = 0.0
+
+    @property
+    def spec(self) -> dict:
+        return {"job_id": self.job_id,
+                "input": self.input_file,
+                "output": self.output_file,
+                "concurrency": self.concurrency,
+                "tenant": self.tenant,
+                "keep_contexts": self.keep_contexts}
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def _set_state(self, state: str, error: str = ''):
+        self._state = state
+        self._error = error
+        if self._on_change:
+            self._on_change(self)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def cancel(self) -> bool:
+        if self._state not in ('queued', 'running'):
+            return False
+        self._set_state('cancelling')
+        return True
+
+    def _completed_lines(self) -> set:
+        # Indexes of the lines already in the output (a line cut short by a crash is dropped). Any other
+        # file is left alone.
+        completed = set()
+        if not os.path.exists(self.output_file):
+            return completed
+
+        with open(self.output_file, 'rb') as f:
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+                completed.add(record['index'])
+            except (ValueError, KeyError, TypeError):
+                raise ValueError("'{}' is not the output of a job".format(self.output_file))
+        if end < len(data) and not data[end:].startswith(b'{"index": '):
+            raise ValueError("'{}' is not the output of a job".format(self.output_file))
+
+        if end < len(data):
+            with open(self.output_file, 'r+b') as f:
+                f.truncate(end)
+        return completed
+
+    def _load(self) -> OrderedDict:
+        completed = self._completed_lines()
+        queues = OrderedDict()
+        with open(self.input_file, 'r') as f:
+            for index, line in enumerate(f):
+                line = line.strip()
+                if not line:
+                    continue
+                self._total += 1
+                if index in completed:
+                    self._skipped += 1
+                    continue
+
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict) or not isinstance(request.get('msg'), str):
+                        raise ValueError("no message")
+                except ValueError as ex:
+                    self._write(index, {}, "", {"event": "INVALID", "error": str(ex)})
+                    continue
+
+                name = request.get('context') or "{}-{}".format(self.job_id, index)
+                queues.setdefault(name, deque()).append((index, request))
+                self._remaining[name] = self._remaining.get(name, 0) + 1
+        return queues
+
+    def _run(self):
+        self._started = time.time()
+        self._set_state('running')
+        try:
+            queues = self._load()
+            if not self.keep_contexts:
+                self._remove_leftovers(queues)
+            self._output = open(self.output_file, 'a', buffering=1)
+            logging.info("Job '{}' started with {} of {} lines to do.".format(self.job_id,
+                                                                           self._total - self._skipped,
+                                                                           self._total))
+            while self._state == 'running' and (queues or self._in_flight):
+                self._fill(queues)
+                time.sleep(self.poll_interval)
+                self._collect()
+
+            if self._state == 'cancelling':
+                for response_id in list(self._in_flight):
+                    try:
+                        self._llm.cancel_directive(response_id)
+                    except ModelWorkerError:
+                        pass
+                self._in_flight.clear()
+                for name in list(self._created):
+                    self._delete_context(name)
+                self._set_state('cancelled')
+            else:
+                self._set_state('completed')
+        except Exception as ex:
+            logging.error("Job '{}' failed: {}".format(self.job_id, ex))
+            self._set_state('failed', str(ex))
+        finally:
+            self._finished = time.time()
+            if self._output:
+                self._output.close()
+            logging.info("Job '{}' {}: {}".format(self.job_id, self._state, self.info))
+
+    def _fill(self, queues: OrderedDict):
+        # One directive in flight per context, up to the job's concurrency
+        if time.monotonic() < self._resume_at:
+            return
+
+        busy = {name for _index, _request, name, _submitted in self._in_flight.values()}
+        for name in list(queues):
+            if len(self._in_flight) >= self.concurrency:
+                break
+            if name in busy:
+                continue
+
+            index, request = queues[name].popleft()
+            try:
+                response_id = self._submit(name, request)
+            except QueueFull as ex:
+                # Come back when the queue has room again
+                queues[name].appendleft((index, request))
+                self._resume_at = time.monotonic() + min(float(ex.retry_after), 10.0)
+                break
+            except ModelWorkerError as ex:
+                # Come back when the model worker is running again
+                logging.warning("Job '{}' waits for the model: {}".format(self.job_id, ex))
+                queues[name].appendleft((index, request))
+                self._resume_at = time.monotonic() + self.retry_interval
+                break
+            except ValueError as ex:
+                response_id = None
+                self._write(index, request, name, {"event": "INVALID", "error": str(ex)})
+            except RuntimeError as ex:
+                response_id = None
+                self._write(index, request, name, {"event": "FAILED", "error": str(ex)})
+
+            if not queues[name]:
+                del queues[name]
+            if response_id:
+                self._in_flight[response_id] = (index, request, name, time.monotonic())
+            else:
+                self._context_done(name)
+
+    def _submit(self, name: str, request: dict) -> Union[str, None]:
+        if name not in self._ready:
+            # A context of the job's own left over from an interrupted run starts over, any other context
+            # that already exists is used as it is (and left in place)
+            owned = self._owned(name)
+            if owned and self._llm.get_context_info(name) is not None:
+                self._llm.delete_context(name)
+            success, msg = self._llm.create_context(name,
+                                                    template_file=request.get('template') or None,
+                                                    history_count=int(request.get('history', 0)),
+                                                    system_prompt=request.get('system_prompt') or None,
+                                                    summerizer_type=request.get('summerizer_type', 'none'),
+                                                    streamer_type=None,
+                                                    priority='batch',
+                                                    model=request.get('model') or None)
+            if success:
+                self._created.add(name)
+            elif owned or self._llm.get_context_info(name) is None:
+                raise RuntimeError(msg)
+            self._ready.add(name)
+
+        response_id = self._llm.submit_directive(name, request['msg'], request.get('max_tokens'),
+                                                 request.get('temperature'), request.get('top_p'),
+                                                 request.get('stop'), 'batch', None, self.tenant or None)
+        if not response_id:
+            raise RuntimeError("Context '{}' does not exist".format(name))
+        return response_id
+
+    def _collect(self):
+        for response_id, (index, request, name, submitted) in list(self._in_flight.items()):
+            try:
+                result = self._llm.get_directive_result(response_id)
+                if result is None and time.monotonic() - submitted > self.lost_after and \
+                        not self._llm.context_busy(name):
+                    result = {"event": "FAILED", "error": "No result for response '{}'".format(response_id)}
+            except Exception as ex:
+                result = {"event": "FAILED", "error": str(ex)}
+            if result is None or result.get('state') in ('queued', 'running'):
+                continue
+
+            del self._in_flight[response_id]
+            result['response_id'] = response_id
+            self._write(index, request, name, result)
+            self._context_done(name)
+
+    def _write(self, index: int, request: dict, name: str, result: dict):
+        timing = result.get('timing', {})
+        record = {"index": index,
+                  "id": request.get('id'),
+                  "context": name,
+                  "response_id": result.get('response_id', ''),
+                  "event": result['event'],
+                  "text": result.get('text', ''),
+                  "summary": result.get('summary', ''),
+                  "error": result.get('error', ''),
+                  "timing": timing}
+        if self._output:
+            self._output.write(json.dumps(record) + "\n")
+        else:
+            with open(self.output_file, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+
+        self._done += 1
+        if result['event'] != 'END':
+            self._failed += 1
+        self._completion_tokens += timing.get('completion_tokens', 0)
+
+    def _context_done(self, name: str):
+        self._remaining[name] -= 1
+        if self._remaining[name] == 0:
+            del self._remaining[name]
+            if name in self._created:
+                self._delete_context(name)
+
+    def _owned(self, name: str) -> bool:
+        # The per line contexts the job names itself
+        prefix = self.job_id + '-'
+        return name.startswith(prefix) and name[len(prefix):].isdigit()
+
+    def _remove_leftovers(self, queues: OrderedDict):
+        # Contexts of lines that were done when an earlier run of the job was interrupted
+        try:
+            for name in self._llm.get_context_names():
+                if self._owned(name) and name not in queues:
+                    self._llm.delete_context(name)
+                    logging.info("Job '{}' removed left over context '{}'".format(self.job_id, name))
+        except ModelWorkerError as ex:
+            logging.warning("Job '{}' could not remove left over contexts: {}".format(self.job_id, ex))
+
+    def _delete_context(self, name: str):
+        self._created.discard(name)
+        self._ready.discard(name)
+        if not self.keep_contexts:
+            try:
+                self._llm.delete_context(name)
+            except ModelWorkerError as ex:
+                logging.warning("Job '{}' could not delete context '{}': {}".format(self.job_id, name, ex))
+
+    @property
+    def info(self) -> dict:
+        elapsed = (self._finished or time.time()) - self._started if self._started else 0.0
+        rate = self._done / elapsed if elapsed > 0 else 0.0
+        left = self._total - self._skipped - self._done
+        return {"job_id": self.job_id,
+                "state": self._state,
+                "error": self._error,
+                "input": self.input_file,
+                "output": self.output_file,
+                "total": self._total,
+                "skipped": self._skipped,
+                "done": self._done,
+                "failed": self._failed,
+                "in_flight": len(self._in_flight),
+                "elapsed_seconds": round(elapsed, 1),
+                "directives_per_second": round(rate, 3),
+                "completion_tokens_per_second": round(self._completion_tokens / elapsed, 1) if elapsed > 0 else 0.0,
+                "eta_seconds": round(left / rate, 1) if rate > 0 and self._state == 'running' else None}
+
+
+class JobManager:
+    """Batch jobs of a server, with their specs kept in a directory (if any) so unfinished jobs resume at startup.
+
+    The input and output files of the jobs have to be in the data directory (relative paths are relative to it).
+    """
+
+    def __init__(self, llm, jobs_dir: Union[str, None] = None, data_dir: str = 'job_data'):
+        self._llm = llm
+        self._jobs_dir = jobs_dir
+        self._data_dir = os.path.realpath(data_dir)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        if jobs_dir:
+            os.makedirs(jobs_dir, exist_ok=True)
+        os.makedirs(self._data_dir, exist_ok=True)
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self._jobs_dir, job_id + '.json')
+
+    def _save(self, job: BatchJob):
+        if self._jobs_dir:
+            with open(self._path(job.job_id) + '.tmp', 'w') as f:
+                json.dump(dict(job.spec, state=job.state), f)
+            os.replace(self._path(job.job_id) + '.tmp', self._path(job.job_id))
+
+    def _data_path(self, path: str) -> Union[str, None]:
+        full_path = os.path.realpath(os.path.join(self._data_dir, path))
+        if full_path == self._data_dir or os.path.commonpath([full_path, self._data_dir]) != self._data_dir:
+            return None
+        return full_path
+
+    def submit(self, input_file: str, output_file: str, concurrency: int = 4, tenant: str = '',
+               keep_contexts: bool = False, job_id: Union[str, None] = None) -> (Union[BatchJob, None], str):
+        input_path, output_path = self._data_path(input_file), self._data_path(output_file)
+        if input_path is None or output_path is None:
+            return None, "Job files have to be in '{}'.".format(self._data_dir)
+        input_file, output_file = input_path, output_path
+
+        if not os.path.isfile(input_file):
+            return None, "Input file '{}' not found.".format(input_file)
+
+        with self._lock:
+            running = [job for job in self._jobs.values()
+                       if job.output_file == output_file and job.state in ('queued', 'running', 'cancelling')]
+            if running:
+                return None, "Job '{}' is already writing to '{}'.".format(running[0].job_id, output_file)
+
+            job = BatchJob(self._llm, job_id or uuid.uuid4().hex[:8], input_file, output_file, concurrency,
+                           tenant, keep_contexts, on_change=self._save)
+            self._jobs[job.job_id] = job
+        job.start()
+        return job, "Started job '{}'.".format(job.job_id)
+
+    def resume(self, job_id: str) -> (Union[BatchJob, None], str):
+        # Start a stopped job again, from where its output file ends
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None, "Unknown job '{}'.".format(job_id)
+        if job.state in ('queued', 'running', 'cancelling'):
+            return None, "Job '{}' is {}.".format(job_id, job.state)
+        spec = job.spec
+        return self.submit(spec['input'], spec['output'], spec['concurrency'], spec['tenant'],
+                           spec['keep_contexts'], job_id)
+
+    def resume_unfinished(self):
+        # Jobs that were running when the server stopped
+        if not self._jobs_dir:
+            return
+        for file_name in sorted(os.listdir(self._jobs_dir)):
+            if not file_name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self._jobs_dir, file_name), 'r') as f:
+                    spec = json.load(f)
+            except (OSError, ValueError) as ex:
+                logging.warning("Unable to read job '{}': {}".format(file_name, ex))
+                continue
+
+            if spec.get('state') in ('queued', 'running'):
+                job, msg = self.submit(spec['input'], spec['output'], spec['concurrency'], spec['tenant'],
+                                       spec['keep_contexts'], spec['job_id'])
+                logging.info("Resumed job '{}': {}".format(spec['job_id'], msg))
+
+    def cancel(self, job_id: str) -> bool:
+        job = self._jobs.get(job_id)
+        return job is not None and job.cancel()
+
+    def get_job(self, job_id: str) -> Union[BatchJob, None]:
+        return self._jobs.get(job_id)
+
+    @property
+    def info(self) -> list:
+        return [job.info for job in list(self._jobs.values())]
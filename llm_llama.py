@@ -1,10 +1,152 @@
+import os
+import mmap
+import time
+import pickle
+import struct
+import logging
+import threading
+from urllib.parse import quote
+
 from llm_base import BaseLanguageModel
 
 from langchain_community.llms import LlamaCpp
 
 
+class LlamaSessionStore:
+    """Hibernated llama.cpp states (evaluated tokens + KV cache) of contexts, one file per context.
+
+    A file holds a length prefixed pickle of the LlamaState without its raw
+    state, followed by the raw state, which is memory-mapped back in. The
+    oldest sessions are removed when the disk quota is exceeded.
+    """
+
+    suffix = '.llama'
+
+    def __init__(self, directory: str, quota: int):
+        self._directory = directory
+        self._quota = quota
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        logging.info("Llama sessions hibernated in '{}'".format(directory))
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._directory, quote(name, safe='') + self.suffix)
+
+    def save(self, name: str, client) -> bool:
+        start = time.monotonic()
+        state = client.save_state()
+        raw_state = state.llama_state
+        state.llama_state = b''
+        header = pickle.dumps(state)
+
+        path = self._path(name)
+        with self._lock:
+            with open(path + '.tmp', 'wb') as f:
+                f.write(struct.pack('<Q', len(header)))
+                f.write(header)
+                f.write(raw_state)
+            os.replace(path + '.tmp', path)
+        logging.info("Hibernated llama session of context '{}' ({} tokens, {} bytes) in {:.2f}s".format(
+            name, state.n_tokens, len(raw_state), time.monotonic() - start))
+
+        self._enforce_quota(keep=path)
+        return True
+
+    def restore(self, name: str, client) -> bool:
+        path = self._path(name)
+        start = time.monotonic()
+        try:
+            with self._lock, open(path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    header_len = struct.unpack('<Q', mm[:8])[0]
+                    state = pickle.loads(mm[8:8 + header_len])
+                    with memoryview(mm) as view:
+                        # load_state copies straight out of the mapping into llama.cpp
+                        state.llama_state = view[8 + header_len:]
+                        try:
+                            client.load_state(state)
+                        finally:
+                            state.llama_state = b''
+                os.utime(path)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, RuntimeError, pickle.UnpicklingError) as ex:
+            logging.error("Unable to restore llama session of context '{}': {}".format(name, ex))
+            self.delete(name)
+            return False
+
+        logging.info("Restored llama session of context '{}' ({} tokens) in {:.2f}s".format(
+            name, state.n_tokens, time.monotonic() - start))
+        return True
+
+    def delete(self, name: str):
+        with self._lock:
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for file in os.listdir(self._directory):
+                if file.endswith(self.suffix):
+                    os.remove(os.path.join(self._directory, file))
+
+    def _enforce_quota(self, keep: str):
+        # Remove the least recently used sessions until the total size fits in the quota
+        if self._quota <= 0:
+            return
+
+        with self._lock:
+            files = []
+            for file in os.listdir(self._directory):
+                if file.endswith(self.suffix):
+                    path = os.path.join(self._directory, file)
+                    st = os.stat(path)
+                    files.append((st.st_mtime, st.st_size, path))
+
+            total = sum(size for _mtime, size, _path in files)
+            for _mtime, size, path in sorted(files):
+                if total <= self._quota:
+                    break
+                if path != keep:
+                    os.remove(path)
+                    total -= size
+                    logging.info("Removed hibernated llama session '{}' (disk quota)".format(path))
+
+
 class LlamaModel(BaseLanguageModel):
+    # Seconds a context's evaluated state stays in memory only before it is hibernated
+    session_idle_save = 30.0
+
     def __init__(self, model, template, verbose, **kwargs):
+        session_dir = kwargs.pop('session_dir', None)
+        session_quota = kwargs.pop('session_quota', 0)
+
+        # With more than one sequence, the directives of that many contexts are decoded together
+        # (one worker per sequence)
+        self._parallel = max(1, kwargs.pop('parallel', 1))
+        if self._parallel > 1:
+            kwargs['workers'] = self._parallel
+            if session_dir:
+                # The contexts' KV caches stay in the batch engine's sequences instead
+                logging.warning("Llama sessions are not hibernated with {} parallel sequences".format(self._parallel))
+                session_dir = None
+        self._sessions = LlamaSessionStore(session_dir, session_quota) if session_dir else None
+
+        # Speculative decoding with a small draft model (a GGUF file) or prompt lookup ('lookup')
+        self._draft = kwargs.pop('draft', '')
+        self._draft_tokens = kwargs.pop('draft_tokens', 0)
+        if self._draft and self._parallel > 1:
+            logging.warning("Speculative decoding is not used with {} parallel sequences".format(self._parallel))
+            self._draft = ''
+
+        # Context whose evaluated state is currently in the model and whether it has been saved
+        self._session_loaded = None
+        self._session_dirty = False
+        self._session_used = 0.0
+        self._session_parents = {}
+
         super().__init__(model, template, verbose, **kwargs)
 
     def create_llm(self, model, verbose, kwargs):
@@ -13,9 +155,24 @@ class LlamaModel(BaseLanguageModel):
                       'temperature': kwargs.pop('temperature', 0.0),
                       'max_tokens': kwargs.pop('max_tokens', 1024),
                       'n_ctx': kwargs.pop('n_ctx', 2048),
-                      'gpu_layers': kwargs.pop('gpu', 0)
+                      'gpu_layers': kwargs.pop('gpu', 0),
+                      'parallel': self._parallel
                       }
 
+        if self._parallel > 1:
+            # llama-cpp-python (like numpy) is only needed once a llama model is loaded
+            from llm_batch import LlamaBatchEngine, BatchedLlamaCpp
+
+            engine = LlamaBatchEngine(model, model_info['n_ctx'], self._parallel,
+                                      n_batch=512, n_gpu_layers=model_info['gpu_layers'], verbose=verbose)
+            llm = BatchedLlamaCpp(engine=engine,
+                                  temperature=model_info['temperature'],
+                                  max_tokens=model_info['max_tokens'],
+                                  top_p=1)
+            return llm, model_info
+
+        draft_model = self._create_draft(model, model_info, verbose)
+
         # Fire up the Llama 2 based LLM
         # LangChain
         llm = LlamaCpp(
@@ -27,7 +184,101 @@ class LlamaModel(BaseLanguageModel):
             top_p=1,
             n_batch=512,
             verbose=verbose,
-            repetition_penalty=1.18
+            repetition_penalty=1.18,
+            model_kwargs={'draft_model': draft_model} if draft_model else {}
         )
 
         return llm, model_info
+
+    def _create_draft(self, model: str, model_info: dict, verbose: bool):
+        # Checked before the model is built, llama.cpp keeps the logits of every position when given a draft
+        if not self._draft:
+            return None
+
+        from llm_speculative import PromptLookupDraft, ModelDraft, vocab_size
+
+        if self._draft == 'lookup':
+            draft_model = PromptLookupDraft(num_pred_tokens=self._draft_tokens or 10)
+        else:
+            if vocab_size(self._draft) != vocab_size(model):
+                logging.warning("Draft model '{}' does not share the vocabulary of '{}', not used".format(
+                    self._draft, model_info['model']))
+                return None
+            draft_model = ModelDraft(self._draft, num_pred_tokens=self._draft_tokens or 4,
+                                     n_ctx=model_info['n_ctx'], n_gpu_layers=model_info['gpu_layers'],
+                                     verbose=verbose)
+        model_info['draft'] = self._draft.split('/').pop()
+        model_info['draft_tokens'] = draft_model.num_pred_tokens
+        return draft_model
+
+    @property
+    def queue_info(self):
+        info = super().queue_info
+        if self._parallel > 1:
+            info['batch'] = self._llm.engine.info
+        elif self._llm.client.draft_model:
+            info['speculative'] = self._llm.client.draft_model.info
+        return info
+
+    def _hibernate_session(self):
+        if self._session_loaded and self._session_dirty:
+            self._sessions.save(self._session_loaded, self._llm.client)
+            self._session_dirty = False
+
+    def _before_directive(self, context_name: str):
+        # Only the default model's state is hibernated
+        if self._sessions is None or self._session_loaded == context_name or self._context_model(context_name):
+            return
+
+        # The model is needed by another context, so put the current one to sleep first
+        parent_name = self._session_parents.pop(context_name, None)
+        parent_loaded = parent_name is not None and parent_name == self._session_loaded
+        self._hibernate_session()
+        self._session_loaded = None
+
+        # llama.cpp only re-evaluates the part of the prompt after the restored tokens.
+        # A fork that has no session of its own starts from its parent's (shared, read only) session,
+        # or from the parent's state still in the model.
+        if not parent_loaded and not self._sessions.restore(context_name, self._llm.client) and parent_name:
+            self._sessions.restore(parent_name, self._llm.client)
+
+    def _after_directive(self, context_name: str):
+        if self._sessions and not self._context_model(context_name):
+            self._session_loaded = context_name
+            self._session_dirty = True
+            self._session_used = time.monotonic()
+
+    def _worker_idle(self):
+        if self._sessions and self._session_dirty and \
+                time.monotonic() - self._session_used > self.session_idle_save:
+            self._hibernate_session()
+
+    def _context_unloaded(self, context_name: str):
+        if self._sessions and self._session_loaded == context_name:
+            self._hibernate_session()
+
+    def _context_reset(self, context_name: str):
+        if self._sessions:
+            self._sessions.delete(context_name)
+            self._session_parents.pop(context_name, None)
+            if self._session_loaded == context_name:
+                self._session_dirty = False
+
+    def _context_forked(self, parent_name: str, context_name: str):
+        if self._sessions:
+            self._session_parents[context_name] = self._session_parents.get(parent_name, parent_name)
+
+    def _model_available(self, model: str) -> bool:
+        return os.path.isfile(model)
+
+    def _model_switched(self):
+        # The hibernated states belong to the old model
+        if self._sessions:
+            self._sessions.clear()
+            self._session_parents = {}
+            self._session_loaded = None
+            self._session_dirty = False
+
+    def _model_swapped(self, old_llm):
+        if self._parallel > 1:
+            old_llm.engine.close()
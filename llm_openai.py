@@ -1,22 +1,217 @@
 import os
+import json
+import time
+import logging
+import threading
+from typing import Any, Dict, Iterator, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
 from llm_base import BaseLanguageModel
 
-from langchain.llms.openai import OpenAI
+from langchain_core.callbacks.manager import CallbackManagerForLLMRun
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+
+class RemoteError(Exception):
+    pass
+
+
+class OpenAICompletions:
+    """Pooled HTTP client of an OpenAI compatible completions endpoint, shared by the directive workers.
+
+    At most `concurrency` requests are in flight at once. A request that fails before its first token
+    (connection error, 429 or 5xx) is retried with exponential backoff, honoring Retry-After.
+    """
+
+    retry_statuses = (429, 500, 502, 503, 504)
+    max_backoff = 8.0
+
+    def __init__(self, base_url: str, api_key: str, concurrency: int = 8, max_retries: int = 3,
+                 timeout: float = 60.0):
+        self.base_url = base_url.rstrip('/')
+        self._concurrency = concurrency
+        self._max_retries = max_retries
+        self._timeout = timeout
+        self._slots = threading.BoundedSemaphore(concurrency)
+
+        # Keep-alive connections for every request in flight
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        if api_key:
+            self._session.headers['Authorization'] = 'Bearer ' + api_key
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._requests = 0
+        self._retries = 0
+        self._failures = 0
+
+    def _post(self, payload: dict) -> requests.Response:
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                resp = self._session.post(self.base_url + '/completions', json=payload, stream=True,
+                                          timeout=self._timeout)
+                if resp.status_code == 200:
+                    return resp
+
+                error = "HTTP {}: {}".format(resp.status_code, resp.text[:200])
+                retry_after = resp.headers.get('Retry-After')
+                resp.close()
+                if resp.status_code not in self.retry_statuses:
+                    raise RemoteError(error)
+            except requests.exceptions.RequestException as ex:
+                error = str(ex)
+
+            if attempt >= self._max_retries:
+                raise RemoteError("{} (after {} retries)".format(error, attempt))
+
+            delay = min(self.max_backoff, 0.5 * 2 ** attempt)
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            attempt += 1
+            with self._lock:
+                self._retries += 1
+            logging.warning("Retrying remote completion in {:.1f}s: {}".format(delay, error))
+            time.sleep(delay)
+
+    def stream(self, payload: dict) -> Iterator[str]:
+        # Text pieces of a streamed completion (closing the generator closes the response)
+        with self._slots:
+            with self._lock:
+                self._in_flight += 1
+                self._requests += 1
+            try:
+                resp = self._post(dict(payload, stream=True))
+                try:
+                    for line in resp.iter_lines():
+                        if not line.startswith(b'data:'):
+                            continue
+                        data = line[5:].strip()
+                        if data == b'[DONE]':
+                            break
+                        choices = json.loads(data).get('choices')
+                        if choices and choices[0].get('text'):
+                            yield choices[0]['text']
+                finally:
+                    resp.close()
+            except RemoteError:
+                with self._lock:
+                    self._failures += 1
+                raise
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+
+    def close(self):
+        self._session.close()
+
+    @property
+    def info(self) -> dict:
+        with self._lock:
+            return {"base_url": self.base_url,
+                    "concurrency": self._concurrency,
+                    "in_flight": self._in_flight,
+                    "requests": self._requests,
+                    "retries": self._retries,
+                    "failures": self._failures}
+
+
+class RemoteOpenAI(LLM):
+    """LangChain LLM streaming completions from an OpenAI compatible server through a shared client."""
+
+    client: Any
+    model_name: str
+    max_tokens: int = 256
+    temperature: float = 0.0
+    top_p: float = 1.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "openai_remote"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model_name": self.model_name, "base_url": self.client.base_url,
+                "max_tokens": self.max_tokens, "temperature": self.temperature, "top_p": self.top_p}
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        return "".join(chunk.text for chunk in self._stream(prompt, stop, run_manager, **kwargs))
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        payload = {"model": self.model_name,
+                   "prompt": prompt,
+                   "max_tokens": kwargs.get('max_tokens', self.max_tokens),
+                   "temperature": kwargs.get('temperature', self.temperature),
+                   "top_p": kwargs.get('top_p', self.top_p)}
+        if stop:
+            payload['stop'] = stop
+
+        pieces = self.client.stream(payload)
+        try:
+            for piece in pieces:
+                chunk = GenerationChunk(text=piece)
+                if run_manager:
+                    # A callback raising here (cancellation) closes the stream and its connection
+                    run_manager.on_llm_new_token(piece, chunk=chunk)
+                yield chunk
+        finally:
+            pieces.close()
+
+    def get_num_tokens(self, text: str) -> int:
+        # The remote tokenizer is not at hand, so about four characters per token
+        return (len(text) + 3) // 4
 
 
 class OpenAIModel(BaseLanguageModel):
     def __init__(self, model, template, verbose, **kwargs):
+        # The model argument is the API key, the remote model is named separately
+        self._api_base = kwargs.pop('api_base', '') or os.environ.get('OPENAI_API_BASE', 'https://api.openai.com/v1')
+        self._remote_model = kwargs.pop('remote_model', '') or 'gpt-3.5-turbo-instruct'
+        self._concurrency = max(1, kwargs.pop('concurrency', 8))
+        self._max_retries = kwargs.pop('max_retries', 3)
+
+        # Remote calls only wait on I/O, so there is a directive worker for every request in flight
+        kwargs['workers'] = self._concurrency
         super().__init__(model, template, verbose, **kwargs)
 
     def create_llm(self, model, verbose, kwargs):
-        model_info = {'model': 'chatGPT',
+        client = OpenAICompletions(self._api_base, model, self._concurrency, self._max_retries)
+        return self._remote_llm(client, self._remote_model, kwargs)
+
+    def _remote_llm(self, client: OpenAICompletions, remote_model: str, kwargs):
+        model_info = {'model': remote_model,
                       'model_type': 'openai',
-                      'temperature': kwargs.pop('temperature', 0.0)
+                      'temperature': kwargs.pop('temperature', 0.0),
+                      'max_tokens': kwargs.pop('max_tokens', 256),
+                      'api_base': client.base_url,
+                      'concurrency': self._concurrency
                       }
 
-        os.environ["OPENAI_API_KEY"] = model
-        llm = OpenAI(temperature=self._model_info['temperature'],
-                     verbose=verbose,
-                     streaming=True)
-
+        llm = RemoteOpenAI(client=client,
+                           model_name=remote_model,
+                           temperature=model_info['temperature'],
+                           max_tokens=model_info['max_tokens'])
         return llm, model_info
+
+    def _load_model(self, model: str):
+        # Other remote models of the same server share its connections and concurrency limit
+        return self._remote_llm(self._llm.client, model, dict(self._llm_params))
+
+    @property
+    def queue_info(self):
+        info = super().queue_info
+        info['remote'] = self._llm.client.info
+        return info
+
+    def _model_swapped(self, old_llm):
+        if old_llm.client is not self._llm.client:
+            old_llm.client.close()
@@ -0,0 +1,98 @@
+import sys
+import time
+import marshal
+import threading
+import tracemalloc
+from collections import Counter
+
+
+class SamplingProfiler:
+    """Statistical profiler that samples the stacks of all the threads in the running process."""
+
+    def __init__(self, interval: float = 0.005):
+        self._interval = interval
+        self._stacks = Counter()
+        self._samples = 0
+        self._duration = 0.0
+
+    def run(self, seconds: float):
+        # Sample from the calling thread, which is left out of the profile
+        own_ident = threading.get_ident()
+        start = time.monotonic()
+        end = start + seconds
+        while time.monotonic() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                stack.reverse()
+                self._stacks[(names.get(ident, str(ident)), tuple(stack))] += 1
+
+            self._samples += 1
+            time.sleep(self._interval)
+        self._duration = time.monotonic() - start
+
+    def as_collapsed(self) -> str:
+        # Brendan Gregg's collapsed stack format (flamegraph.pl, speedscope, ...)
+        lines = []
+        for (thread_name, stack), count in self._stacks.most_common():
+            frames = [thread_name.replace(' ', '_')]
+            frames += ["{}:{}:{}".format(func, filename.split('/').pop(), line) for filename, line, func in stack]
+            lines.append("{} {}".format(';'.join(frames), count))
+        return "\n".join(lines) + "\n"
+
+    def as_pstats(self) -> bytes:
+        # Build the marshalled dict pstats.Stats() loads, using sample counts as call counts
+        # and sampled time as the total (own) and cumulative times.
+        period = self._duration / self._samples if self._samples else self._interval
+        stats = {}
+        for (_thread_name, stack), count in self._stacks.items():
+            seconds = count * period
+            seen = set()
+            for index, func in enumerate(stack):
+                cc, nc, tt, ct, callers = stats.get(func, (0, 0, 0.0, 0.0, {}))
+                if index == len(stack) - 1:
+                    tt += seconds
+                if func not in seen:
+                    # Recursive functions only count once per stack in the cumulative time
+                    seen.add(func)
+                    cc += count
+                    ct += seconds
+                nc += count
+                if index > 0:
+                    caller = stack[index - 1]
+                    c_cc, c_nc, c_tt, c_ct = callers.get(caller, (0, 0, 0.0, 0.0))
+                    callers[caller] = (c_cc + count, c_nc + count, c_tt, c_ct + seconds)
+                stats[func] = (cc, nc, tt, ct, callers)
+        return marshal.dumps(stats)
+
+    @property
+    def info(self) -> dict:
+        return {"samples": self._samples,
+                "stacks": len(self._stacks),
+                "interval": self._interval,
+                "duration": round(self._duration, 3)}
+
+
+def memory_diff(seconds: float, limit: int = 25, frames: int = 1, key_type: str = 'lineno') -> list:
+    # Compare tracemalloc snapshots taken at the start and the end of the interval
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(frames)
+
+    try:
+        first = tracemalloc.take_snapshot()
+        time.sleep(seconds)
+        second = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+
+    stats = second.compare_to(first, key_type)
+    return [str(stat) for stat in stats[:limit]]
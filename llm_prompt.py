@@ -0,0 +1,232 @@
+import itertools
+import logging
+from typing import Union, Callable
+
+from llm_history import HistoryEntry
+
+# Each builder tags the fragments it caches on history entries with its own key
+_builder_keys = itertools.count(1)
+
+# Whitespace padding used to find out how a template trims the message contents
+_padding = "\n\t "
+
+
+def _sentinel(name: str) -> str:
+    return "\x02{}\x03".format(name)
+
+
+def _trim(text: str, keep: tuple) -> str:
+    keep_left, keep_right = keep
+    if not keep_left and not keep_right:
+        return text.strip()
+    elif not keep_left:
+        return text.lstrip()
+    elif not keep_right:
+        return text.rstrip()
+    return text
+
+
+class PromptBuilder:
+    """Incremental prompt assembly for a jinja2 chat template.
+
+    When the template is loaded, the layout of the conversation it renders
+    (the literal text around the system, user and assistant messages and how
+    it trims them) is learned by rendering probe conversations made of
+    sentinels. A prompt is then the concatenation of the head, the fragments
+    cached on the stored history entries, the new user message and the tail,
+    so only the new message is rendered on each turn. Templates whose output
+    cannot be reproduced this way (checked against full renders at load time)
+    fall back to a full render of the conversation.
+
+    With an assistant prefix (declared in the template header) the
+    conversation ends with the user message and the prefix is appended to
+    the rendered prompt, otherwise an empty assistant message starts the answer.
+    """
+
+    def __init__(self, j_template, template_name: str = "", assistant_prefix: Union[str, None] = None):
+        self._template = j_template
+        self._assistant_prefix = assistant_prefix
+        self._key = next(_builder_keys)
+        self._literal_tokens = {}
+        self._layouts = {}
+        for has_system in (True, False):
+            layout = self._learn_layout(has_system)
+            if layout and not self._validate(layout, has_system):
+                layout = None
+            self._layouts[has_system] = layout
+
+        if self._layouts[True] is None or self._layouts[False] is None:
+            logging.warning("Template '{}' is rendered in full on every directive.".format(template_name))
+
+    def _messages(self, system_prompt: str, history: list, message: str) -> list:
+        # Conversation layout used by ContextInstruct
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        messages += history
+        messages.append({"role": "user", "content": message})
+        if self._assistant_prefix is None:
+            messages.append({"role": "assistant", "content": ""})
+        return messages
+
+    def render(self, system_prompt: str, history: list, message: str) -> str:
+        # Full render of the conversation
+        prompt = self._template.render(messages=self._messages(system_prompt, history, message))
+        return prompt + self._assistant_prefix if self._assistant_prefix else prompt
+
+    def _split(self, names: list, pad: str) -> Union[tuple, None]:
+        # Render a probe conversation of sentinels and cut the output into the literals between them
+        contents = {name: pad + _sentinel(name) + pad for name in names}
+        history = [{"role": "user" if name[0] == 'U' else "assistant", "content": contents[name]}
+                   for name in names if name[0] in 'UA' and name != 'U2']
+        out = self.render(contents.get('S', ''), history, contents['U2'])
+
+        literals = []
+        trims = {}
+        pos = 0
+        for name in names:
+            start = out.find(_sentinel(name), pos)
+            if start < 0:
+                return None
+            end = start + len(_sentinel(name))
+            trims[name] = (out[max(0, start - len(pad)):start] == pad, out[end:end + len(pad)] == pad)
+            literals.append(out[pos:start])
+            pos = end
+        literals.append(out[pos:])
+        return literals, trims
+
+    def _learn_layout(self, has_system: bool) -> Union[dict, None]:
+        names = (['S'] if has_system else []) + ['U0', 'A0', 'U1', 'A1', 'U2']
+        try:
+            plain = self._split(names, "")
+            padded = self._split(names, _padding)
+        except Exception as ex:
+            logging.warning("Unable to learn the layout of the template: {}".format(ex))
+            return None
+        if plain is None or padded is None:
+            return None
+
+        literals, _ = plain
+        _, trims = padded
+        offset = 1 if has_system else 0
+        layout = {"head": literals[0],
+                  "system_to_user": literals[1] if has_system else "",
+                  "user_to_assistant": literals[offset + 1],
+                  "assistant_to_user": literals[offset + 2],
+                  "tail": literals[-1],
+                  "system": trims.get('S', (True, True)),
+                  "first_user": trims['U0'],
+                  "user": trims['U1'],
+                  "assistant": trims['A0']}
+
+        # Every exchange after the first one has to look the same
+        if literals[offset + 3] != layout['user_to_assistant'] or literals[offset + 4] != layout['assistant_to_user'] \
+                or trims['U2'] != layout['user'] or trims['A1'] != layout['assistant']:
+            return None
+        return layout
+
+    def _validate(self, layout: dict, has_system: bool) -> bool:
+        # The assembled prompts must match full renders of realistic conversations
+        system_prompt = " Act as a {friendly} chatbot.\n" if has_system else ""
+        exchanges = [(" How many moons does {Pluto} have? ", "Pluto has five moons.\n"),
+                     ("and saturn?\n", " Saturn has 146 known moons. "),
+                     ("why is pluto no longer a planet?", "It has not cleared its orbit.")]
+        for count in range(len(exchanges) + 1):
+            entries = []
+            for user, assistant in exchanges[:count]:
+                entries += [HistoryEntry('user', user), HistoryEntry('assistant', assistant)]
+            message = "  the IAU should be {defunded}  "
+            history = [entry.as_dict() for entry in entries]
+            if self._assemble(layout, system_prompt, entries, message) != self.render(system_prompt, history, message):
+                return False
+
+        # Templates joining or trimming messages together (the system prompt prepended to the first user
+        # message) lay out blank messages differently, those conversations are then rendered in full
+        layout['blank'] = True
+        blank_system = " \n" if has_system else ""
+        for exchanges, message in (([], ""), ([], " \n"), ([("", "Pluto has five moons.")], "and saturn?"),
+                                   ([("\n", " "), ("and saturn?", "")], "  ")):
+            entries = []
+            for user, assistant in exchanges:
+                entries += [HistoryEntry('user', user), HistoryEntry('assistant', assistant)]
+            history = [entry.as_dict() for entry in entries]
+            if self._assemble(layout, blank_system, entries, message) != \
+                    self.render(blank_system, history, message):
+                layout['blank'] = False
+                break
+        return True
+
+    def _fragment(self, layout: dict, entry: HistoryEntry, first: bool, has_system: bool) -> str:
+        # Rendered text of a stored history message, cached on the entry
+        cached = entry.cached_fragments((self._key, has_system))
+        if cached is None:
+            if entry.role == 'user':
+                first_text = _trim(entry.content, layout['first_user']) + layout['user_to_assistant']
+                other_text = layout['assistant_to_user'] + _trim(entry.content, layout['user']) + \
+                    layout['user_to_assistant']
+            else:
+                first_text = other_text = _trim(entry.content, layout['assistant'])
+            cached = (first_text, other_text)
+            entry.cache_fragments((self._key, has_system), cached)
+        return cached[0] if first else cached[1]
+
+    def _assemble(self, layout: dict, system_prompt: str, entries: list, message: str) -> str:
+        has_system = len(system_prompt) > 0
+        parts = [layout['head']]
+        if has_system:
+            parts.append(_trim(system_prompt, layout['system']))
+            parts.append(layout['system_to_user'])
+
+        for index, entry in enumerate(entries):
+            parts.append(self._fragment(layout, entry, index == 0, has_system))
+
+        # Only the new user message is rendered
+        if entries:
+            parts.append(layout['assistant_to_user'] + _trim(message, layout['user']))
+        else:
+            parts.append(_trim(message, layout['first_user']))
+        parts.append(layout['tail'])
+        return ''.join(parts)
+
+    @staticmethod
+    def _alternating(entries: tuple) -> bool:
+        return len(entries) % 2 == 0 and \
+            all(entry.role == ('user' if index % 2 == 0 else 'assistant') for index, entry in enumerate(entries))
+
+    @staticmethod
+    def _has_blank(system_prompt: str, entries: tuple, message: str) -> bool:
+        return not message.strip() or (system_prompt and not system_prompt.strip()) or \
+            any(not entry.content.strip() for entry in entries)
+
+    def build(self, system_prompt: str, entries: tuple, message: str) -> str:
+        layout = self._layouts[len(system_prompt) > 0]
+        if layout is None or not self._alternating(entries) or \
+                (not layout['blank'] and self._has_blank(system_prompt, entries, message)):
+            return self.render(system_prompt, [entry.as_dict() for entry in entries], message)
+        return self._assemble(layout, system_prompt, entries, message)
+
+    def clear_token_counts(self):
+        self._literal_tokens.clear()
+
+    def prompt_tokens(self, count_tokens: Callable[[str], int], system_prompt: str, entries: tuple,
+                      message: str, tokenizer_key: int = 0) -> int:
+        # Token count of the prompt from the cached token counts of the history entries and of the
+        # template literals (tokens merging across fragment boundaries make this an estimate)
+        layout = self._layouts[len(system_prompt) > 0]
+        if layout is None:
+            return count_tokens(self.build(system_prompt, entries, message))
+
+        literals = self._literal_tokens.get(id(layout))
+        if literals is None:
+            literals = {name: count_tokens(layout[name]) for name in ('head', 'system_to_user', 'user_to_assistant',
+                                                                      'assistant_to_user', 'tail')}
+            self._literal_tokens[id(layout)] = literals
+
+        tokens = literals['head'] + literals['tail'] + count_tokens(message)
+        if system_prompt:
+            tokens += literals['system_to_user'] + count_tokens(system_prompt)
+        for entry in entries:
+            tokens += entry.token_count(count_tokens, tokenizer_key)
+        exchanges = len(entries) // 2
+        tokens += literals['user_to_assistant'] * exchanges + literals['assistant_to_user'] * exchanges
+        return tokens
@@ -0,0 +1,271 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+
+class ContextRegistry:
+    """Loaded contexts in least recently used order, with a count/memory budget and an idle TTL.
+
+    The registry only picks the contexts to evict. The owner spills them to
+    the context store and rehydrates them when they are addressed again.
+    A limit of 0 disables that limit.
+    """
+
+    def __init__(self, max_contexts: int = 0, max_memory: int = 0, idle_ttl: float = 0.0):
+        self._max_contexts = max_contexts
+        self._max_memory = max_memory
+        self._idle_ttl = idle_ttl
+        self._contexts = OrderedDict()
+        self._last_used = {}
+        self._sizes = {}
+        self._pins = {}
+        self._lock = threading.RLock()
+
+    def get(self, name, default=None):
+        with self._lock:
+            if name in self._contexts:
+                self._contexts.move_to_end(name)
+                self._last_used[name] = time.monotonic()
+                return self._contexts[name]
+            return default
+
+    def __setitem__(self, name, context):
+        with self._lock:
+            self._contexts[name] = context
+            self._contexts.move_to_end(name)
+            self._last_used[name] = time.monotonic()
+            self._sizes[name] = context.memory_usage()
+
+    def __getitem__(self, name):
+        context = self.get(name)
+        if context is None:
+            raise KeyError(name)
+        return context
+
+    def __contains__(self, name):
+        return name in self._contexts
+
+    def __len__(self):
+        return len(self._contexts)
+
+    def __iter__(self):
+        return iter(list(self._contexts))
+
+    def keys(self):
+        return list(self._contexts)
+
+    def pop(self, name, default=None):
+        with self._lock:
+            self._last_used.pop(name, None)
+            self._sizes.pop(name, None)
+            self._pins.pop(name, None)
+            return self._contexts.pop(name, default)
+
+    def clear(self):
+        with self._lock:
+            self._contexts.clear()
+            self._last_used.clear()
+            self._sizes.clear()
+            self._pins.clear()
+
+    def pin(self, name):
+        # Pinned contexts (queued or running directives) are never evicted
+        with self._lock:
+            self._pins[name] = self._pins.get(name, 0) + 1
+
+    def unpin(self, name):
+        with self._lock:
+            count = self._pins.get(name, 0) - 1
+            if count > 0:
+                self._pins[name] = count
+            else:
+                self._pins.pop(name, None)
+
+    def update_size(self, name):
+        with self._lock:
+            if name in self._contexts:
+                self._sizes[name] = self._contexts[name].memory_usage()
+
+    def idle_time(self, name) -> float:
+        return time.monotonic() - self._last_used.get(name, time.monotonic())
+
+    def _evictable(self, name) -> bool:
+        if name in self._pins:
+            return False
+
+        # Keep contexts whose stream has not been read yet
+        streamer = self._contexts[name].streamer
+        return streamer is None or not hasattr(streamer, 'no_words') or streamer.no_words()
+
+    def select_evictions(self) -> list:
+        # Pick idle contexts first, then the least recently used ones until the budget is met
+        with self._lock:
+            now = time.monotonic()
+            evict = []
+            if self._idle_ttl > 0:
+                evict = [name for name in self._contexts
+                         if now - self._last_used[name] > self._idle_ttl and self._evictable(name)]
+
+            count = len(self._contexts) - len(evict)
+            memory = self.memory_usage() - sum(self._sizes[name] for name in evict)
+            for name in self._contexts:
+                over_count = 0 < self._max_contexts < count
+                over_memory = 0 < self._max_memory < memory
+                if not over_count and not over_memory:
+                    break
+                if name not in evict and self._evictable(name):
+                    evict.append(name)
+                    count -= 1
+                    memory -= self._sizes[name]
+
+            return evict
+
+    def memory_usage(self) -> int:
+        return sum(self._sizes.values())
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_contexts > 0 or self._max_memory > 0 or self._idle_ttl > 0
+
+    @property
+    def info(self) -> dict:
+        return {"contexts": len(self._contexts),
+                "memory_bytes": self.memory_usage(),
+                "max_contexts": self._max_contexts,
+                "max_memory_bytes": self._max_memory,
+                "idle_ttl": self._idle_ttl}
+
+
+class ModelRegistry:
+    """Models loaded on demand next to the default one, in least recently used order, within a memory budget.
+
+    Models are keyed by their (real) file, so all the contexts naming the same GGUF file share one copy
+    of its weights. The owner builds and frees the models, the registry picks the idle ones to unload
+    when another model needs the room. A budget of 0 disables the limit.
+    """
+
+    def __init__(self, load, unload, max_memory: int = 0, aliases: dict = None):
+        # load(model) returns (llm, model_info), unload(model, llm) drops the owner's references
+        self._load = load
+        self._unload = unload
+        self._max_memory = max_memory
+        self._aliases = dict(aliases or {})
+        self._default = None
+        self._default_size = 0
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._users = {}
+        self._last_used = {}
+        self._loading = set()
+        self._lock = threading.Condition()
+
+    def resolve(self, name: str) -> str:
+        # Model of an alias, with files named by their real path
+        model = self._aliases.get(name, name)
+        return os.path.realpath(model) if os.path.isfile(model) else model
+
+    @staticmethod
+    def model_size(model: str) -> int:
+        # The weights are the bulk of a loaded model (remote models take no memory here)
+        return os.path.getsize(model) if os.path.isfile(model) else 0
+
+    def set_default(self, model: str):
+        # The default model is always loaded (and owned by the owner), but counts toward the budget
+        with self._lock:
+            self._default = self.resolve(model)
+            self._default_size = self.model_size(self._default)
+
+    def is_default(self, name: str) -> bool:
+        return self.resolve(name) == self._default
+
+    def get(self, model: str):
+        with self._lock:
+            entry = self._models.get(model)
+            return entry[0] if entry else None
+
+    def acquire(self, model: str):
+        # The loaded model (loaded first if needed), kept loaded until it is released
+        with self._lock:
+            while True:
+                if model in self._models:
+                    self._models.move_to_end(model)
+                    self._users[model] = self._users.get(model, 0) + 1
+                    self._last_used[model] = time.monotonic()
+                    return self._models[model][0]
+                if model not in self._loading:
+                    break
+                self._lock.wait()
+
+            self._loading.add(model)
+            size = self.model_size(model)
+            evicted = self._select_unloads(size)
+
+        try:
+            for name, llm in evicted:
+                logging.info("Unloading model '{}' to make room for '{}'.".format(name, model))
+                self._unload(name, llm)
+
+            start = time.monotonic()
+            llm, model_info = self._load(model)
+            logging.info("Loaded model '{}' in {:.2f}s.".format(model, time.monotonic() - start))
+        finally:
+            with self._lock:
+                self._loading.discard(model)
+                self._lock.notify_all()
+
+        with self._lock:
+            self._models[model] = (llm, model_info)
+            self._sizes[model] = size
+            self._users[model] = 1
+            self._last_used[model] = time.monotonic()
+            self._lock.notify_all()
+            return llm
+
+    def release(self, model: str):
+        with self._lock:
+            count = self._users.get(model, 0) - 1
+            if count > 0:
+                self._users[model] = count
+            else:
+                self._users.pop(model, None)
+            self._last_used[model] = time.monotonic()
+
+    def _select_unloads(self, size: int) -> list:
+        # Take the least recently used idle models out until the new one fits (it is loaded over
+        # budget when the models in use do not leave enough room)
+        evicted = []
+        memory = self.memory_usage() + size
+        for name in list(self._models):
+            if not 0 < self._max_memory < memory:
+                break
+            if name not in self._users:
+                evicted.append((name, self._models.pop(name)[0]))
+                memory -= self._sizes.pop(name)
+                self._last_used.pop(name, None)
+
+        if 0 < self._max_memory < memory:
+            logging.warning("Models in use take {} MB, over the budget of {} MB.".format(
+                memory // (1024 * 1024), self._max_memory // (1024 * 1024)))
+        return evicted
+
+    def memory_usage(self) -> int:
+        return self._default_size + sum(self._sizes.values())
+
+    @property
+    def info(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            models = [{"model": model,
+                       "model_info": model_info,
+                       "size_bytes": self._sizes[model],
+                       "users": self._users.get(model, 0),
+                       "idle_seconds": round(now - self._last_used[model], 1)}
+                      for model, (_llm, model_info) in self._models.items()]
+            return {"default": self._default,
+                    "models": models,
+                    "loading": sorted(self._loading),
+                    "aliases": self._aliases,
+                    "memory_bytes": self.memory_usage(),
+                    "max_memory_bytes": self._max_memory}
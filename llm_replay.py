@@ -0,0 +1,199 @@
+import sys
+import math
+import json
+import time
+import argparse
+import threading
+import pyfiglet
+
+from llm_rest_client import ContextClient, LLMClient
+from llm_trace import load_trace
+
+latency_keys = ['ttft_ms', 'total_ms', 'queue_ms', 'render_ms', 'prefill_ms', 'decode_ms', 'summarize_ms']
+
+
+def percentile(values, pct):
+    # Nearest rank percentile of an unsorted list
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def latency_summary(results):
+    summary = {}
+    for key in latency_keys:
+        values = [r[key] for r in results if r.get(key) is not None]
+        summary[key] = {'p50': percentile(values, 50),
+                        'p90': percentile(values, 90),
+                        'p99': percentile(values, 99),
+                        'max': max(values) if values else 0.0}
+    return summary
+
+
+def print_summary(title, results):
+    print("{} ({} directives)".format(title, len(results)))
+    print("  {:<14}{:>10}{:>10}{:>10}{:>10}".format('', 'p50', 'p90', 'p99', 'max'))
+    for key, stats in latency_summary(results).items():
+        print("  {:<14}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(key, stats['p50'], stats['p90'],
+                                                                     stats['p99'], stats['max']))
+    print()
+
+
+def replay_context(records, start_time, t0, speed, llm_client, host, port, prefix, results, lock):
+    # Directives of one context are replayed in order (they share the context's stream and history)
+    name = prefix + records[0]['context_name']
+    con_client = ContextClient(name, host, port)
+
+    first = records[0]
+    status = con_client.create_context(template=first['template'],
+                                       history=int(first['history_count']),
+                                       system_prompt=first['system_prompt'],
+                                       summerizer_type=first['summarizer_type'])
+    if not status[0]:
+        print("Unable to create context '{}': {}".format(name, status[2]))
+        return
+    if first['history_length'] > 0:
+        print("Context '{}' was recorded mid conversation ({} history messages missing).".format(
+            name, first['history_length']))
+
+    system_prompt = first['system_prompt']
+    template = first['template']
+    for rec in records:
+        # Follow system prompt and template changes made during the recording
+        if rec['system_prompt'] != system_prompt:
+            system_prompt = rec['system_prompt']
+            con_client.set_system_prompt(system_prompt)
+        if rec['template'] != template:
+            template = rec['template']
+            con_client.load_template(template)
+
+        # Wait for the (scaled) arrival time of the directive
+        scheduled = (rec['arrival'] - t0) / speed
+        delay = start_time + scheduled - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        sent = time.time()
+        first_word = None
+        word_count = 0
+        # Replay with the directive's own parameters (the template and model supply the rest, as they did)
+        parameters = {name: value for name, value in rec.get('parameters', {}).items()
+                      if name in ('max_tokens', 'temperature', 'top_p', 'stop')}
+        resp_gen, resp_id = con_client.submit_directive(rec['msg'], **parameters)
+        if resp_gen is None:
+            print("Directive in context '{}' failed: {}".format(name, resp_id))
+            continue
+        for _word in resp_gen:
+            if first_word is None:
+                first_word = time.time()
+            word_count += 1
+        done = time.time()
+
+        result = {'context_name': name,
+                  'response_id': resp_id,
+                  'recorded_response_id': rec['response_id'],
+                  'scheduled_s': round(scheduled, 3),
+                  'lag_ms': round((sent - start_time - scheduled) * 1000, 1),
+                  'ttft_ms': round((first_word - sent) * 1000, 1) if first_word else None,
+                  'total_ms': round((done - sent) * 1000, 1),
+                  'words': word_count}
+
+        # Add the server side phase breakdown
+        timing = llm_client.get_response_timing(resp_id)
+        if timing:
+            for key in latency_keys:
+                if key in timing and key not in result:
+                    result[key] = timing[key]
+            result['prompt_tokens'] = timing['prompt_tokens']
+            result['completion_tokens'] = timing['completion_tokens']
+
+        with lock:
+            results.append(result)
+
+
+def replay(trace_file, output_file, speed, host, port, prefix):
+    records = load_trace(trace_file)
+    if len(records) == 0:
+        print("No directives in trace '{}'.".format(trace_file))
+        return []
+
+    # Split the traffic by context, keeping arrival order within each context
+    by_context = {}
+    for rec in records:
+        by_context.setdefault(rec['context_name'], []).append(rec)
+
+    print("Replaying {} directives in {} contexts from '{}' at {}x speed.".format(len(records), len(by_context),
+                                                                                 trace_file, speed))
+    llm_client = LLMClient(host, port)
+    results = []
+    lock = threading.Lock()
+    t0 = records[0]['arrival']
+    start_time = time.time()
+
+    threads = [threading.Thread(target=replay_context,
+                                args=(recs, start_time, t0, speed, llm_client, host, port, prefix, results, lock))
+               for recs in by_context.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if output_file:
+        with open(output_file, 'w') as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+        print("Wrote {} results to '{}'.".format(len(results), output_file))
+
+    # Clean up the replayed contexts
+    for name in by_context:
+        ContextClient(prefix + name, host, port).delete_context()
+
+    return results
+
+
+def load_results(results_file):
+    with open(results_file, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(baseline_file, candidate_file):
+    baseline = latency_summary(load_results(baseline_file))
+    candidate = latency_summary(load_results(candidate_file))
+
+    print("Latency (ms) '{}' -> '{}'".format(baseline_file, candidate_file))
+    print("  {:<14}{:>6}{:>12}{:>12}{:>10}".format('', '', 'baseline', 'candidate', 'change'))
+    for key in latency_keys:
+        for pct in ('p50', 'p90', 'p99'):
+            base = baseline[key][pct]
+            cand = candidate[key][pct]
+            change = "{:+.1f}%".format((cand - base) / base * 100) if base else "n/a"
+            print("  {:<14}{:>6}{:>12.1f}{:>12.1f}{:>10}".format(key, pct, base, cand, change))
+    print()
+
+
+if __name__ == "__main__":
+    print(pyfiglet.figlet_format("LLM Replay"))
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("command", help="replay (trace -> results) or compare (baseline results, candidate results)")
+    ap.add_argument("files", nargs='+', help="trace file to replay or two results files to compare")
+    ap.add_argument("-o", "--output", type=str, default="", help="results file written by replay")
+    ap.add_argument("-s", "--speed", type=float, default=1.0, help="replay speed (2.0 = twice as fast)")
+    ap.add_argument("-x", "--prefix", type=str, default="replay-", help="prefix of the replayed context names")
+    ap.add_argument("-t", "--host", type=str, default="ai-001.local", help="server host")
+    ap.add_argument("-p", "--port", type=int, default=8080, help="server port")
+    args = vars(ap.parse_args())
+
+    if args['command'] == 'replay' and len(args['files']) == 1:
+        replay_results = replay(args['files'][0], args['output'], args['speed'], args['host'], args['port'],
+                                args['prefix'])
+        print_summary("Replay of '{}'".format(args['files'][0]), replay_results)
+
+    elif args['command'] == 'compare' and len(args['files']) == 2:
+        compare(args['files'][0], args['files'][1])
+
+    else:
+        print("Invalid command. Use 'replay trace.jsonl' or 'compare baseline.jsonl candidate.jsonl'.")
+        sys.exit(1)
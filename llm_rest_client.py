@@ -1,10 +1,15 @@
+import time
 import requests
 import re
 
+from llm_timing import DirectiveTiming
+
 
 class LLMClient:
     def __init__(self, host, port, prefix="http"):
         self._llm_url = "{}://{}:{}/llm/".format(prefix, host, port)
+        self._resp_url = "{}://{}:{}/response/".format(prefix, host, port)
+        self._jobs_url = "{}://{}:{}/jobs".format(prefix, host, port)
 
     @staticmethod
     def _build_return_status(resp):
@@ -28,23 +33,89 @@ class LLMClient:
         resp = requests.get(self._llm_url + "info")
         return self._build_return_status(resp)
 
+    # Get the token usage of all the tenants (or of one)
+    def get_tenant_usage(self, tenant: str = ""):
+        params = {"tenant": tenant} if tenant else {}
+        resp = requests.get(self._llm_url + "usage", params=params)
+        return self._build_return_status(resp)
+
+    # Get the models loaded next to the default one
+    def get_models_info(self):
+        resp = requests.get(self._llm_url + "models")
+        return self._build_return_status(resp)
+
+    # Run a JSONL file of directives on the server in the background (files are in the server's job data directory)
+    def submit_job(self, input_file: str, output_file: str, concurrency=4, tenant="", keep_contexts=False):
+        json = {"input": input_file, "output": output_file, "concurrency": concurrency,
+                "tenant": tenant, "keep_contexts": keep_contexts}
+        resp = requests.post(self._jobs_url, json=json)
+        return self._build_return_status(resp)
+
+    # Get the progress of a batch job (or of all of them)
+    def get_job_info(self, job_id: str = ""):
+        resp = requests.get(self._jobs_url + ("/" + job_id if job_id else ""))
+        return self._build_return_status(resp)
+
+    # Stop a batch job (resume_job picks it up where its output ends)
+    def cancel_job(self, job_id: str):
+        resp = requests.post(self._jobs_url + "/cancel/" + job_id)
+        return self._build_return_status(resp)
+
+    def resume_job(self, job_id: str):
+        resp = requests.post(self._jobs_url + "/resume/" + job_id)
+        return self._build_return_status(resp)
+
+    # Get the directive queue statistics
+    def get_queue_info(self):
+        resp = requests.get(self._llm_url + "queue")
+        return self._build_return_status(resp)
+
+    # Cancel a queued or running response
+    def cancel_response(self, resp_id: str):
+        resp = requests.post(self._resp_url + "cancel/" + resp_id)
+        return self._build_return_status(resp)
+
+    # Get the result of a response (state, text, summary, token counts and timing), waiting up to
+    # wait seconds for it to be done
+    def get_response(self, resp_id: str, wait: float = 0.0):
+        resp = requests.get(self._resp_url + resp_id, params={"wait": wait}, timeout=wait + 30)
+        if resp.status_code == 200:
+            return resp.json()['detail']
+        else:
+            return None
+
+    # Get the phase timing breakdown of a response
+    def get_response_timing(self, resp_id: str):
+        resp = requests.get(self._resp_url + "timing/" + resp_id)
+        if resp.status_code == 200:
+            return resp.json()['detail']
+        else:
+            return None
+
 
 class ContextClient:
-    def __init__(self, conv_name, host, port, prefix="http"):
+    def __init__(self, conv_name, host, port, prefix="http", tenant=""):
         self._name = conv_name
+        # Directives are charged to this tenant instead of the one in the context name (if the server configures it)
+        self._headers = {"X-Tenant": tenant} if tenant else {}
         self._con_url = "{}://{}:{}/context/".format(prefix, host, port)
+        self._resp_url = "{}://{}:{}/response/".format(prefix, host, port)
         self._current_respid = ""
         self._last_loaded_template = ""
+        self._last_timing = {}
+        self._last_event = ""
 
     @staticmethod
     def _build_return_status(resp):
         return resp.status_code == 200 or resp.status_code == 422, resp.status_code, resp.json()
 
     # Start a named context
-    def create_context(self, template="", history=2, system_prompt="", summerizer_type="abstractive"):
+    def create_context(self, template="", history=2, system_prompt="", summerizer_type="abstractive",
+                       priority="interactive", model="", stream=True):
         try:
             json = {"template": template, "history": history,
-                    "system_prompt": system_prompt, "summerizer_type": summerizer_type}
+                    "system_prompt": system_prompt, "summerizer_type": summerizer_type, "priority": priority,
+                    "model": model, "stream": stream}
             resp = requests.post(self._con_url + self._name, json=json)
             if resp.status_code == 200:
                 self._last_loaded_template = template
@@ -55,6 +126,18 @@ class ContextClient:
         except requests.exceptions.ConnectionError:
             return False, 422, {}
 
+    # Start this context as a fork of another context (same settings and history)
+    def fork_context(self, parent: str):
+        try:
+            resp = requests.post(self._con_url + "fork/" + self._name, json={"parent": parent})
+            if resp.status_code == 200:
+                temp_status = self.get_template()
+                return temp_status
+            return self._build_return_status(resp)
+
+        except requests.exceptions.ConnectionError:
+            return False, 422, {}
+
     # End and delete a context and its history
     def delete_context(self):
         resp = requests.delete(self._con_url + self._name)
@@ -105,15 +188,33 @@ class ContextClient:
         return result
 
     # Send directive (prompt) to the context and return a response generator
-    def submit_directive(self, msg: str):
+    # The generation parameters (if given) apply to this directive only
+    # A busy server (429) is asked again after the time it says, up to retries times
+    def submit_directive(self, msg: str, max_tokens=None, temperature=None, top_p=None, stop=None, priority=None,
+                         deadline_seconds=None, retries=3):
         json = {"msg": msg}
-        resp = requests.put(self._con_url + self._name, json=json)
+        for name, value in (('max_tokens', max_tokens), ('temperature', temperature),
+                            ('top_p', top_p), ('stop', stop), ('priority', priority),
+                            ('deadline_seconds', deadline_seconds)):
+            if value is not None:
+                json[name] = value
+        resp = requests.put(self._con_url + self._name, json=json, headers=self._headers)
+        while resp.status_code == 429 and retries > 0:
+            time.sleep(float(resp.headers.get('Retry-After', 1)))
+            retries -= 1
+            resp = requests.put(self._con_url + self._name, json=json, headers=self._headers)
+
         if resp.status_code == 200:
             self._current_respid = resp.json()['detail']
             return self.response_generator(), self._current_respid
         else:
             return None, '|ERROR-{}, {}, {}|'.format(resp.status_code, resp.reason, resp.text)
 
+    # Cancel the current directive (queued or running), its response ends with a CANCELLED event
+    def cancel_directive(self):
+        resp = requests.post(self._resp_url + "cancel/" + self._current_respid)
+        return self._build_return_status(resp)
+
     # Just send directive and return
     # Used with response_generator to do stuff between the directive and getting a response
     def directive_only(self, msg: str):
@@ -139,7 +240,7 @@ class ContextClient:
         # sending a request and fetching a response which is stored in r
         with requests.get(self._con_url + self._name, stream=True) as r:
             is_recv = False
-            for chunk in r.iter_content(128):
+            for chunk in r.iter_content(1024):
                 word = chunk.decode("utf-8")
 
                 is_marker, data = self._is_resp_marker(word)
@@ -150,6 +251,14 @@ class ContextClient:
                     elif data[0] == 'END':
                         assert is_recv, "Got a end before the start of a response."
                         is_recv = False
+                        # The timing breakdown is the last field (context names may contain '-')
+                        self._last_timing = DirectiveTiming.parse_marker(data[-1])
+                        self._last_event = data[0]
+                    elif data[0] in ('CANCELLED', 'TIMEOUT', 'FAILED'):
+                        # Ends the response whether it had started or not
+                        self._last_timing = DirectiveTiming.parse_marker(data[-1])
+                        self._last_event = data[0]
+                        return
                     continue
 
                 if is_recv:
@@ -158,3 +267,15 @@ class ContextClient:
     @property
     def last_loaded_template(self):
         return self._last_loaded_template
+
+    @property
+    def current_response_id(self):
+        return self._current_respid
+
+    @property
+    def last_timing(self):
+        return self._last_timing
+
+    @property
+    def last_event(self):
+        return self._last_event
@@ -1,24 +1,45 @@
+import time
+import queue
 import pyfiglet
 import argparse
 import logging
 import asyncio
+import threading
+import functools
+from typing import Union, List, Literal
 from pydantic import BaseModel, typing, Field
 
-from fastapi.responses import StreamingResponse
-from fastapi import FastAPI, HTTPException, status
+from fastapi.responses import StreamingResponse, PlainTextResponse, Response
+from fastapi import FastAPI, HTTPException, Header, status
+from fastapi.concurrency import run_in_threadpool
 import uvicorn
 
-from llm_streamers import Word2QueueStreamer
+from llm_streamers import Word2QueueStreamer, is_end_marker
+from llm_profiler import SamplingProfiler, memory_diff
+from llm_scheduler import QueueFull
 from llm_llama import LlamaModel
 from llm_openai import OpenAIModel
+from llm_echo import EchoModel
+from llm_worker import WorkerLLM
+from llm_jobs import JobManager
 
 llm_types = {'llama': LlamaModel,
-             'openai': OpenAIModel
+             'openai': OpenAIModel,
+             'echo': EchoModel
              }
 
 
 class Predict(BaseModel):
     msg: str
+    # Generation parameters of this directive only (the model's are used when not given)
+    max_tokens: Union[int, None] = Field(default=None, gt=0)
+    temperature: Union[float, None] = Field(default=None, ge=0.0)
+    top_p: Union[float, None] = Field(default=None, gt=0.0, le=1.0)
+    stop: Union[List[str], None] = Field(default=None)
+    # Queue lane of this directive only (the context's lane is used when not given)
+    priority: Union[Literal['interactive', 'batch'], None] = Field(default=None)
+    # Seconds the client is willing to wait for the directive to start (dropped with a TIMEOUT event after that)
+    deadline_seconds: Union[float, None] = Field(default=None, gt=0.0)
 
 
 class ContextSpec(BaseModel):
@@ -26,6 +47,38 @@ class ContextSpec(BaseModel):
     history: int = Field(default=0)
     system_prompt: str = Field(default='')
     summerizer_type: str = Field(default='')
+    priority: Literal['interactive', 'batch'] = Field(default='interactive')
+    # Model file or alias the context uses (the default model when not given)
+    model: str = Field(default='')
+    # Without a stream the results are only collected with GET /response/{id}
+    stream: bool = Field(default=True)
+
+
+class ForkSpec(BaseModel):
+    parent: str
+
+
+class ContextSnapshot(BaseModel):
+    settings: dict
+    history: list
+
+
+class ModelSwap(BaseModel):
+    model: str
+    # Parameters of the new model (the current model's are used when not given)
+    n_ctx: Union[int, None] = Field(default=None, gt=0)
+    gpu: Union[int, None] = Field(default=None, ge=0)
+    temperature: Union[float, None] = Field(default=None, ge=0.0)
+    max_tokens: Union[int, None] = Field(default=None, gt=0)
+
+
+class JobSpec(BaseModel):
+    # JSONL files in the server's job data directory, one directive per input line and one result per output line
+    input: str
+    output: str
+    concurrency: int = Field(default=4, gt=0)
+    tenant: str = Field(default='')
+    keep_contexts: bool = Field(default=False)
 
 
 class ReturnData(BaseModel):
@@ -35,40 +88,103 @@ class ReturnData(BaseModel):
 
 # creating a fast application
 app = FastAPI()
+app.extra['llm'] = None
+app.extra['llm_state'] = 'loading'
+app.extra['llm_error'] = ''
+app.extra['jobs'] = None
+
+
+def _llm():
+    # The model, or a 503 while it is still loading
+    llm = app.extra['llm']
+    if llm is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Model {}: {}".format(app.extra['llm_state'], app.extra['llm_error']),
+                            headers={"Retry-After": "5"})
+    return llm
+
+
+def _jobs() -> JobManager:
+    _llm()
+    return app.extra['jobs']
+
+
+@app.get("/llm/status")
+def model_status() -> ReturnData:
+    # loading or failed at startup, then ready, or loading/swapping/draining during a model swap
+    llm = app.extra['llm']
+    detail = {"state": app.extra['llm_state'] if llm is None else llm.model_state,
+              "error": app.extra['llm_error']}
+    if llm is not None:
+        detail['model'] = llm.model_info.get('model')
+    return ReturnData(name="llm", detail=detail)
 
 
 @app.post("/llm/restart")
-async def restart_llm() -> ReturnData:
-    app.extra['llm'].restart()
+def restart_llm() -> ReturnData:
+    _llm().restart()
     return ReturnData(name="llm", detail='LLM restarted')
 
 
 @app.post("/llm/shutdown")
-async def shutdown_llm() -> ReturnData:
-    app.extra['llm'].shutdown()
+def shutdown_llm() -> ReturnData:
+    _llm().shutdown()
     return ReturnData(name="llm", detail='LLM shutdown')
 
 
 @app.get("/llm/list")
-async def list_contexts() -> ReturnData:
-    names = app.extra['llm'].get_context_names()
+def list_contexts() -> ReturnData:
+    names = _llm().get_context_names()
     return ReturnData(name="llm", detail=names)
 
 
 @app.get("/llm/info")
-async def model_info() -> ReturnData:
-    info = app.extra['llm'].model_info
+def model_info() -> ReturnData:
+    info = _llm().model_info
+    return ReturnData(name="llm", detail=info)
+
+
+@app.get("/llm/workers")
+async def worker_info() -> ReturnData:
+    llm = _llm()
+    info = llm.worker_info if isinstance(llm, WorkerLLM) else []
+    return ReturnData(name="llm", detail=info)
+
+
+@app.get("/llm/contexts")
+def context_registry_info() -> ReturnData:
+    info = _llm().registry_info
+    return ReturnData(name="llm", detail=info)
+
+
+@app.get("/llm/models")
+def models_info() -> ReturnData:
+    info = _llm().models_info
+    return ReturnData(name="llm", detail=info)
+
+
+@app.get("/llm/queue")
+def queue_info() -> ReturnData:
+    info = _llm().queue_info
     return ReturnData(name="llm", detail=info)
 
 
+@app.get("/llm/usage")
+def tenant_usage(tenant: Union[str, None] = None) -> ReturnData:
+    usage = _llm().get_tenant_usage(tenant)
+    return ReturnData(name="llm", detail=usage)
+
+
 @app.post("/context/{name}")
 def create_context(name: str, cspec: ContextSpec) -> ReturnData:
-    success, msg = app.extra['llm'].create_context(name,
-                                                   template_file=cspec.template,
-                                                   history_count=cspec.history,
-                                                   system_prompt=cspec.system_prompt,
-                                                   summerizer_type=cspec.summerizer_type,
-                                                   streamer_type='queue')
+    success, msg = _llm().create_context(name,
+                                         template_file=cspec.template,
+                                         history_count=cspec.history,
+                                         system_prompt=cspec.system_prompt,
+                                         summerizer_type=cspec.summerizer_type,
+                                         streamer_type='queue' if cspec.stream else None,
+                                         priority=cspec.priority,
+                                         model=cspec.model or None)
     if success:
         return ReturnData(name=name, detail="Context '{}' created".format(name))
     else:
@@ -76,9 +192,44 @@ def create_context(name: str, cspec: ContextSpec) -> ReturnData:
                             detail="Context '{}' error: {}".format(name, msg))
 
 
+@app.post("/context/fork/{name}")
+def fork_context(name: str, fspec: ForkSpec) -> ReturnData:
+    success, msg = _llm().fork_context(fspec.parent, name)
+    if success:
+        return ReturnData(name=name, detail=msg)
+    else:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Context '{}' error: {}".format(name, msg))
+
+
+@app.get("/context/export/{name}")
+def export_context(name: str) -> ReturnData:
+    # Settings and history of an idle context, to move it to another server
+    if _llm().context_busy(name):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Context '{}' has directives in progress".format(name))
+    snapshot = _llm().export_context(name)
+    if snapshot:
+        return ReturnData(name=name, detail=snapshot)
+    else:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Context '{}' does not exist".format(name))
+
+
+@app.post("/context/import/{name}")
+def import_context(name: str, snapshot: ContextSnapshot) -> ReturnData:
+    success, msg = _llm().import_context(name, {"settings": snapshot.settings,
+                                                "history": snapshot.history})
+    if success:
+        return ReturnData(name=name, detail=msg)
+    else:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Context '{}' error: {}".format(name, msg))
+
+
 @app.delete("/context/{name}")
 def delete_context(name: str) -> ReturnData:
-    if app.extra['llm'].delete_context(name):
+    if _llm().delete_context(name):
         return ReturnData(name=name, detail="Context '{}' deleted".format(name))
     else:
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
@@ -86,8 +237,16 @@ def delete_context(name: str) -> ReturnData:
 
 
 @app.put("/context/{name}")
-def submit_directive(name: str, predict: Predict) -> ReturnData:
-    resp_id = app.extra['llm'].submit_directive(name, predict.msg)
+def submit_directive(name: str, predict: Predict, x_tenant: Union[str, None] = Header(default=None)) -> ReturnData:
+    # The tenant comes from the context name, or from the X-Tenant header if it names a configured tenant
+    try:
+        resp_id = _llm().submit_directive(name, predict.msg, predict.max_tokens, predict.temperature,
+                                          predict.top_p, predict.stop, predict.priority,
+                                          predict.deadline_seconds, x_tenant)
+    except QueueFull as ex:
+        # Overloaded, so tell the client when to come back instead of queueing work it will give up on
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(ex),
+                            headers={"Retry-After": str(ex.retry_after)})
     if resp_id:
         return ReturnData(name=name, detail=resp_id)
     else:
@@ -96,10 +255,14 @@ def submit_directive(name: str, predict: Predict) -> ReturnData:
 
 
 @app.get('/context/{name}')
-async def stream_response(name: str):
+def stream_response(name: str):
     # We use Streaming Response class of Fast API to stream response
-    if app.extra['llm'].get_context(name):
-        return StreamingResponse(serve_response(app.extra['llm'].get_context(name).streamer),
+    context = _llm().get_context(name)
+    if context and context.streamer is None:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Context '{}' has no stream".format(name))
+    if context:
+        return StreamingResponse(serve_response(name, context.streamer),
                                  media_type='text/event-stream')
     else:
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
@@ -107,8 +270,8 @@ async def stream_response(name: str):
 
 
 @app.get('/context/info/{name}')
-async def get_context_info(name: str):
-    info = app.extra['llm'].get_context_info(name)
+def get_context_info(name: str):
+    info = _llm().get_context_info(name)
     if info is None:
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                             detail="Context '{}' info does not exist".format(name))
@@ -118,7 +281,7 @@ async def get_context_info(name: str):
 
 @app.put("/context/template/{name}")
 def load_template(name: str, cspec: ContextSpec) -> ReturnData:
-    if app.extra['llm'].load_template(name, cspec.template):
+    if _llm().load_template(name, cspec.template):
         return ReturnData(name=name, detail="Context '{}' template loaded".format(name))
     else:
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
@@ -127,7 +290,7 @@ def load_template(name: str, cspec: ContextSpec) -> ReturnData:
 
 @app.get("/context/template/{name}")
 def get_template(name: str) -> ReturnData:
-    templ = app.extra['llm'].get_template(name)
+    templ = _llm().get_template(name)
     if templ:
         return ReturnData(name=name, detail=templ)
     else:
@@ -137,7 +300,7 @@ def get_template(name: str) -> ReturnData:
 
 @app.put("/context/prompt/{name}")
 def set_system_prompt(name: str, cspec: ContextSpec) -> ReturnData:
-    if app.extra['llm'].set_system_prompt(name, cspec.system_prompt):
+    if _llm().set_system_prompt(name, cspec.system_prompt):
         return ReturnData(name=name, detail="System prompt in context '{}' set.".format(name))
     else:
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
@@ -146,7 +309,7 @@ def set_system_prompt(name: str, cspec: ContextSpec) -> ReturnData:
 
 @app.patch("/context/history/{name}")
 def clear_context(name: str) -> ReturnData:
-    if app.extra['llm'].clear_context(name):
+    if _llm().clear_context(name):
         return ReturnData(name=name, detail="Context '{}' history cleared".format(name))
     else:
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
@@ -155,7 +318,7 @@ def clear_context(name: str) -> ReturnData:
 
 @app.get("/context/history/{name}")
 def get_context_history(name: str) -> ReturnData:
-    hist = app.extra['llm'].get_history(name)
+    hist = _llm().get_history(name)
     if hist:
         return ReturnData(name=name, detail=hist)
     else:
@@ -163,24 +326,195 @@ def get_context_history(name: str) -> ReturnData:
                             detail="Context '{}' does not exist".format(name))
 
 
-async def serve_response(streamer: Word2QueueStreamer):
+@app.get("/response/{resp_id}")
+async def get_response(resp_id: str, wait: float = 0.0) -> ReturnData:
+    # State of a directive and once it is done its result. With wait, the request is held until the
+    # directive is done or wait seconds have passed (polling, so no thread is held meanwhile).
+    if not 0 <= wait <= 60:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Response wait needs 0 <= wait <= 60")
+
+    llm = _llm()
+    deadline = time.monotonic() + wait
     while True:
-        # Retreiving the word from the queue
-        word = streamer.get_word()
+        result = await run_in_threadpool(llm.get_directive_result, resp_id)
+        if result is None:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                detail="Response '{}' does not exist or has expired".format(resp_id))
+        if result['state'] == 'done' or time.monotonic() >= deadline:
+            return ReturnData(name=resp_id, detail=result)
+        await asyncio.sleep(0.1)
+
+
+@app.get("/llm/results")
+def results_info() -> ReturnData:
+    info = _llm().results_info
+    return ReturnData(name="llm", detail=info)
+
+
+@app.get("/response/timing/{resp_id}")
+def get_response_timing(resp_id: str) -> ReturnData:
+    timing = _llm().get_directive_timing(resp_id)
+    if timing:
+        return ReturnData(name=resp_id, detail=timing)
+    else:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Timing for response '{}' does not exist".format(resp_id))
+
+
+@app.post("/response/cancel/{resp_id}")
+def cancel_response(resp_id: str) -> ReturnData:
+    if _llm().cancel_directive(resp_id):
+        return ReturnData(name=resp_id, detail="Response '{}' cancelled".format(resp_id))
+    else:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Response '{}' is not queued or running".format(resp_id))
+
+
+@app.post("/jobs")
+def submit_job(spec: JobSpec) -> ReturnData:
+    # Run the directives of a JSONL file in the background at batch priority (resumes from the output file)
+    job, msg = _jobs().submit(spec.input, spec.output, spec.concurrency, spec.tenant, spec.keep_contexts)
+    if job:
+        return ReturnData(name=job.job_id, detail=job.info)
+    else:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=msg)
+
+
+@app.get("/jobs")
+def list_jobs() -> ReturnData:
+    return ReturnData(name="jobs", detail=_jobs().info)
 
-        # yields the value
-        yield word
 
-        # provides a task_done signal once value yielded
-        streamer.processed_word()
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str) -> ReturnData:
+    job = _jobs().get_job(job_id)
+    if job:
+        return ReturnData(name=job_id, detail=job.info)
+    else:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Job '{}' does not exist".format(job_id))
+
 
-        # Breaks if an end marker is encountered
-        if word.startswith('|END'):
-            break
+@app.post("/jobs/cancel/{job_id}")
+def cancel_job(job_id: str) -> ReturnData:
+    if _jobs().cancel(job_id):
+        return ReturnData(name=job_id, detail="Job '{}' cancelled".format(job_id))
+    else:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Job '{}' is not running".format(job_id))
 
-        # guard to make sure we are not extracting anything from
-        # empty queue
-        await asyncio.sleep(0.01)
+
+@app.post("/jobs/resume/{job_id}")
+def resume_job(job_id: str) -> ReturnData:
+    job, msg = _jobs().resume(job_id)
+    if job:
+        return ReturnData(name=job_id, detail=job.info)
+    else:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=msg)
+
+
+# Admin endpoints are plain 'def' so they run in the threadpool and the event loop keeps serving
+# (and shows up in the profile) while they sample.
+@app.get("/admin/profile")
+def profile_server(seconds: float = 10.0, format: str = 'collapsed', interval: float = 0.005):
+    if not 0 < seconds <= 300 or not 0.001 <= interval <= 1.0 or format not in ('collapsed', 'pstats'):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Profile needs 0 < seconds <= 300, 0.001 <= interval <= 1 and a "
+                                   "format of 'collapsed' or 'pstats'")
+
+    profiler = SamplingProfiler(interval)
+    profiler.run(seconds)
+    logging.info("Profiled server: {}".format(profiler.info))
+
+    if format == 'pstats':
+        return Response(content=profiler.as_pstats(), media_type='application/octet-stream',
+                        headers={'Content-Disposition': 'attachment; filename="llm_server.pstats"'})
+    else:
+        return PlainTextResponse(profiler.as_collapsed())
+
+
+@app.get("/admin/memory")
+def memory_snapshot_diff(seconds: float = 10.0, limit: int = 25, frames: int = 1) -> ReturnData:
+    if not 0 < seconds <= 300 or limit < 1 or frames < 1:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Memory diff needs 0 < seconds <= 300, limit >= 1 and frames >= 1")
+
+    key_type = 'traceback' if frames > 1 else 'lineno'
+    return ReturnData(name="memory", detail=memory_diff(seconds, limit, frames, key_type))
+
+
+@app.post("/admin/model")
+def swap_model(spec: ModelSwap) -> ReturnData:
+    # Load a model next to the current one in the background, and switch over between directives
+    llm = _llm()
+    if llm.model_state != 'ready':
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="A model swap is already in progress ({})".format(llm.model_state))
+
+    params = {name: value for name, value in (('n_ctx', spec.n_ctx), ('gpu', spec.gpu),
+                                              ('temperature', spec.temperature), ('max_tokens', spec.max_tokens))
+              if value is not None}
+    threading.Thread(target=run_swap, args=(llm, spec.model, params), daemon=True).start()
+    return ReturnData(name="llm", detail="Loading model '{}'".format(spec.model))
+
+
+def run_swap(llm, model: str, params: dict):
+    success, msg = llm.swap_model(model, **params)
+    app.extra['llm_error'] = '' if success else msg
+
+
+def load_model(build, trace_file: str, jobs_dir: str, job_data: str):
+    # Runs in the background, the server answers with the loading state meanwhile
+    try:
+        llm = build()
+    except Exception as ex:
+        logging.error("Unable to load the model: {}".format(ex))
+        app.extra['llm_state'] = 'failed'
+        app.extra['llm_error'] = str(ex)
+        return
+
+    if trace_file:
+        llm.start_trace(trace_file)
+    app.extra['jobs'] = JobManager(llm, jobs_dir or None, job_data)
+    app.extra['llm'] = llm
+    app.extra['llm_state'] = 'ready'
+    logging.info("Model loaded.")
+    app.extra['jobs'].resume_unfinished()
+
+
+async def serve_response(name: str, streamer: Word2QueueStreamer):
+    ended = False
+    try:
+        while True:
+            # Retreiving the word from the queue without blocking the event loop (a directive may wait
+            # in the queue for a long time before its first word)
+            try:
+                word = streamer.get_word(timeout=0)
+            except queue.Empty:
+                await asyncio.sleep(0.01)
+                continue
+
+            # yields the value
+            yield word
+
+            # provides a task_done signal once value yielded
+            streamer.processed_word()
+
+            # Breaks if an end marker is encountered
+            if is_end_marker(word):
+                ended = True
+                break
+
+            # guard to make sure we are not extracting anything from
+            # empty queue
+            await asyncio.sleep(0.01)
+    finally:
+        # The client went away in the middle of a response
+        if not ended and app.extra.get('cancel_on_disconnect'):
+            logging.info("Stream of context '{}' disconnected".format(name))
+            # Cancelling may wait on a model worker, and the stream's task is being cancelled itself
+            asyncio.get_running_loop().run_in_executor(None, _llm().cancel_directives, name)
 
 
 if __name__ == "__main__":
@@ -189,7 +523,7 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
 
     ap = argparse.ArgumentParser()
-    ap.add_argument("llm_type", default="llama", help="LLM type (llama, openai)")
+    ap.add_argument("llm_type", default="llama", help="LLM type (llama, openai, echo)")
     ap.add_argument("template", default="", help="template file")
     ap.add_argument('model', default="", help="model file or API key")
     ap.add_argument("-p", "--port", type=int, default=8080, help="server port")
@@ -198,18 +532,107 @@ if __name__ == "__main__":
     ap.add_argument("-v", "--verbose", action="store_true", help="verbose output")
     ap.add_argument("-c", "--n_ctx", type=int, default=2048, help="size of context")
     ap.add_argument("-m", "--tokens", type=int, default=1024, help="max tokens")
+    ap.add_argument("-r", "--trace", type=str, default="", help="record directives to this JSONL trace file")
+    ap.add_argument("-s", "--store", type=str, default="", help="directory of context snapshots (warm restart)")
+    ap.add_argument("--max_contexts", type=int, default=0, help="max loaded contexts (0 = unlimited)")
+    ap.add_argument("--context_memory", type=int, default=0, help="max memory of loaded contexts in MB (0 = unlimited)")
+    ap.add_argument("--context_ttl", type=float, default=0.0, help="seconds before an idle context is evicted")
+    ap.add_argument("--sessions", type=str, default="", help="directory of hibernated llama sessions (KV cache)")
+    ap.add_argument("--max_queue", type=int, default=0, help="max queued directives (0 = unlimited)")
+    ap.add_argument("--max_context_queue", type=int, default=0,
+                    help="max queued directives per context (0 = unlimited)")
+    ap.add_argument("--queue_aging", type=float, default=30.0,
+                    help="seconds a batch directive waits before it is served ahead of interactive ones")
+    ap.add_argument("--tenant_rate", type=float, default=0.0,
+                    help="prompt + generated tokens per second allowed per tenant (0 = unlimited)")
+    ap.add_argument("--tenant_burst", type=float, default=0.0,
+                    help="token bucket size per tenant (0 = ten seconds at the tenant rate)")
+    ap.add_argument("--tenant_weight", type=str, action="append", default=[],
+                    help="fair share weight of a tenant as name=weight (repeatable, default 1), "
+                         "X-Tenant headers can only name these tenants")
+    ap.add_argument("--cancel_on_disconnect", action="store_true",
+                    help="cancel a context's directives when its stream client disconnects")
+    ap.add_argument("--session_quota", type=int, default=2048, help="disk quota of the llama sessions in MB")
+    ap.add_argument("--model_workers", type=int, default=0,
+                    help="model worker processes (0 = run the model in the server process)")
+    ap.add_argument("--models", type=str, action="append", default=[],
+                    help="model contexts can name besides the default one, as name=file (repeatable)")
+    ap.add_argument("--model_memory", type=int, default=0,
+                    help="memory budget of the loaded models in MB (0 = unlimited)")
+    ap.add_argument("--api_base", type=str, default="",
+                    help="base URL of the OpenAI compatible server (openai, default $OPENAI_API_BASE or OpenAI)")
+    ap.add_argument("--remote_model", type=str, default="", help="name of the remote model (openai)")
+    ap.add_argument("--concurrency", type=int, default=8, help="remote requests in flight at once (openai)")
+    ap.add_argument("--max_results", type=int, default=1024,
+                    help="directive results kept for GET /response/{id} (0 = unlimited)")
+    ap.add_argument("--result_ttl", type=float, default=3600.0, help="seconds a directive result is kept")
+    ap.add_argument("--result_memory", type=int, default=0,
+                    help="max memory of the kept directive results in MB (0 = unlimited)")
+    ap.add_argument("--jobs_dir", type=str, default="",
+                    help="directory of the batch job specs (unfinished jobs resume at startup)")
+    ap.add_argument("--job_data", type=str, default="job_data",
+                    help="directory of the batch job input and output files")
+    ap.add_argument("--parallel", type=int, default=1,
+                    help="contexts decoded together in one llama batch (1 = one directive at a time)")
+    ap.add_argument("--draft", type=str, default="",
+                    help="speculative decoding with a small draft model (GGUF file) or with prompt lookup "
+                         "('lookup') (llama)")
+    ap.add_argument("--draft_tokens", type=int, default=0,
+                    help="tokens drafted per step (0 = 4 with a draft model, 10 with prompt lookup)")
     args = vars(ap.parse_args())
 
-    # Build the model and pass it into the web server
-    app.extra['llm'] = llm_types[args["llm_type"]](args["model"],
-                                                   args['template'],
-                                                   verbose=args["verbose"],
-                                                   gpu=args['gpu'],
-                                                   temperature=args['temperature'],
-                                                   n_ctx=args['n_ctx'],
-                                                   max_tokens=args['tokens'])
+    tenant_weights = {}
+    for item in args['tenant_weight']:
+        tenant_name, _, weight = item.partition('=')
+        tenant_weights[tenant_name] = float(weight) if weight else 1.0
+
+    model_aliases = {}
+    for item in args['models']:
+        alias, _, model_file = item.partition('=')
+        model_aliases[alias] = model_file if model_file else alias
+
+    model_params = dict(gpu=args['gpu'],
+                        temperature=args['temperature'],
+                        n_ctx=args['n_ctx'],
+                        max_tokens=args['tokens'],
+                        store_dir=args['store'],
+                        max_contexts=args['max_contexts'],
+                        max_context_memory=args['context_memory'] * 1024 * 1024,
+                        context_ttl=args['context_ttl'],
+                        max_queued=args['max_queue'],
+                        max_queued_per_context=args['max_context_queue'],
+                        queue_aging=args['queue_aging'],
+                        tenant_rate=args['tenant_rate'],
+                        tenant_burst=args['tenant_burst'],
+                        tenant_weights=tenant_weights,
+                        session_dir=args['sessions'],
+                        session_quota=args['session_quota'] * 1024 * 1024,
+                        max_results=args['max_results'],
+                        result_ttl=args['result_ttl'],
+                        max_result_memory=args['result_memory'] * 1024 * 1024,
+                        models=model_aliases,
+                        model_memory=args['model_memory'] * 1024 * 1024,
+                        parallel=args['parallel'])
+    if args['llm_type'] == 'openai':
+        model_params.update(api_base=args['api_base'],
+                            remote_model=args['remote_model'],
+                            concurrency=args['concurrency'])
+    elif args['llm_type'] == 'llama':
+        model_params.update(draft=args['draft'], draft_tokens=args['draft_tokens'])
+
+    # Build the model (here or in worker processes) while the web server already answers
+    if args['model_workers'] > 0:
+        build = functools.partial(WorkerLLM, args["llm_type"], args['model_workers'], args["model"],
+                                  args['template'], verbose=args["verbose"], **model_params)
+    else:
+        build = functools.partial(llm_types[args["llm_type"]], args["model"], args['template'],
+                                  verbose=args["verbose"], **model_params)
+    app.extra['cancel_on_disconnect'] = args['cancel_on_disconnect']
+    threading.Thread(target=load_model, args=(build, args['trace'], args['jobs_dir'], args['job_data']),
+                     daemon=True).start()
 
     # Start the web server
     uvicorn.run(app, host='0.0.0.0', port=args['port'], log_level='info')
 
-    app.extra['llm'].shutdown()
+    if app.extra['llm']:
+        app.extra['llm'].shutdown()
@@ -0,0 +1,102 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+from typing import Union
+
+from llm_timing import DirectiveTiming
+
+
+class ResultStore:
+    """Outcome of every directive by response id, from the moment it is queued until it expires.
+
+    A finished result (end event, text, summary, token counts and timing) is kept for `ttl` seconds,
+    and the oldest finished results go first once there are more than `max_results` of them or they
+    take more than `max_memory` bytes. Queued and running directives are never evicted. A limit of 0
+    disables that limit.
+    """
+
+    def __init__(self, max_results: int = 1024, ttl: float = 3600.0, max_memory: int = 0):
+        self._max_results = max_results
+        self._ttl = ttl
+        self._max_memory = max_memory
+        self._results = OrderedDict()
+        self._sizes = {}
+        self._finished = OrderedDict()
+        self._last = None
+        self._lock = threading.Lock()
+
+    def add(self, response_id: str, context_name: str):
+        with self._lock:
+            self._results[response_id] = {"response_id": response_id,
+                                          "context": context_name,
+                                          "state": 'queued',
+                                          "submitted": time.time()}
+
+    def start(self, response_id: str):
+        with self._lock:
+            if response_id in self._results:
+                self._results[response_id]['state'] = 'running'
+
+    def discard(self, response_id: str):
+        with self._lock:
+            self._results.pop(response_id, None)
+
+    def finish(self, response_id: str, event: str, timing: Union[DirectiveTiming, None] = None,
+               result: Union[tuple, None] = None, error: str = ''):
+        text, summary = result if result else ("", "")
+        timing_info = timing.as_dict() if timing else {}
+        with self._lock:
+            entry = self._results.get(response_id, {"response_id": response_id,
+                                                    "context": None,
+                                                    "submitted": None})
+            entry.update({"state": 'done',
+                          "event": event,
+                          "text": text,
+                          "summary": summary,
+                          "error": error,
+                          "prompt_tokens": timing_info.get('prompt_tokens', 0),
+                          "completion_tokens": timing_info.get('completion_tokens', 0),
+                          "timing": timing_info,
+                          "finished": time.time()})
+            self._results[response_id] = entry
+            self._sizes[response_id] = sys.getsizeof(text) + sys.getsizeof(summary) + sys.getsizeof(error)
+            self._finished[response_id] = time.monotonic()
+            self._last = entry
+            self._evict()
+
+    def _evict(self):
+        # Expired results first, then the oldest ones until the store is within its limits
+        now = time.monotonic()
+        memory = sum(self._sizes.values())
+        while self._finished:
+            response_id, finished = next(iter(self._finished.items()))
+            expired = 0 < self._ttl < now - finished
+            over_count = 0 < self._max_results < len(self._finished)
+            over_memory = 0 < self._max_memory < memory
+            if not expired and not over_count and not over_memory:
+                break
+            del self._finished[response_id]
+            memory -= self._sizes.pop(response_id)
+            self._results.pop(response_id, None)
+
+    def get(self, response_id: str) -> Union[dict, None]:
+        with self._lock:
+            self._evict()
+            entry = self._results.get(response_id)
+            return dict(entry) if entry else None
+
+    @property
+    def last(self) -> Union[dict, None]:
+        return self._last
+
+    @property
+    def info(self) -> dict:
+        with self._lock:
+            self._evict()
+            return {"results": len(self._finished),
+                    "pending": len(self._results) - len(self._finished),
+                    "memory_bytes": sum(self._sizes.values()),
+                    "max_results": self._max_results,
+                    "max_memory_bytes": self._max_memory,
+                    "ttl": self._ttl}
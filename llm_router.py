@@ -0,0 +1,588 @@
+import json
+import math
+import time
+import bisect
+import hashlib
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from typing import Union
+
+import pyfiglet
+import requests
+import uvicorn
+from pydantic import BaseModel, typing
+from fastapi import FastAPI, HTTPException, Header, Body, status
+from fastapi.responses import StreamingResponse, Response
+
+
+class ReturnData(BaseModel):
+    name: str
+    detail: typing.Any
+
+
+class Backend:
+    """An llm_rest_server the router sends contexts to, and what the health checks learned about it."""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+        self.healthy = False
+        self.draining = False
+        self.failures = 0
+        self.directives = 0
+        self.contexts = 0
+        self.moved = 0
+        self.last_check = 0.0
+        self.error = ""
+
+    @property
+    def load(self) -> int:
+        # Contexts placed on the backend plus its queued and running directives
+        return self.contexts + self.directives
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and not self.draining
+
+    def as_dict(self) -> dict:
+        return {"url": self.url,
+                "healthy": self.healthy,
+                "draining": self.draining,
+                "contexts": self.contexts,
+                "directives": self.directives,
+                "load": self.load,
+                "moved": self.moved,
+                "failures": self.failures,
+                "error": self.error}
+
+
+class HashRing:
+    """Consistent hash ring of the backends, each placed at a number of points (virtual nodes) on it."""
+
+    replicas = 64
+
+    def __init__(self, urls: list):
+        self._points = []
+        self._owners = {}
+        for url in urls:
+            for replica in range(self.replicas):
+                point = self._hash("{}#{}".format(url, replica))
+                self._points.append(point)
+                self._owners[point] = url
+        self._points.sort()
+        self._count = len(urls)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def walk(self, key: str):
+        # The backends in ring order from the key's position (its owner first)
+        seen = set()
+        start = bisect.bisect(self._points, self._hash(key))
+        for index in range(len(self._points)):
+            url = self._owners[self._points[(start + index) % len(self._points)]]
+            if url not in seen:
+                seen.add(url)
+                yield url
+                if len(seen) == self._count:
+                    return
+
+
+class ContextRouter:
+    """Context placement across several llm_rest_server backends.
+
+    A context lives on one backend, so its history and KV cache stay local,
+    and all its requests go there. A new context goes to the first backend
+    along the consistent hash ring of its name whose load is within the
+    load factor of the average (consistent hashing with bounded loads),
+    so placement follows the hash while the nodes are balanced and the
+    least loaded nodes otherwise. Forks go to their parent's backend.
+
+    The backends are health checked in the background. A drained backend
+    gets no new contexts and its contexts are moved, once idle, to the
+    other backends through their snapshots (export, import, delete).
+    """
+
+    # Seconds to wait for a backend answer (streams only wait for the connection)
+    request_timeout = 30.0
+
+    # Seconds between attempts to move the busy contexts of a drained backend
+    drain_retry = 1.0
+
+    # Number of response ids remembered to route cancellations and timing lookups
+    max_responses = 4096
+
+    def __init__(self, urls: list, health_interval: float = 2.0, load_factor: float = 1.25):
+        self._backends = OrderedDict((backend.url, backend) for backend in (Backend(url) for url in urls))
+        self._ring = HashRing(list(self._backends))
+        self._health_interval = health_interval
+        self._load_factor = load_factor
+        self._placements = {}
+        self._responses = OrderedDict()
+        self._lock = threading.RLock()
+        self._running = True
+
+        self.check_health()
+        self.sync_contexts()
+        self._health_thread = threading.Thread(target=self._health_worker, daemon=True)
+        self._health_thread.start()
+
+    def shutdown(self):
+        self._running = False
+
+    # Backends
+    def backend(self, url: str) -> Union[Backend, None]:
+        return self._backends.get(url.rstrip('/'))
+
+    @property
+    def backends(self) -> list:
+        return list(self._backends.values())
+
+    def _health_worker(self):
+        while self._running:
+            time.sleep(self._health_interval)
+            self.check_health()
+
+    def check_health(self):
+        for backend in self.backends:
+            try:
+                resp = requests.get(backend.url + "/llm/queue", timeout=self._health_interval)
+                resp.raise_for_status()
+                backend.directives = self._directives(resp.json()['detail'])
+                if not backend.healthy:
+                    logging.info("Backend '{}' is up".format(backend.url))
+                backend.healthy = True
+                backend.failures = 0
+                backend.error = ""
+            except (requests.RequestException, ValueError, KeyError) as ex:
+                self.mark_failed(backend, str(ex))
+            backend.last_check = time.time()
+
+    @staticmethod
+    def _directives(queue_info: dict) -> int:
+        # Queued and running directives (summed over the model workers of the backend)
+        infos = queue_info.get('workers', [queue_info])
+        return sum(info.get('queued', 0) + info.get('running', 0) for info in infos)
+
+    def mark_failed(self, backend: Backend, error: str):
+        if backend.healthy:
+            logging.error("Backend '{}' is down: {}".format(backend.url, error))
+        backend.healthy = False
+        backend.failures += 1
+        backend.error = error
+
+    def sync_contexts(self):
+        # Learn where the existing contexts are (the first backend listing a context keeps it)
+        for backend in self.backends:
+            if backend.healthy:
+                try:
+                    names = requests.get(backend.url + "/llm/list", timeout=self.request_timeout).json()['detail']
+                except (requests.RequestException, ValueError, KeyError):
+                    continue
+                with self._lock:
+                    for name in names:
+                        self._placements.setdefault(name, backend.url)
+        self._count_contexts()
+
+    def _count_contexts(self):
+        with self._lock:
+            for backend in self.backends:
+                backend.contexts = sum(1 for url in self._placements.values() if url == backend.url)
+
+    # Contexts
+    def place(self, context_name: str) -> Union[Backend, None]:
+        # Backend for a new context: along the ring, the first one within the load bound
+        available = [backend for backend in self.backends if backend.available]
+        if not available:
+            return None
+
+        limit = max(1, math.ceil(self._load_factor * (sum(backend.load for backend in available) + 1) /
+                                 len(available)))
+        for url in self._ring.walk(context_name):
+            backend = self._backends[url]
+            if backend.available and backend.load < limit:
+                return backend
+        return min(available, key=lambda item: item.load)
+
+    def locate(self, context_name: str) -> Union[Backend, None]:
+        # Backend holding a context, asking the backends (ring order) about contexts it has not seen
+        with self._lock:
+            url = self._placements.get(context_name)
+        if url:
+            return self._backends[url]
+
+        for url in self._ring.walk(context_name):
+            backend = self._backends[url]
+            if not backend.healthy:
+                continue
+            try:
+                resp = requests.get(backend.url + "/context/info/" + context_name, timeout=self.request_timeout)
+            except requests.RequestException:
+                continue
+            if resp.status_code == 200:
+                self.assign(context_name, backend)
+                return backend
+        return None
+
+    def assign(self, context_name: str, backend: Backend):
+        with self._lock:
+            self._placements[context_name] = backend.url
+        self._count_contexts()
+
+    def forget(self, context_name: str):
+        with self._lock:
+            self._placements.pop(context_name, None)
+        self._count_contexts()
+
+    def remember_response(self, response_id: str, backend: Backend):
+        with self._lock:
+            self._responses[response_id] = backend.url
+            while len(self._responses) > self.max_responses:
+                self._responses.popitem(last=False)
+
+    def response_backend(self, response_id: str) -> Union[Backend, None]:
+        with self._lock:
+            url = self._responses.get(response_id)
+        return self._backends[url] if url else None
+
+    # Draining
+    def drain(self, backend: Backend):
+        if backend.draining:
+            return
+        backend.draining = True
+        logging.info("Draining backend '{}'".format(backend.url))
+        threading.Thread(target=self._drain_worker, args=(backend,), daemon=True).start()
+
+    def undrain(self, backend: Backend):
+        backend.draining = False
+        logging.info("Backend '{}' takes new contexts again".format(backend.url))
+
+    def _drain_worker(self, backend: Backend):
+        while self._running and backend.draining:
+            with self._lock:
+                names = [name for name, url in self._placements.items() if url == backend.url]
+            if not names:
+                logging.info("Backend '{}' is drained".format(backend.url))
+                return
+
+            for name in names:
+                if backend.draining:
+                    self._move(name, backend)
+            time.sleep(self.drain_retry)
+
+    def _move(self, context_name: str, source: Backend) -> bool:
+        # Move an idle context through its snapshot, busy ones are tried again later
+        target = self.place(context_name)
+        if target is None:
+            return False
+
+        try:
+            resp = requests.get(source.url + "/context/export/" + context_name, timeout=self.request_timeout)
+            if resp.status_code != 200:
+                if 'does not exist' in resp.text:
+                    self.forget(context_name)
+                return False
+
+            snapshot = resp.json()['detail']
+            resp = requests.post(target.url + "/context/import/" + context_name, json=snapshot,
+                                 timeout=self.request_timeout)
+            if resp.status_code != 200:
+                logging.error("Unable to move context '{}' to '{}': {}".format(context_name, target.url, resp.text))
+                return False
+
+            self.assign(context_name, target)
+            requests.delete(source.url + "/context/" + context_name, timeout=self.request_timeout)
+        except (requests.RequestException, ValueError, KeyError) as ex:
+            logging.error("Unable to move context '{}': {}".format(context_name, ex))
+            return False
+
+        source.moved += 1
+        logging.info("Moved context '{}' from '{}' to '{}'".format(context_name, source.url, target.url))
+        return True
+
+
+# creating a fast application
+app = FastAPI()
+
+
+def _router() -> ContextRouter:
+    return app.extra['router']
+
+
+def _forward(backend: Backend, method: str, path: str, json=None, params=None, headers=None,
+             timeout: float = 0.0) -> Response:
+    # Relay a request to a backend and its answer (status, body and Retry-After) back to the client
+    try:
+        resp = requests.request(method, backend.url + path, json=json, params=params, headers=headers,
+                                timeout=_router().request_timeout + timeout)
+    except requests.RequestException as ex:
+        _router().mark_failed(backend, str(ex))
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Backend '{}' is unavailable".format(backend.url))
+
+    relay_headers = {"Retry-After": resp.headers["Retry-After"]} if "Retry-After" in resp.headers else None
+    return Response(content=resp.content, status_code=resp.status_code, headers=relay_headers,
+                    media_type=resp.headers.get('content-type'))
+
+
+def _context_backend(name: str) -> Backend:
+    backend = _router().locate(name)
+    if backend is None:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Context '{}' does not exist".format(name))
+    if not backend.healthy:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Backend '{}' of context '{}' is down".format(backend.url, name))
+    return backend
+
+
+def _all_backends(method: str, path: str, params=None) -> dict:
+    # Answers of every healthy backend by URL
+    details = {}
+    for backend in _router().backends:
+        if backend.healthy:
+            try:
+                resp = requests.request(method, backend.url + path, params=params,
+                                        timeout=_router().request_timeout)
+                details[backend.url] = resp.json().get('detail')
+            except (requests.RequestException, ValueError) as ex:
+                _router().mark_failed(backend, str(ex))
+    return details
+
+
+@app.get("/router/backends")
+def backends_info() -> ReturnData:
+    return ReturnData(name="router", detail=[backend.as_dict() for backend in _router().backends])
+
+
+@app.post("/router/drain")
+def drain_backend(backend: str) -> ReturnData:
+    node = _router().backend(backend)
+    if node is None:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Unknown backend '{}'".format(backend))
+    _router().drain(node)
+    return ReturnData(name="router", detail="Draining backend '{}'".format(node.url))
+
+
+@app.post("/router/undrain")
+def undrain_backend(backend: str) -> ReturnData:
+    node = _router().backend(backend)
+    if node is None:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Unknown backend '{}'".format(backend))
+    _router().undrain(node)
+    return ReturnData(name="router", detail="Backend '{}' takes new contexts".format(node.url))
+
+
+@app.post("/llm/restart")
+def restart_llm() -> ReturnData:
+    return ReturnData(name="llm", detail=_all_backends('POST', "/llm/restart"))
+
+
+@app.post("/llm/shutdown")
+def shutdown_llm() -> ReturnData:
+    return ReturnData(name="llm", detail=_all_backends('POST', "/llm/shutdown"))
+
+
+@app.get("/llm/list")
+def list_contexts() -> ReturnData:
+    names = []
+    for backend_names in _all_backends('GET', "/llm/list").values():
+        names += [name for name in backend_names or [] if name not in names]
+    return ReturnData(name="llm", detail=names)
+
+
+@app.get("/llm/info")
+def model_info() -> ReturnData:
+    return ReturnData(name="llm", detail=_all_backends('GET', "/llm/info"))
+
+
+@app.get("/llm/contexts")
+def context_registry_info() -> ReturnData:
+    return ReturnData(name="llm", detail=_all_backends('GET', "/llm/contexts"))
+
+
+@app.get("/llm/models")
+def models_info() -> ReturnData:
+    return ReturnData(name="llm", detail=_all_backends('GET', "/llm/models"))
+
+
+@app.get("/llm/queue")
+def queue_info() -> ReturnData:
+    return ReturnData(name="llm", detail=_all_backends('GET', "/llm/queue"))
+
+
+@app.get("/llm/usage")
+def tenant_usage(tenant: Union[str, None] = None) -> ReturnData:
+    return ReturnData(name="llm", detail=_all_backends('GET', "/llm/usage", {"tenant": tenant} if tenant else None))
+
+
+@app.post("/context/{name}")
+def create_context(name: str, cspec: dict = Body(default={})):
+    backend = _router().locate(name)
+    if backend is None:
+        backend = _router().place(name)
+        if backend is None:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="No backend available for context '{}'".format(name))
+
+    resp = _forward(backend, 'POST', "/context/" + name, json=cspec)
+    if resp.status_code == 200:
+        _router().assign(name, backend)
+    return resp
+
+
+@app.post("/context/fork/{name}")
+def fork_context(name: str, fspec: dict = Body(default={})):
+    # The fork shares its parent's backend (and history/KV state there)
+    backend = _context_backend(fspec.get('parent', ''))
+    resp = _forward(backend, 'POST', "/context/fork/" + name, json=fspec)
+    if resp.status_code == 200:
+        _router().assign(name, backend)
+    return resp
+
+
+@app.delete("/context/{name}")
+def delete_context(name: str):
+    resp = _forward(_context_backend(name), 'DELETE', "/context/" + name)
+    if resp.status_code == 200:
+        _router().forget(name)
+    return resp
+
+
+@app.put("/context/{name}")
+def submit_directive(name: str, predict: dict = Body(default={}), x_tenant: Union[str, None] = Header(default=None)):
+    backend = _context_backend(name)
+    resp = _forward(backend, 'PUT', "/context/" + name, json=predict,
+                    headers={"X-Tenant": x_tenant} if x_tenant else None)
+    if resp.status_code == 200:
+        _router().remember_response(json.loads(resp.body)["detail"], backend)
+    return resp
+
+
+@app.get('/context/{name}')
+def stream_response(name: str):
+    backend = _context_backend(name)
+    try:
+        resp = requests.get(backend.url + "/context/" + name, stream=True, timeout=(_router().request_timeout, None))
+    except requests.RequestException as ex:
+        _router().mark_failed(backend, str(ex))
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Backend '{}' is unavailable".format(backend.url))
+    if resp.status_code != 200:
+        with resp:
+            return Response(content=resp.content, status_code=resp.status_code,
+                            media_type=resp.headers.get('content-type'))
+
+    def relay():
+        # One chunk per word, as the backend sent them
+        with resp:
+            for chunk in resp.iter_content(chunk_size=None):
+                yield chunk
+
+    return StreamingResponse(relay(), media_type='text/event-stream')
+
+
+@app.get('/context/info/{name}')
+def get_context_info(name: str):
+    return _forward(_context_backend(name), 'GET', "/context/info/" + name)
+
+
+@app.put("/context/template/{name}")
+def load_template(name: str, cspec: dict = Body(default={})):
+    return _forward(_context_backend(name), 'PUT', "/context/template/" + name, json=cspec)
+
+
+@app.get("/context/template/{name}")
+def get_template(name: str):
+    return _forward(_context_backend(name), 'GET', "/context/template/" + name)
+
+
+@app.put("/context/prompt/{name}")
+def set_system_prompt(name: str, cspec: dict = Body(default={})):
+    return _forward(_context_backend(name), 'PUT', "/context/prompt/" + name, json=cspec)
+
+
+@app.patch("/context/history/{name}")
+def clear_context(name: str):
+    return _forward(_context_backend(name), 'PATCH', "/context/history/" + name)
+
+
+@app.get("/context/history/{name}")
+def get_context_history(name: str):
+    return _forward(_context_backend(name), 'GET', "/context/history/" + name)
+
+
+@app.get("/context/export/{name}")
+def export_context(name: str):
+    return _forward(_context_backend(name), 'GET', "/context/export/" + name)
+
+
+def _response_forward(method: str, path: str, resp_id: str, params=None, timeout: float = 0.0):
+    # The backend that answered the directive, or else the first one that knows the response
+    # (asked without waiting, only that one is long-polled)
+    backend = _router().response_backend(resp_id)
+    if backend is None:
+        probe_params = dict(params, wait=0) if timeout else params
+        resp = None
+        for candidate in _router().backends:
+            if not candidate.healthy:
+                continue
+            try:
+                resp = _forward(candidate, method, path + resp_id, params=probe_params)
+            except HTTPException:
+                continue
+            if resp.status_code == 200:
+                _router().remember_response(resp_id, candidate)
+                backend = candidate
+                break
+
+        if resp is None:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="No backend available")
+        if backend is None or not timeout:
+            return resp
+    return _forward(backend, method, path + resp_id, params=params, timeout=timeout)
+
+
+@app.get("/response/{resp_id}")
+def get_response(resp_id: str, wait: float = 0.0):
+    return _response_forward('GET', "/response/", resp_id, {"wait": wait}, wait)
+
+
+@app.get("/llm/results")
+def results_info() -> ReturnData:
+    return ReturnData(name="llm", detail=_all_backends('GET', "/llm/results"))
+
+
+@app.get("/response/timing/{resp_id}")
+def get_response_timing(resp_id: str):
+    return _response_forward('GET', "/response/timing/", resp_id)
+
+
+@app.post("/response/cancel/{resp_id}")
+def cancel_response(resp_id: str):
+    return _response_forward('POST', "/response/cancel/", resp_id)
+
+
+if __name__ == "__main__":
+    print(pyfiglet.figlet_format("LLM Router"))
+
+    logging.basicConfig(level=logging.INFO)
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("backends", nargs='+', help="URLs of the llm_rest_server backends (http://host:port)")
+    ap.add_argument("-p", "--port", type=int, default=8000, help="router port")
+    ap.add_argument("--health_interval", type=float, default=2.0, help="seconds between backend health checks")
+    ap.add_argument("--load_factor", type=float, default=1.25,
+                    help="most load a backend takes new contexts at, relative to the average")
+    args = vars(ap.parse_args())
+
+    app.extra['router'] = ContextRouter(args['backends'], args['health_interval'], args['load_factor'])
+
+    # Start the web server
+    uvicorn.run(app, host='0.0.0.0', port=args['port'], log_level='info')
+
+    app.extra['router'].shutdown()
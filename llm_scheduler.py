@@ -0,0 +1,411 @@
+import math
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Union
+
+
+class QueueFull(Exception):
+    """Raised when a directive is not admitted because the queue (or the context's share of it) is full."""
+
+    def __init__(self, msg: str, retry_after: int):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        # Raised again on the other side of a worker pipe
+        return QueueFull, (str(self), self.retry_after)
+
+
+class TokenBucket:
+    """Token allowance refilled at a fixed rate up to a burst size.
+
+    Usage is only known once a directive is done, so spending may take the
+    bucket below zero; the tenant then waits until it is paid back.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self._rate = rate
+        self._burst = burst
+        self._level = burst
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self._burst, self._level + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def spend(self, tokens: float):
+        self._refill()
+        self._level -= tokens
+
+    def wait_time(self) -> float:
+        # Seconds until there is something left to spend
+        self._refill()
+        return 0.0 if self._level > 0 else (1.0 - self._level) / self._rate
+
+    @property
+    def level(self) -> float:
+        self._refill()
+        return self._level
+
+
+class DirectiveScheduler:
+    """Queue of the directives waiting for the model.
+
+    Unlike a plain queue, a waiting directive can be looked up and taken out
+    again by its response id (cancellation), and the worker blocks until work
+    arrives instead of polling.
+
+    Directives wait in priority lanes (interactive before batch). A lower
+    lane directive that has waited longer than the aging time is served
+    ahead of the higher lanes, so batch work is slowed down but never starved.
+
+    Within a lane the cheapest directive goes first (shortest job first), the
+    cost being its prompt tokens (weighted, prefill is much faster per token
+    than decoding) plus the most tokens it may generate. Waiting lowers a
+    directive's cost so expensive ones still get their turn, and directives
+    about to miss their deadline go ahead of the rest. Directives past their
+    deadline are handed back as expired without being run.
+
+    Directives belong to tenants. Within a lane the tenants share the model
+    by weighted fair queuing: the tenant whose next directive would finish
+    first in virtual time (cost divided by the tenant's weight) goes next.
+    With a tenant rate, each tenant also has a token bucket charged with the
+    prompt and generated tokens of its directives, and a tenant in debt is
+    not admitted until the bucket has refilled.
+
+    The queue can be bounded globally and per context (a limit of 0 disables
+    that limit). Directives over a limit are rejected right away with an
+    estimate of when there will be room, based on the observed service time
+    of the directives, instead of waiting longer than the client will.
+
+    With several workers, a context's directives still run one at a time:
+    the directives of a context that is running are passed over until the
+    worker reports it done.
+    """
+
+    # Lanes in the order they are served
+    lanes = ('interactive', 'batch')
+
+    # Weight of the latest directive in the average service and wait times
+    service_smoothing = 0.2
+
+    # Cost of a prompt token relative to a generated token
+    prefill_weight = 0.1
+
+    # Cost (in generated tokens) taken off a directive for every second it waits
+    cost_aging = 20.0
+
+    # Seconds an unconfigured tenant with nothing queued and a full bucket is remembered, and between checks
+    tenant_idle = 600.0
+    tenant_sweep = 10.0
+
+    # A directive is urgent once its deadline is within this many service times
+    urgent_services = 2.0
+
+    def __init__(self, max_queued: int = 0, max_queued_per_context: int = 0, aging: float = 30.0,
+                 tenant_rate: float = 0.0, tenant_burst: float = 0.0, tenant_weights: Union[dict, None] = None):
+        self._max_queued = max_queued
+        self._max_queued_per_context = max_queued_per_context
+        self._aging = aging
+        self._tenant_rate = tenant_rate
+        # Ten seconds worth of tokens unless a burst size is given
+        self._tenant_burst = tenant_burst if tenant_burst > 0 else tenant_rate * 10
+        self._tenant_weights = tenant_weights or {}
+        self._tenants = {}
+        self._tenants_swept = 0.0
+        self._virtual_time = 0.0
+        self._lanes = {lane: deque() for lane in self.lanes}
+        self._busy = set()
+        self._lane_stats = {lane: {"served": 0, "aged": 0, "rejected": 0, "expired": 0,
+                                   "wait_seconds": None, "max_wait_seconds": 0.0}
+                            for lane in self.lanes}
+        self._ready = threading.Condition()
+        self._service_time = None
+        self._completed = 0
+        self._rejected = 0
+
+    def put(self, directive):
+        if directive.priority not in self._lanes:
+            raise ValueError("Unknown priority '{}'".format(directive.priority))
+
+        with self._ready:
+            self._admit(directive)
+            self._lanes[directive.priority].append(directive)
+            self._ready.notify()
+
+    def _queued(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def _ahead(self, directive) -> int:
+        # Rough number of directives served before this one (the higher lanes and the earlier arrivals in its lane)
+        count = 0
+        for lane in self.lanes:
+            if lane == directive.priority:
+                return count + self._lanes[lane].index(directive)
+            count += len(self._lanes[lane])
+        return count
+
+    def configured_tenant(self, name: str) -> bool:
+        return name in self._tenant_weights
+
+    def _tenant(self, name: str) -> dict:
+        now = time.monotonic()
+        tenant = self._tenants.get(name)
+        if tenant is None:
+            self._forget_idle_tenants(now)
+            tenant = {"weight": float(self._tenant_weights.get(name, 1.0)),
+                      "bucket": TokenBucket(self._tenant_rate, self._tenant_burst) if self._tenant_rate > 0 else None,
+                      "finish": 0.0, "directives": 0, "prompt_tokens": 0, "completion_tokens": 0, "rejected": 0}
+            self._tenants[name] = tenant
+        tenant['used'] = now
+        return tenant
+
+    def _forget_idle_tenants(self, now: float):
+        # Tenants come from the clients, so the idle ones are dropped (a tenant with a full bucket starts over
+        # the same way, only its usage counts are lost)
+        if now - self._tenants_swept < self.tenant_sweep:
+            return
+        self._tenants_swept = now
+
+        queued = {directive.tenant for lane in self._lanes.values() for directive in lane}
+        for name, tenant in list(self._tenants.items()):
+            if name in queued or name in self._tenant_weights or now - tenant['used'] < self.tenant_idle \
+                    or (tenant['bucket'] and tenant['bucket'].level < self._tenant_burst):
+                continue
+            del self._tenants[name]
+
+    def _admit(self, directive):
+        # Raises QueueFull with an estimate of when there will be room
+        tenant = self._tenant(directive.tenant)
+        if tenant['bucket'] and tenant['bucket'].wait_time() > 0:
+            tenant['rejected'] += 1
+            self._reject(directive.priority, "Tenant '{}' is over its token rate".format(directive.tenant),
+                         max(1, math.ceil(tenant['bucket'].wait_time())))
+
+        queued = self._queued()
+        if 0 < self._max_queued <= queued:
+            self._reject(directive.priority, "Directive queue is full ({} waiting)".format(queued),
+                         self.retry_after(queued - self._max_queued + 1))
+
+        if self._max_queued_per_context > 0:
+            waiting = [queued_directive for lane in self._lanes.values() for queued_directive in lane
+                       if queued_directive.context_name == directive.context_name]
+            if len(waiting) >= self._max_queued_per_context:
+                # The context gets a slot back once its first waiting directive has run
+                first = min(self._ahead(queued_directive) for queued_directive in waiting)
+                self._reject(directive.priority,
+                             "Context '{}' has {} directives waiting".format(directive.context_name, len(waiting)),
+                             self.retry_after(first + 1))
+
+    def _reject(self, lane: str, msg: str, retry_after: int):
+        self._rejected += 1
+        self._lane_stats[lane]['rejected'] += 1
+        raise QueueFull(msg, retry_after)
+
+    def retry_after(self, directives: int = 1) -> int:
+        # Seconds for the given number of directives to run at the observed throughput
+        service_time = self._service_time if self._service_time is not None else 1.0
+        return max(1, math.ceil(directives * service_time))
+
+    def record_service(self, seconds: float):
+        # Service time (start to end) of a directive that left the model
+        with self._ready:
+            self._service_time = self._smooth(self._service_time, seconds)
+            self._completed += 1
+
+    def record_usage(self, directive, prompt_tokens: int, completion_tokens: int):
+        # Charge the tenant for what the directive actually used
+        with self._ready:
+            tenant = self._tenant(directive.tenant)
+            tenant['directives'] += 1
+            tenant['prompt_tokens'] += prompt_tokens
+            tenant['completion_tokens'] += completion_tokens
+            if tenant['bucket']:
+                tenant['bucket'].spend(prompt_tokens + completion_tokens)
+
+            # The fair share was charged with the estimate, settle the difference
+            used = prompt_tokens * self.prefill_weight + completion_tokens
+            tenant['finish'] += (used - self.cost(directive)) / tenant['weight']
+
+    def _smooth(self, average: Union[float, None], value: float) -> float:
+        return value if average is None else average + self.service_smoothing * (value - average)
+
+    def cost(self, directive) -> float:
+        return directive.prompt_tokens * self.prefill_weight + directive.max_tokens
+
+    def _runnable(self, lane: str) -> list:
+        # The lane's directives whose context is not running
+        return [directive for directive in self._lanes[lane] if directive.context_name not in self._busy]
+
+    def _next_lane(self, now: float) -> (Union[str, None], bool):
+        # The highest lane with work, unless a lower lane's oldest directive has waited past the aging time
+        first = None
+        for lane in self.lanes:
+            queue = self._runnable(lane)
+            if queue:
+                if first is None:
+                    first = lane
+                elif self._aging > 0 and now - min(directive.submitted for directive in queue) > self._aging:
+                    self._lane_stats[lane]['aged'] += 1
+                    return lane, True
+        return first, False
+
+    def _oldest(self, lane: str) -> float:
+        return min(directive.submitted for directive in self._lanes[lane])
+
+    def _pick(self, lane: str, aged: bool, now: float):
+        queue = self._runnable(lane)
+        if aged:
+            # The lane got its turn because of its oldest directive
+            return min(queue, key=lambda directive: directive.submitted)
+
+        # Earliest deadline among the urgent directives first
+        urgent_window = self.urgent_services * (self._service_time if self._service_time is not None else 1.0)
+        urgent = [directive for directive in queue if directive.deadline and directive.deadline - now < urgent_window]
+        if urgent:
+            return min(urgent, key=lambda directive: directive.deadline)
+
+        # The lowest (aged) cost directive of each tenant
+        candidates = {}
+        for directive in queue:
+            aged_cost = self.cost(directive) - self.cost_aging * (now - directive.submitted)
+            if directive.tenant not in candidates or aged_cost < candidates[directive.tenant][0]:
+                candidates[directive.tenant] = (aged_cost, directive)
+
+        # and of those the one that would finish first in virtual time
+        return min((directive for _cost, directive in candidates.values()), key=self._finish_tag)
+
+    def _finish_tag(self, directive) -> float:
+        tenant = self._tenant(directive.tenant)
+        return max(self._virtual_time, tenant['finish']) + self.cost(directive) / tenant['weight']
+
+    def _charge_share(self, directive):
+        # The directive starts at the later of the virtual time and its tenant's last finish
+        tenant = self._tenant(directive.tenant)
+        start = max(self._virtual_time, tenant['finish'])
+        tenant['finish'] = start + self.cost(directive) / tenant['weight']
+        self._virtual_time = start
+
+    def take_expired(self) -> list:
+        # Take the directives whose deadline has passed out of the queue
+        with self._ready:
+            now = time.monotonic()
+            expired = []
+            for lane, queue in self._lanes.items():
+                for directive in [directive for directive in queue if directive.deadline and directive.deadline < now]:
+                    queue.remove(directive)
+                    self._lane_stats[lane]['expired'] += 1
+                    expired.append(directive)
+            return expired
+
+    def get(self, timeout: Union[float, None] = None):
+        # Next directive to run, or None if nothing arrived within the timeout
+        # The directive's context counts as running until done() is called for it
+        with self._ready:
+            if not any(self._runnable(lane) for lane in self.lanes):
+                self._ready.wait(timeout)
+
+            now = time.monotonic()
+            lane, aged = self._next_lane(now)
+            if lane is None:
+                return None
+
+            directive = self._pick(lane, aged, now)
+            self._lanes[lane].remove(directive)
+            self._busy.add(directive.context_name)
+            self._charge_share(directive)
+            stats = self._lane_stats[lane]
+            wait = now - directive.submitted
+            stats['served'] += 1
+            stats['wait_seconds'] = self._smooth(stats['wait_seconds'], wait)
+            stats['max_wait_seconds'] = max(stats['max_wait_seconds'], wait)
+            return directive
+
+    def done(self, context_name: str):
+        # The context's directive finished, so its next one can run
+        with self._ready:
+            self._busy.discard(context_name)
+            self._ready.notify()
+
+    @contextmanager
+    def paused(self):
+        # No directive is handed out (or reported done) while in here, the set of running contexts holds still
+        with self._ready:
+            yield set(self._busy)
+
+    def remove(self, response_id: str):
+        # Take a waiting directive out of the queue (None if it is not waiting)
+        with self._ready:
+            for lane in self._lanes.values():
+                for directive in lane:
+                    if directive.response_id == response_id:
+                        lane.remove(directive)
+                        return directive
+            return None
+
+    def waiting(self, context_name: Union[str, None] = None) -> list:
+        # Response ids of the waiting directives (of one context or all of them)
+        with self._ready:
+            return [directive.response_id for lane in self._lanes.values() for directive in lane
+                    if context_name is None or directive.context_name == context_name]
+
+    def clear(self) -> list:
+        with self._ready:
+            directives = [directive for lane in self._lanes.values() for directive in lane]
+            for lane in self._lanes.values():
+                lane.clear()
+            self._busy.clear()
+            return directives
+
+    def __len__(self):
+        return self._queued()
+
+    def usage(self, tenant_name: Union[str, None] = None) -> dict:
+        # Token usage, bucket level and fair share weight of every tenant (or of one)
+        with self._ready:
+            queued = {}
+            for lane in self._lanes.values():
+                for directive in lane:
+                    queued[directive.tenant] = queued.get(directive.tenant, 0) + 1
+
+            usage = {}
+            for name, tenant in self._tenants.items():
+                if tenant_name is None or name == tenant_name:
+                    usage[name] = {"weight": tenant['weight'],
+                                   "queued": queued.get(name, 0),
+                                   "directives": tenant['directives'],
+                                   "prompt_tokens": tenant['prompt_tokens'],
+                                   "completion_tokens": tenant['completion_tokens'],
+                                   "rejected": tenant['rejected'],
+                                   "bucket_tokens": round(tenant['bucket'].level, 1) if tenant['bucket'] else None,
+                                   "tokens_per_second": self._tenant_rate}
+            return usage
+
+    @property
+    def info(self) -> dict:
+        with self._ready:
+            now = time.monotonic()
+            lanes = {}
+            for lane, stats in self._lane_stats.items():
+                queue = self._lanes[lane]
+                lanes[lane] = {"queued": len(queue),
+                               "oldest_seconds": round(now - self._oldest(lane), 3) if queue else 0.0,
+                               "served": stats['served'],
+                               "aged": stats['aged'],
+                               "rejected": stats['rejected'],
+                               "expired": stats['expired'],
+                               "wait_seconds": round(stats['wait_seconds'], 3)
+                               if stats['wait_seconds'] is not None else None,
+                               "max_wait_seconds": round(stats['max_wait_seconds'], 3)}
+
+            return {"queued": self._queued(),
+                    "max_queued": self._max_queued,
+                    "max_queued_per_context": self._max_queued_per_context,
+                    "aging_seconds": self._aging,
+                    "completed": self._completed,
+                    "rejected": self._rejected,
+                    "service_seconds": round(self._service_time, 3) if self._service_time is not None else None,
+                    "lanes": lanes}
@@ -0,0 +1,140 @@
+import time
+import logging
+import threading
+from abc import abstractmethod
+
+import numpy as np
+import llama_cpp
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+
+def vocab_size(model_path: str) -> int:
+    # Only the vocabulary is loaded
+    return llama_cpp.Llama(model_path=model_path, vocab_only=True, verbose=False).n_vocab()
+
+
+class SpeculativeDraft(LlamaDraftModel):
+    """Draft tokens for llama-cpp-python's speculative decoding, counting how many of them the model accepts.
+
+    The model evaluates its last token and the draft in one pass and keeps the drafted tokens it would
+    have sampled itself, so the output is the same as without a draft. It then asks for the next draft
+    with the tokens it kept: the part of the previous draft found after the previous input is the part
+    that was accepted.
+    """
+
+    method = ''
+
+    def __init__(self, num_pred_tokens: int):
+        self.num_pred_tokens = num_pred_tokens
+        self._previous = None
+        self._lock = threading.Lock()
+        self._drafts = 0
+        self._drafted = 0
+        self._accepted = 0
+        self._draft_time = 0.0
+
+    @abstractmethod
+    def _draft(self, input_ids: np.ndarray) -> np.ndarray:
+        pass
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs) -> np.ndarray:
+        self._measure(input_ids)
+
+        start = time.monotonic()
+        draft = self._draft(input_ids)
+        elapsed = time.monotonic() - start
+
+        # input_ids is a view of the model's token buffer, which is overwritten later
+        self._previous = (np.array(input_ids), draft) if len(draft) else None
+        with self._lock:
+            self._draft_time += elapsed
+        return draft
+
+    def _measure(self, input_ids: np.ndarray):
+        if self._previous is None:
+            return
+        previous, draft = self._previous
+        self._previous = None
+
+        # A different prefix means the previous generation ended right after the draft
+        n = len(previous)
+        if len(input_ids) <= n or not np.array_equal(input_ids[:n], previous):
+            return
+
+        kept = input_ids[n:n + len(draft)]
+        mismatches = np.nonzero(kept != draft[:len(kept)])[0]
+        accepted = int(mismatches[0]) if len(mismatches) else len(kept)
+        with self._lock:
+            self._drafts += 1
+            self._drafted += len(draft)
+            self._accepted += accepted
+
+    @property
+    def info(self) -> dict:
+        with self._lock:
+            return {"method": self.method,
+                    "num_pred_tokens": self.num_pred_tokens,
+                    "drafts": self._drafts,
+                    "drafted_tokens": self._drafted,
+                    "accepted_tokens": self._accepted,
+                    "acceptance_rate": round(self._accepted / self._drafted, 3) if self._drafted else 0.0,
+                    "draft_time": round(self._draft_time, 3)}
+
+
+class PromptLookupDraft(SpeculativeDraft):
+    """Drafts the tokens that followed the latest earlier occurrence of the last n-gram (no second model).
+
+    Pays off when the answer repeats the prompt (extraction, summaries, code edits).
+    """
+
+    method = 'lookup'
+
+    def __init__(self, num_pred_tokens: int = 10, max_ngram_size: int = 3):
+        super().__init__(num_pred_tokens)
+        self.max_ngram_size = max_ngram_size
+
+    def _draft(self, input_ids: np.ndarray) -> np.ndarray:
+        return LlamaPromptLookupDecoding.find_candidate_pred_tokens(input_ids, self.max_ngram_size,
+                                                                    self.num_pred_tokens)
+
+
+class ModelDraft(SpeculativeDraft):
+    """Drafts tokens greedily with a small model sharing the main model's vocabulary.
+
+    The draft model keeps its own KV cache of the longest prefix it shares with the main model's
+    tokens, so only the tokens kept since the previous draft are evaluated again.
+    """
+
+    method = 'model'
+
+    def __init__(self, model_path: str, num_pred_tokens: int = 4, n_ctx: int = 2048, n_gpu_layers: int = 0,
+                 verbose: bool = False):
+        super().__init__(num_pred_tokens)
+        self.model_path = model_path
+        self._llm = llama_cpp.Llama(model_path=model_path, n_ctx=n_ctx, n_batch=512, n_gpu_layers=n_gpu_layers,
+                                    verbose=verbose)
+        self.n_vocab = self._llm.n_vocab()
+        logging.info("Loaded draft model '{}'".format(model_path))
+
+    def _draft(self, input_ids: np.ndarray) -> np.ndarray:
+        llm = self._llm
+        if len(input_ids) + self.num_pred_tokens >= llm.n_ctx():
+            return np.array([], dtype=np.intc)
+
+        # Keep at least the last token to evaluate, its logits predict the first drafted token
+        n = min(llm.n_tokens, len(input_ids) - 1)
+        mismatches = np.nonzero(llm.input_ids[:n] != input_ids[:n])[0]
+        llm.n_tokens = int(mismatches[0]) if len(mismatches) else n
+        llm.eval(input_ids[llm.n_tokens:].tolist())
+
+        draft = []
+        for _ in range(self.num_pred_tokens):
+            logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(llm.ctx, -1), shape=(self.n_vocab,))
+            token = int(np.argmax(logits))
+            draft.append(token)
+            llm.eval([token])
+        return np.array(draft, dtype=np.intc)
+
+    @property
+    def info(self) -> dict:
+        return dict(super().info, model=self.model_path.split('/').pop())
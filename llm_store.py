@@ -0,0 +1,103 @@
+import os
+import json
+import logging
+import threading
+from typing import Union
+from urllib.parse import quote, unquote
+
+
+class ContextStore:
+    """Local store of context snapshots, one append-only JSONL file per context.
+
+    The first line holds the context settings and every following line one
+    user/assistant exchange, so a turn costs a single small append. The file
+    is rewritten (compacted) when the settings change or too many turns pile up.
+    """
+
+    suffix = '.jsonl'
+
+    # Rewrite a snapshot once this many turns have been appended to it
+    compact_after = 32
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._appended = {}
+        os.makedirs(directory, exist_ok=True)
+        logging.info("Context snapshots stored in '{}'".format(directory))
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._directory, quote(name, safe='') + self.suffix)
+
+    def save_context(self, name: str, settings: dict, history: list):
+        lines = [json.dumps({"type": "settings", "name": name, "settings": settings})]
+        for i in range(0, len(history) - 1, 2):
+            lines.append(json.dumps({"type": "turn", "messages": history[i:i + 2]}))
+
+        path = self._path(name)
+        with self._lock:
+            with open(path + '.tmp', 'w') as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(path + '.tmp', path)
+            self._appended[name] = 0
+
+    def append_turn(self, name: str, settings: dict, history: list):
+        # Only the latest user/assistant exchange is written unless the snapshot is due for compaction
+        if self._appended.get(name, 0) >= self.compact_after or not os.path.exists(self._path(name)):
+            self.save_context(name, settings, history)
+            return
+
+        with self._lock:
+            with open(self._path(name), 'a') as f:
+                f.write(json.dumps({"type": "turn", "messages": history[-2:]}) + "\n")
+            self._appended[name] = self._appended.get(name, 0) + 1
+
+    def load_context(self, name: str) -> Union[tuple, None]:
+        settings = None
+        history = []
+        try:
+            with self._lock, open(self._path(name), 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        item = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn write at the end of the file (crash while appending)
+                        logging.warning("Skipping damaged line in snapshot of context '{}'".format(name))
+                        continue
+                    if item['type'] == 'settings':
+                        settings = item['settings']
+                    elif item['type'] == 'turn':
+                        history += item['messages']
+        except FileNotFoundError:
+            return None
+
+        if settings is None:
+            logging.error("Snapshot of context '{}' has no settings".format(name))
+            return None
+
+        # Keep only the history window of the context
+        window = int(settings['history_count']) * 2
+        history = history[-window:] if window > 0 else []
+        return settings, history
+
+    def delete_context(self, name: str):
+        with self._lock:
+            self._appended.pop(name, None)
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+
+    def has_context(self, name: str) -> bool:
+        return os.path.exists(self._path(name))
+
+    def get_context_names(self) -> list:
+        return [unquote(file[:-len(self.suffix)]) for file in os.listdir(self._directory)
+                if file.endswith(self.suffix)]
+
+    @property
+    def directory(self):
+        return self._directory
@@ -1,12 +1,46 @@
 import sys
+import time
 from queue import Queue
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Union
 import demoji
 import logging
 
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import LLMResult
 
+from llm_timing import DirectiveTiming
+
+# Stream markers that close a response
+end_events = ('END', 'CANCELLED', 'TIMEOUT', 'FAILED')
+
+
+def is_end_marker(word: str) -> bool:
+    return any(word.startswith('|' + event + '-') for event in end_events)
+
+
+class DirectiveCancelled(Exception):
+    """Raised from the LLM callbacks to stop the generation of a cancelled directive."""
+
+
+class CancelCallbackHandler(BaseCallbackHandler):
+    """Callback handler that stops a generation at the next token once its directive is cancelled."""
+
+    raise_error = True
+
+    def __init__(self, cancel):
+        super(BaseCallbackHandler, self).__init__()
+        self._cancel = cancel
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
+        """Run when LLM starts running."""
+        if self._cancel.is_set():
+            raise DirectiveCancelled()
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        """Run on new LLM token. Only available when streaming is enabled."""
+        if self._cancel.is_set():
+            raise DirectiveCancelled()
+
 
 class PromptCallbackHandler(BaseCallbackHandler):
     def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> Any:
@@ -14,6 +48,38 @@ class PromptCallbackHandler(BaseCallbackHandler):
         logging.info(f"Prompt:\n\n{formatted_prompts}")
 
 
+class TimingCallbackHandler(BaseCallbackHandler):
+    """Callback handler used to split the LLM call of a directive into prefill and decode time."""
+
+    def __init__(self, timing: DirectiveTiming):
+        super(BaseCallbackHandler, self).__init__()
+        self._timing = timing
+        self._llm_start = None
+        self._first_token = None
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
+        """Run when LLM starts running."""
+        self._llm_start = time.monotonic()
+        self._first_token = None
+        self._timing.prompt_text = "\n".join(prompts)
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        """Run on new LLM token. Only available when streaming is enabled."""
+        if self._first_token is None:
+            self._first_token = time.monotonic()
+            self._timing.record('prefill', self._first_token - self._llm_start)
+        self._timing.completion_tokens += 1
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        """Run when LLM ends running."""
+        now = time.monotonic()
+        if self._first_token is None:
+            # Not streamed, so there is no way to tell prefill from decode
+            self._timing.record('prefill', now - self._llm_start)
+        else:
+            self._timing.record('decode', now - self._first_token)
+
+
 class Word2StdoutStreamer(BaseCallbackHandler):
     """Callback handler used to handle callbacks from langchain and output to stdout."""
 
@@ -33,11 +99,32 @@ class Word2StdoutStreamer(BaseCallbackHandler):
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
         """Run when chain ends running."""
         word = self._filter_word(self._word)
-        sys.stdout.write(word + "|END-{}|\n".format(self._token_count))
+        sys.stdout.write(word)
         sys.stdout.flush()
         self._word = ""
+
+    def end_response(self, timing: str = ""):
+        """Run when the directive is complete (after the history has been summarized)."""
+        if timing:
+            sys.stdout.write("|END-{}-{}|\n".format(self._token_count, timing))
+        else:
+            sys.stdout.write("|END-{}|\n".format(self._token_count))
+        sys.stdout.flush()
         self._token_count = 0
 
+    def abort_response(self, response_id: str, event: str, timing: str = ""):
+        """Run when a directive is cancelled or dropped, while it runs or before it started."""
+        count = 0
+        if response_id == self._con_id:
+            count = self._token_count
+            self._word = ""
+            self._token_count = 0
+        if timing:
+            sys.stdout.write("|{}-{}-{}|\n".format(event, count, timing))
+        else:
+            sys.stdout.write("|{}-{}|\n".format(event, count))
+        sys.stdout.flush()
+
     def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
         """Run on new LLM token. Only available when streaming is enabled."""
         self._token_count += 1
@@ -95,11 +182,31 @@ class Word2QueueStreamer(BaseCallbackHandler):
         """Run when chain ends running."""
         word = self._filter_word(self._word)
         self._streamer_queue.put(word)
-        end_code = "|END-{}-{}-{}|".format(self._resp_id, self._name, self._token_count)
-        self._streamer_queue.put(end_code)
         self._word = ""
+
+    def end_response(self, timing: str = ""):
+        """Run when the directive is complete (after the history has been summarized)."""
+        if timing:
+            end_code = "|END-{}-{}-{}-{}|".format(self._resp_id, self._name, self._token_count, timing)
+        else:
+            end_code = "|END-{}-{}-{}|".format(self._resp_id, self._name, self._token_count)
+        self._streamer_queue.put(end_code)
         self._token_count = 0
 
+    def abort_response(self, response_id: str, event: str, timing: str = ""):
+        """Run when a directive is cancelled or dropped, while it runs or before it started."""
+        count = 0
+        if response_id == self._resp_id:
+            # The partial word of the running response is dropped
+            count = self._token_count
+            self._word = ""
+            self._token_count = 0
+        if timing:
+            end_code = "|{}-{}-{}-{}-{}|".format(event, response_id, self._name, count, timing)
+        else:
+            end_code = "|{}-{}-{}-{}|".format(event, response_id, self._name, count)
+        self._streamer_queue.put(end_code)
+
     def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
         """Run on new LLM token. Only available when streaming is enabled."""
         self._token_count += 1
@@ -119,8 +226,9 @@ class Word2QueueStreamer(BaseCallbackHandler):
         else:
             self._word += token
 
-    def get_word(self):
-        return self._streamer_queue.get()
+    def get_word(self, timeout: Union[float, None] = None):
+        # Raises queue.Empty when no word arrives in time (timeout 0 does not wait)
+        return self._streamer_queue.get(timeout=timeout)
 
     def processed_word(self):
         self._streamer_queue.task_done()
@@ -33,4 +33,5 @@ j_template = j_environ.get_template("mistral.jinja2")
 prompt = PromptTemplate.from_template(j_template.render(messages=messages))
 chain = LLMChain(llm=llm, prompt=prompt, verbose=False)
 result = chain.invoke({}, {"callbacks": [callback]})
+callback.end_response()
 print(result)
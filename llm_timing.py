@@ -0,0 +1,76 @@
+import time
+from contextlib import contextmanager
+
+
+class DirectiveTiming:
+    """Per phase wall clock breakdown and token counts of a single directive."""
+
+    phases = ('queue', 'render', 'chain', 'prefill', 'decode', 'summarize')
+
+    def __init__(self, response_id: str, submitted: float = 0.0):
+        self.response_id = response_id
+        self.submitted = submitted if submitted else time.monotonic()
+        self.started = None
+        self.finished = None
+        self.durations = {}
+        self.prompt_text = ""
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def start(self):
+        # The directive has left the queue and is now being worked on
+        self.started = time.monotonic()
+        self.durations['queue'] = self.started - self.submitted
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    def record(self, phase: str, seconds: float):
+        self.durations[phase] = self.durations.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name: str):
+        t0 = time.monotonic()
+        try:
+            yield self
+        finally:
+            self.record(name, time.monotonic() - t0)
+
+    @property
+    def total(self) -> float:
+        end = self.finished if self.finished else time.monotonic()
+        return end - self.submitted
+
+    @property
+    def service(self) -> float:
+        # Time spent on the directive after it left the queue
+        if self.started is None:
+            return 0.0
+        end = self.finished if self.finished else time.monotonic()
+        return end - self.started
+
+    def as_dict(self) -> dict:
+        info = {"response_id": self.response_id}
+        for phase in self.phases:
+            info[phase + "_ms"] = round(self.durations.get(phase, 0.0) * 1000, 1)
+        info["total_ms"] = round(self.total * 1000, 1)
+        info["prompt_tokens"] = self.prompt_tokens
+        info["completion_tokens"] = self.completion_tokens
+        return info
+
+    def as_marker(self) -> str:
+        # Compact form carried by the END marker of a stream (no '-' or '|' allowed)
+        items = ["{}:{}".format(phase, int(self.durations.get(phase, 0.0) * 1000)) for phase in self.phases]
+        items.append("total:{}".format(int(self.total * 1000)))
+        items.append("prompt_tokens:{}".format(self.prompt_tokens))
+        items.append("completion_tokens:{}".format(self.completion_tokens))
+        return ",".join(items)
+
+    @staticmethod
+    def parse_marker(text: str) -> dict:
+        info = {}
+        for item in text.split(','):
+            key, _, value = item.partition(':')
+            if value.isdigit():
+                info[key] = int(value)
+        return info
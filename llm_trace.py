@@ -0,0 +1,68 @@
+import json
+import logging
+import threading
+import time
+
+from llm_timing import DirectiveTiming
+
+
+class TraceRecorder:
+    """Append-only JSONL trace of every directive handled by the server (used by llm_replay.py)."""
+
+    def __init__(self, trace_file: str, model_info: dict):
+        self._trace_file = trace_file
+        self._lock = threading.Lock()
+        self._file = open(trace_file, 'a', buffering=1)
+        self._write({"type": "header",
+                     "started": time.time(),
+                     "model_info": model_info})
+        logging.info("Recording directive trace to '{}'".format(trace_file))
+
+    def _write(self, item: dict):
+        line = json.dumps(item)
+        with self._lock:
+            if self._file:
+                self._file.write(line + "\n")
+
+    def record(self, arrival: float, context_name: str, context_info: dict, history_length: int,
+               msg: str, parameters: dict, effective_parameters: dict, timing: DirectiveTiming):
+        self._write({"type": "directive",
+                     "arrival": arrival,
+                     "response_id": timing.response_id,
+                     "context_name": context_name,
+                     "context_type": context_info['context_type'],
+                     "template": context_info['template_file'],
+                     "system_prompt": context_info['system_prompt'],
+                     "summarizer_type": context_info['summarizer_type'],
+                     "history_count": context_info['history_count'],
+                     "history_length": history_length,
+                     "msg": msg,
+                     "parameters": parameters,
+                     "effective_parameters": effective_parameters,
+                     "timing": timing.as_dict()})
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+                logging.info("Closed directive trace '{}'".format(self._trace_file))
+
+    @property
+    def trace_file(self):
+        return self._trace_file
+
+
+def load_trace(trace_file: str) -> list:
+    # Read the directive records of a trace sorted by arrival time
+    records = []
+    with open(trace_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                item = json.loads(line)
+                if item.get('type') == 'directive':
+                    records.append(item)
+
+    records.sort(key=lambda r: r['arrival'])
+    return records
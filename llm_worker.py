@@ -0,0 +1,520 @@
+import time
+import zlib
+import logging
+import itertools
+import threading
+import functools
+import multiprocessing
+from queue import Queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
+
+from llm_streamers import Word2QueueStreamer, is_end_marker
+
+
+class ModelWorkerError(Exception):
+    """Raised for a call to a model worker process that died (or was shut down) before answering."""
+
+
+class _PipeQueue:
+    """Stand-in for the streamer queue of a context in a worker process: the words go to the front end."""
+
+    def __init__(self, context_name: str, send):
+        self._context_name = context_name
+        self._send = send
+
+    def put(self, word: str):
+        self._send(('word', self._context_name, word))
+
+
+class Word2PipeStreamer(Word2QueueStreamer):
+    """Queue streamer of the worker processes, streaming the words over the worker's pipe."""
+
+    def __init__(self, name, send=None, **params):
+        super().__init__(name, **params)
+        self._streamer_queue = _PipeQueue(name, send)
+
+
+class RemoteStreamer:
+    """Front end side of a context's stream, fed by the worker process running the context."""
+
+    def __init__(self):
+        self._streamer_queue = Queue()
+
+    def put_word(self, word: str):
+        self._streamer_queue.put(word)
+
+    def get_word(self, timeout: Union[float, None] = None):
+        return self._streamer_queue.get(timeout=timeout)
+
+    def processed_word(self):
+        self._streamer_queue.task_done()
+
+    def no_words(self):
+        return self._streamer_queue.empty()
+
+
+class RemoteContext:
+    """What the front end knows of a context that lives in a worker process."""
+
+    def __init__(self, name: str, streamer: RemoteStreamer):
+        self.name = name
+        self.streamer = streamer
+
+
+def _serve_model(conn, llm_type: str, model: str, template: str, verbose: bool, kwargs: dict, index: int):
+    # Entry point of a worker process: load the model and answer the front end's calls
+    logging.basicConfig(level=logging.INFO, format="[worker {}] %(levelname)s:%(name)s:%(message)s".format(index))
+
+    from llm_llama import LlamaModel
+    from llm_openai import OpenAIModel
+    from llm_echo import EchoModel
+    model_types = {'llama': LlamaModel, 'openai': OpenAIModel, 'echo': EchoModel}
+
+    send_lock = threading.Lock()
+
+    def send(item):
+        with send_lock:
+            conn.send(item)
+
+    llm = model_types[llm_type](model, template, verbose, **kwargs)
+    # Contexts stream to the front end instead of a local queue
+    llm.streamer_types = dict(llm.streamer_types, queue=functools.partial(Word2PipeStreamer, send=send))
+
+    def context_stream(name):
+        # None for an unknown context, else whether the context streams its responses
+        context = llm.get_context(name)
+        return None if context is None else context.streamer is not None
+
+    calls = {'context_stream': context_stream}
+
+    def handle(call_id, method, args, call_kwargs):
+        try:
+            target = calls[method] if method in calls else getattr(llm, method)
+            value = target(*args, **call_kwargs) if callable(target) else target
+            send(('reply', call_id, True, value))
+        except Exception as ex:
+            send(('reply', call_id, False, ex))
+
+    # Calls run concurrently (like the HTTP handlers of an in-process model) so a slow one,
+    # such as a restart waiting for the running directive, does not hold up cancellations
+    send(('ready', 0, True, llm.model_info))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        while True:
+            try:
+                call_id, method, args, call_kwargs = conn.recv()
+            except (EOFError, OSError):
+                break
+            if method == 'exit':
+                break
+            executor.submit(handle, call_id, method, args, call_kwargs)
+
+    llm.shutdown()
+
+
+class _ModelWorker:
+    """A worker process, its pipe and the calls waiting for an answer."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.reader = None
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.ready = threading.Event()
+        self.model_info = {}
+        self.restarts = 0
+        self.next_start = 0.0
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+
+class WorkerLLM:
+    """Front end for models running in worker processes.
+
+    Offers the calls of BaseLanguageModel used by the REST server, and
+    forwards them over a pipe to the worker process holding the context
+    (a context always lives in the same worker, picked from a hash of its
+    name). The words of the responses stream back over the same pipe into
+    per context queues, so the server reads them as from a local streamer.
+
+    The HTTP handlers no longer share a GIL with the model, and a native
+    crash only takes down a worker: the supervisor ends its open responses
+    with a FAILED event and starts it again (backing off if it keeps
+    dying). The model file is mmap'ed by llama.cpp, so workers on the same
+    host share its pages. With a context store the contexts of a restarted
+    worker are rehydrated from their snapshots.
+    """
+
+    # Seconds between checks of the worker processes
+    check_interval = 1.0
+
+    # Seconds a worker process has to load the model
+    start_timeout = 600.0
+
+    # Longest wait between restarts of a worker that keeps dying
+    max_restart_backoff = 60.0
+
+    # Number of response ids remembered to route cancellations and timing lookups
+    max_responses = 1024
+
+    def __init__(self, llm_type: str, workers: int, model: str, template: str, verbose: bool = False, **kwargs):
+        self._args = (llm_type, model, template, verbose, kwargs)
+        self._workers = [_ModelWorker(index) for index in range(max(1, workers))]
+        self._call_ids = itertools.count(1)
+        self._streams = {}
+        self._streams_lock = threading.Lock()
+        self._responses = OrderedDict()
+        # Results are looked up as long as the workers keep them
+        self._max_responses = max(self.max_responses, kwargs.get('max_results', 0))
+        # Responses still streaming, and those that ended before their submit call returned
+        self._open = {}
+        self._ended = OrderedDict()
+        self._open_lock = threading.Lock()
+        self._trace_file = None
+        self._running = False
+        self._supervisor = None
+        self._start()
+
+    def _start(self):
+        self._running = True
+        for worker in self._workers:
+            self._spawn(worker)
+        for worker in self._workers:
+            deadline = time.monotonic() + self.start_timeout
+            while not worker.ready.wait(1.0) and worker.alive and time.monotonic() < deadline:
+                pass
+            if not worker.ready.is_set():
+                logging.error("Model worker {} did not start".format(worker.index))
+        self._supervisor = threading.Thread(target=self._supervise, daemon=True)
+        self._supervisor.start()
+
+    def _spawn(self, worker: _ModelWorker):
+        llm_type, model, template, verbose, kwargs = self._args
+        # Spawned rather than forked, the front end has threads (and the workers native ones)
+        mp = multiprocessing.get_context('spawn')
+        parent_conn, child_conn = mp.Pipe()
+        worker.ready.clear()
+        worker.conn = parent_conn
+        worker.process = mp.Process(target=_serve_model, name="llm-worker-{}".format(worker.index),
+                                    args=(child_conn, llm_type, model, template, verbose, kwargs, worker.index),
+                                    daemon=True)
+        worker.process.start()
+        child_conn.close()
+        worker.reader = threading.Thread(target=self._read, args=(worker, parent_conn), daemon=True)
+        worker.reader.start()
+        logging.info("Started model worker {} (pid {})".format(worker.index, worker.process.pid))
+
+    def _read(self, worker: _ModelWorker, conn):
+        # Route the answers to the waiting calls and the words to the context streams
+        while True:
+            try:
+                kind, key, ok, value = self._unpack(conn.recv())
+            except (EOFError, OSError):
+                break
+
+            if kind == 'word':
+                self._stream_word(key, value)
+            elif kind == 'ready':
+                worker.model_info = value
+                worker.ready.set()
+                if self._trace_file:
+                    self._send(worker, 'start_trace', self._trace_file)
+            else:
+                slot = worker.pending.pop(key, None)
+                if slot:
+                    slot['ok'], slot['value'] = ok, value
+                    slot['done'].set()
+
+        self._fail_pending(worker)
+
+    @staticmethod
+    def _unpack(item: tuple) -> tuple:
+        # Words are (kind, context, word), answers (kind, call id, ok, value)
+        return (item[0], item[1], True, item[2]) if item[0] == 'word' else item
+
+    def _stream_word(self, context_name: str, word: str):
+        self._stream(context_name).put_word(word)
+        if is_end_marker(word):
+            self._close_response(word[1:-1].split('-')[1])
+
+    def _close_response(self, response_id: str):
+        # The end marker can be read before the answer to the submit call
+        with self._open_lock:
+            if self._open.pop(response_id, None) is None:
+                self._ended[response_id] = True
+                while len(self._ended) > self._max_responses:
+                    self._ended.popitem(last=False)
+
+    def _stream(self, context_name: str) -> RemoteStreamer:
+        with self._streams_lock:
+            stream = self._streams.get(context_name)
+            if stream is None:
+                stream = RemoteStreamer()
+                self._streams[context_name] = stream
+            return stream
+
+    def _fail_pending(self, worker: _ModelWorker):
+        # The worker is gone, so nothing it was asked will be answered
+        with worker.lock:
+            pending = list(worker.pending.values())
+            worker.pending.clear()
+        for slot in pending:
+            slot['ok'], slot['value'] = False, ModelWorkerError("Model worker {} stopped".format(worker.index))
+            slot['done'].set()
+
+    def _supervise(self):
+        while self._running:
+            time.sleep(self.check_interval)
+            for worker in self._workers:
+                if self._running and not worker.alive and time.monotonic() >= worker.next_start:
+                    self._recover(worker)
+
+    def _recover(self, worker: _ModelWorker):
+        logging.error("Model worker {} died (exit code {}), restarting it".format(worker.index,
+                                                                                  worker.process.exitcode))
+        self._fail_pending(worker)
+        worker.ready.clear()
+
+        # Close the responses it was working on
+        with self._open_lock:
+            failed = [(response_id, context_name) for response_id, context_name in self._open.items()
+                      if self._worker_of(context_name) is worker]
+            for response_id, _context_name in failed:
+                del self._open[response_id]
+        for response_id, context_name in failed:
+            self._stream(context_name).put_word("|FAILED-{}-{}-0|".format(response_id, context_name))
+
+        worker.restarts += 1
+        worker.next_start = time.monotonic() + min(self.max_restart_backoff, 2.0 ** worker.restarts)
+        self._spawn(worker)
+
+    def _worker_of(self, context_name: str) -> _ModelWorker:
+        return self._workers[zlib.crc32(context_name.encode('utf-8')) % len(self._workers)]
+
+    def _send(self, worker: _ModelWorker, method: str, *args, **kwargs):
+        # Call without waiting for the answer
+        with worker.lock:
+            worker.conn.send((next(self._call_ids), method, args, kwargs))
+
+    def _call(self, worker: _ModelWorker, method: str, *args, **kwargs):
+        if not worker.ready.wait(self.start_timeout):
+            raise ModelWorkerError("Model worker {} is not running".format(worker.index))
+
+        call_id = next(self._call_ids)
+        slot = {'done': threading.Event(), 'ok': False, 'value': None}
+        with worker.lock:
+            worker.pending[call_id] = slot
+            try:
+                worker.conn.send((call_id, method, args, kwargs))
+            except (OSError, ValueError) as ex:
+                worker.pending.pop(call_id, None)
+                raise ModelWorkerError("Model worker {} stopped: {}".format(worker.index, ex))
+
+        slot['done'].wait()
+        if not slot['ok']:
+            raise slot['value']
+        return slot['value']
+
+    def _call_context(self, context_name: str, method: str, *args, **kwargs):
+        return self._call(self._worker_of(context_name), method, context_name, *args, **kwargs)
+
+    def _call_all(self, method: str, *args, **kwargs) -> list:
+        return [self._call(worker, method, *args, **kwargs) for worker in self._workers]
+
+    def _merge_info(self, infos: list) -> dict:
+        return infos[0] if len(infos) == 1 else {"workers": infos}
+
+    def _remember_response(self, response_id: str, context_name: str):
+        self._responses[response_id] = context_name
+        while len(self._responses) > self._max_responses:
+            self._responses.popitem(last=False)
+
+    def shutdown(self):
+        # Stop the worker processes (restart() starts new ones)
+        if not self._running:
+            return
+        self._running = False
+        self._supervisor.join()
+        for worker in self._workers:
+            if worker.alive:
+                try:
+                    self._send(worker, 'exit')
+                except OSError:
+                    pass
+                worker.process.join(30.0)
+                if worker.alive:
+                    worker.process.kill()
+            worker.conn.close()
+            self._fail_pending(worker)
+        logging.info("Model workers have been shutdown.")
+
+    def restart(self):
+        self.shutdown()
+        for worker in self._workers:
+            worker.restarts = 0
+            worker.next_start = 0.0
+        self._start()
+        logging.info("Model workers have been restarted.")
+
+    def swap_model(self, model: str, **params) -> (bool, str):
+        # One worker after the other, the others keep serving while one loads
+        for worker in self._workers:
+            success, msg = self._call(worker, 'swap_model', model, **params)
+            if not success:
+                return False, msg
+            worker.model_info = self._call(worker, 'model_info')
+
+        # Restarted workers load the new model
+        llm_type, _model, template, verbose, kwargs = self._args
+        self._args = (llm_type, model, template, verbose, dict(kwargs, **params))
+        msg = "Swapped {} model workers to model '{}'.".format(len(self._workers), model)
+        logging.info(msg)
+        return True, msg
+
+    @property
+    def model_state(self) -> str:
+        states = [state for state in self._call_all('model_state') if state != 'ready']
+        return states[0] if states else 'ready'
+
+    def start_trace(self, trace_file: str):
+        self._trace_file = trace_file
+        self._call_all('start_trace', trace_file)
+
+    def stop_trace(self):
+        self._trace_file = None
+        self._call_all('stop_trace')
+
+    def create_context(self, context_name: str, **params) -> (bool, str):
+        return self._call_context(context_name, 'create_context', **params)
+
+    def fork_context(self, parent_name: str, context_name: str) -> (bool, str):
+        # A fork that lands in another worker gets a copy of the parent's settings and history
+        worker = self._worker_of(context_name)
+        if worker is self._worker_of(parent_name):
+            return self._call(worker, 'fork_context', parent_name, context_name)
+
+        snapshot = self._call_context(parent_name, 'export_context')
+        if snapshot is None:
+            msg = "Unknown context '{}'.".format(parent_name)
+            logging.error(msg)
+            return False, msg
+        return self._call(worker, 'import_context', context_name, snapshot)
+
+    def context_busy(self, context_name: str) -> bool:
+        return self._call_context(context_name, 'context_busy')
+
+    def export_context(self, context_name: str) -> Union[dict, None]:
+        return self._call_context(context_name, 'export_context')
+
+    def import_context(self, context_name: str, snapshot: dict) -> (bool, str):
+        return self._call_context(context_name, 'import_context', snapshot)
+
+    def delete_context(self, context_name: str) -> bool:
+        return self._call_context(context_name, 'delete_context')
+
+    def clear_context(self, context_name: str) -> bool:
+        return self._call_context(context_name, 'clear_context')
+
+    def get_context_info(self, context_name: str) -> Union[dict, None]:
+        return self._call_context(context_name, 'get_context_info')
+
+    def get_context(self, context_name: str) -> Union[RemoteContext, None]:
+        streamed = self._call_context(context_name, 'context_stream')
+        if streamed is None:
+            return None
+        return RemoteContext(context_name, self._stream(context_name) if streamed else None)
+
+    def get_history(self, context_name: str):
+        return self._call_context(context_name, 'get_history')
+
+    def load_template(self, context_name: str, template_file: str) -> bool:
+        return self._call_context(context_name, 'load_template', template_file)
+
+    def get_template(self, context_name: str) -> Union[str, None]:
+        return self._call_context(context_name, 'get_template')
+
+    def set_system_prompt(self, context_name: str, system_prompt: str) -> bool:
+        return self._call_context(context_name, 'set_system_prompt', system_prompt)
+
+    def submit_directive(self, context_name: str, msg: str, *args, **kwargs) -> Union[str, None]:
+        # QueueFull and ValueError raised in the worker are raised here
+        response_id = self._call_context(context_name, 'submit_directive', msg, *args, **kwargs)
+        if response_id:
+            self._remember_response(response_id, context_name)
+            with self._open_lock:
+                if self._ended.pop(response_id, None) is None:
+                    self._open[response_id] = context_name
+        return response_id
+
+    def cancel_directive(self, response_id: str) -> bool:
+        context_name = self._responses.get(response_id)
+        if context_name is None:
+            logging.error("Unknown or completed response '{}'.".format(response_id))
+            return False
+        return self._call(self._worker_of(context_name), 'cancel_directive', response_id)
+
+    def cancel_directives(self, context_name: str) -> list:
+        return self._call_context(context_name, 'cancel_directives')
+
+    def get_directive_timing(self, response_id: str) -> Union[dict, None]:
+        context_name = self._responses.get(response_id)
+        if context_name is None:
+            logging.error("Unknown response '{}'.".format(response_id))
+            return None
+        return self._call(self._worker_of(context_name), 'get_directive_timing', response_id)
+
+    def get_directive_result(self, response_id: str) -> Union[dict, None]:
+        context_name = self._responses.get(response_id)
+        if context_name is None:
+            logging.error("Unknown response '{}'.".format(response_id))
+            return None
+        result = self._call(self._worker_of(context_name), 'get_directive_result', response_id)
+        if result and result['state'] == 'done':
+            # Contexts without a stream never send the end marker
+            with self._open_lock:
+                self._open.pop(response_id, None)
+        return result
+
+    def get_tenant_usage(self, tenant: Union[str, None] = None) -> dict:
+        return self._merge_info(self._call_all('get_tenant_usage', tenant))
+
+    def get_context_names(self):
+        # Workers sharing a store list the same snapshots
+        names = []
+        for worker_names in self._call_all('get_context_names'):
+            names += [name for name in worker_names if name not in names]
+        return names
+
+    @property
+    def registry_info(self):
+        return self._merge_info(self._call_all('registry_info'))
+
+    @property
+    def results_info(self):
+        return self._merge_info(self._call_all('results_info'))
+
+    @property
+    def models_info(self):
+        return self._merge_info(self._call_all('models_info'))
+
+    @property
+    def queue_info(self):
+        return self._merge_info(self._call_all('queue_info'))
+
+    @property
+    def worker_info(self) -> list:
+        return [{"worker": worker.index,
+                 "pid": worker.process.pid if worker.process else None,
+                 "alive": worker.alive,
+                 "restarts": worker.restarts} for worker in self._workers]
+
+    @property
+    def model_info(self):
+        info = dict(self._workers[0].model_info)
+        info['model_workers'] = len(self._workers)
+        return info
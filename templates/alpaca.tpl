@@ -1,3 +1,4 @@
+ContextStandard {"stop": ["### Instruction:", "### Human:"]}
 Below is an instruction that describes a task. Write a response that appropriately completes the request.
 
 ### Instruction:
@@ -1,3 +1,4 @@
+ContextStandard {"stop": ["</s>", "[INST]"]}
 [INST] <<SYS>>
 Talk like a pirate in your responses.
 <<SYS>>
@@ -1 +1,2 @@
+ContextStandard {"stop": ["</s>", "[INST]"]}
 </s>[INST] Context: {history} Question: {input} [/INST]
\ No newline at end of file
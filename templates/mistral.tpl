@@ -1,3 +1,4 @@
+ContextStandard {"stop": ["\nQuestion:", "\nHistory:"]}
 You are a helpful AI assistant. Use the following pieces of context to answer the question at the end.
 If you don't know the answer, just say that you don't know, don't try to make up an answer.
 History: {history}
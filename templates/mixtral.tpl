@@ -1,2 +1,3 @@
+ContextStandard {"stop": ["\nQuestion:", "\nContext:"]}
 Context: {history}
 Question: {input}
@@ -1 +1,2 @@
+ContextStandard {"stop": ["<|end_of_turn|>", "GPT4 Correct User:"]}
 GPT4 Correct User: {history} {input}<|end_of_turn|>GPT4 Correct Assistant:
@@ -1,2 +1,3 @@
+ContextStandard {"stop": ["\nInstruct:", "<|endoftext|>"], "max_tokens": 512}
 Instruct: {history} {input}
 Output:
\ No newline at end of file
@@ -1,3 +1,4 @@
+ContextStandard {"stop": ["<|im_end|>", "<|im_start|>"], "max_tokens": 512}
 <|im_start|>system
 Act as friendly and polite chatbot that answers general questions one at a time.<|im_end|>
 <|im_start|>user
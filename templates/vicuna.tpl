@@ -1,3 +1,4 @@
+ContextStandard {"stop": ["\nUSER:", "</s>"]}
 A chat between a curious user and an artificial intelligence assistant.
 The assistant gives helpful, detailed, and polite answers to the user's questions.
 USER: {history} {input}
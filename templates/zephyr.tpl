@@ -1,4 +1,4 @@
-ContextStandard
+ContextStandard {"stop": ["</s>", "<|user|>"]}
 <|system|>
 {system}</s>
 <|user|>